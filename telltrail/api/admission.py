@@ -0,0 +1,215 @@
+"""
+Admission control for the TellTrail API.
+
+Each DataSource gets a token bucket, refilled at its rate limit in identities per second up to
+its burst limit, and a cap on its requests in progress.  A request costs the number of
+identities it looks up, and one that would overdraw the bucket or exceed the cap is refused
+at once with 429 Too Many Requests and a Retry-After, before it touches the database.
+
+The buckets live in a small file, memory mapped by every worker, with one slot per data
+source found by open addressing on its pk.  A slot is updated under an fcntl lock on its
+bytes, so workers only contend for the same source.  Requests in progress hold leases in
+their slot, which expire after ADMISSION_LEASE seconds, so a worker killed mid-request
+doesn't hold its leases for good.  Streaming responses renew their leases as they go, so a
+long stream counts against the cap until it ends.
+"""
+from django.http import HttpResponse
+from threading import Lock
+import fcntl
+import math
+import mmap
+import os
+import struct
+import time
+from telltrail.utils import setting
+
+SLOTS = 1024
+LEASES = 16
+SLOT = struct.Struct('<Qdd%dd' % LEASES) # source pk, tokens, last refill, lease expiry times
+
+class AdmissionTable(object):
+    """
+    The shared table of data source buckets.
+    """
+    def __init__(self,path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        self.path = path
+        self.fd = os.open(path,os.O_RDWR | os.O_CREAT,0600)
+        if os.fstat(self.fd).st_size < SLOT.size * SLOTS:
+            os.ftruncate(self.fd,SLOT.size * SLOTS)
+        self.map = mmap.mmap(self.fd,SLOT.size * SLOTS)
+        self.pid = os.getpid()
+        self.lock = Lock() # fcntl locks are held by the process, so threads take turns first
+    
+    def locked(self,slot,function):
+        """
+        Calls function with the slot's fields, under the slot's lock, writing back the fields
+        it returns with its result.
+        """
+        offset = slot * SLOT.size
+        with self.lock:
+            fcntl.lockf(self.fd,fcntl.LOCK_EX,SLOT.size,offset)
+            try:
+                fields, result = function(list(SLOT.unpack_from(self.map,offset)))
+                if fields is not None:
+                    SLOT.pack_into(self.map,offset,*fields)
+                return result
+            finally:
+                fcntl.lockf(self.fd,fcntl.LOCK_UN,SLOT.size,offset)
+    
+    def slot(self,source_id):
+        """
+        The slot of the data source, claiming a free one if it has none, or None if the
+        table is full.
+        """
+        def claim(fields):
+            if fields[0] == source_id:
+                return None, True
+            elif fields[0] == 0:
+                return [source_id,0.0,0.0] + [0.0] * LEASES, True
+            return None, False
+        
+        for probe in xrange(SLOTS):
+            slot = (source_id + probe) % SLOTS
+            owner = struct.unpack_from('<Q',self.map,slot * SLOT.size)[0]
+            if owner == source_id or (owner == 0 and self.locked(slot,claim)):
+                return slot
+        return None
+    
+    def acquire(self,source_id,cost,rate,burst,concurrency):
+        """
+        Takes cost tokens and a lease for the data source.  Returns (lease, retry after): the
+        lease to release when the request is done, or None and the seconds to wait if refused.
+        Costs over the burst limit are admitted once the bucket is full, leaving it in debt.
+        A lease is its position in the table and its expiry time, which tells it apart from a
+        later lease in the same position once it has expired.
+        """
+        slot = self.slot(source_id)
+        if slot is None:
+            return (-1,0.0), None # too many sources to track, so none are limited
+        concurrency = min(concurrency,LEASES)
+        now = time.time()
+        
+        def take(fields):
+            tokens, refilled, leases = fields[1], fields[2], fields[3:]
+            tokens = burst if refilled == 0 else min(burst,tokens + (now - refilled) * rate) # a new slot starts full
+            free = [n for n in range(concurrency) if leases[n] <= now]
+            if not free:
+                return None, (None,1)
+            needed = min(cost,burst)
+            if tokens < needed:
+                return None, (None,(needed - tokens) / rate if rate > 0 else setting('ADMISSION_LEASE',60))
+            leases[free[0]] = now + setting('ADMISSION_LEASE',60)
+            return [source_id,tokens - cost,now] + leases, ((slot * LEASES + free[0],leases[free[0]]),None)
+        
+        return self.locked(slot,take)
+    
+    def renew(self,lease):
+        """
+        Extends a lease taken by acquire for another ADMISSION_LEASE seconds, returning the
+        renewed lease, or None if it had already expired.
+        """
+        position, expires = lease
+        if position < 0:
+            return lease
+        slot, n = divmod(position,LEASES)
+        
+        def extend(fields):
+            if fields[3 + n] != expires:
+                return None, None
+            fields[3 + n] = time.time() + setting('ADMISSION_LEASE',60)
+            return fields, (position,fields[3 + n])
+        
+        return self.locked(slot,extend)
+    
+    def release(self,lease):
+        """
+        Gives back a lease taken by acquire, unless it has expired and been taken again.
+        """
+        position, expires = lease
+        if position < 0:
+            return
+        slot, n = divmod(position,LEASES)
+        
+        def give_back(fields):
+            if fields[3 + n] != expires:
+                return None, None
+            fields[3 + n] = 0.0
+            return fields, None
+        
+        self.locked(slot,give_back)
+
+_table = None
+
+def admission_table():
+    """
+    Gets this worker's view of the table at the ADMISSION_PATH setting, opened after any fork.
+    """
+    global _table
+    path = setting('ADMISSION_PATH','/tmp/telltrail-admission')
+    if _table is None or _table.pid != os.getpid() or _table.path != path:
+        _table = AdmissionTable(path)
+    return _table
+
+def lookup_cost(params):
+    """
+    The cost of a lookup with the four lookup variables, the number of identities it names.
+    """
+    cost = 0
+    for name in ('profile','identity'):
+        if name in params:
+            cost += 1
+        if name + '_list' in params:
+            cost += len(params[name + '_list'].split(','))
+    return max(cost,1)
+
+def too_many_requests(retry_after):
+    """
+    The response refusing a request, to be retried after so many seconds.
+    """
+    response = HttpResponse('Too Many Requests',status=429,content_type='text/plain')
+    response['Retry-After'] = '%d' % max(1,int(math.ceil(retry_after)))
+    return response
+
+def admit(request,source,cost):
+    """
+    Admits a request from the data source costing so many identities, returning None, or the
+    429 response to send if it is over the source's limits.  A request is only charged once,
+    and AdmissionMiddleware releases its lease when the response is done.
+    """
+    if not setting('ADMISSION_CONTROL',False) or hasattr(request,'admission_lease'):
+        return None
+    rate = max(source.rate_limit if source.rate_limit is not None else setting('ADMISSION_RATE',1000.0),0)
+    burst = source.burst_limit if source.burst_limit is not None else setting('ADMISSION_BURST',10000)
+    concurrency = source.concurrency_limit if source.concurrency_limit is not None else setting('ADMISSION_CONCURRENCY',4)
+    lease, retry_after = admission_table().acquire(source.pk,cost,float(rate),float(burst),concurrency)
+    if lease is None:
+        return too_many_requests(retry_after)
+    request.admission_lease = lease
+    return None
+
+def renew(request):
+    """
+    Renews the request's lease, if it has one, as a long response goes on.
+    """
+    lease = getattr(request,'admission_lease',None)
+    if lease is not None:
+        renewed = admission_table().renew(lease)
+        if renewed is None:
+            del request.admission_lease
+        else:
+            request.admission_lease = renewed
+
+def release(request):
+    """
+    Releases the request's lease, if it has one.
+    """
+    lease = getattr(request,'admission_lease',None)
+    if lease is not None:
+        del request.admission_lease
+        admission_table().release(lease)
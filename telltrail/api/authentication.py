@@ -0,0 +1,90 @@
+"""
+API key authentication for TellTrail.
+"""
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import time
+from telltrail.utils import setting
+from telltrail.cache import get_generation, bump_generation, generations_shared
+
+def digest_key(api_key):
+    """
+    The digest of an API key, as stored in DataSource.api_key_digest.
+    """
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+class SourceCache(object):
+    """
+    In-process cache of DataSources by API key digest.  Unknown keys are cached too, as None,
+    so repeated bad keys don't reach the database.  Entries expire after the API_KEY_CACHE_TIMEOUT
+    setting, and the whole cache is dropped whenever the shared 'datasources' generation moves on,
+    which happens on every DataSource change.  Without a default cache shared by the workers
+    nothing is cached, since other workers couldn't learn of a change at once.
+    """
+    def __init__(self):
+        self.size = setting('API_KEY_CACHE_SIZE',10000)
+        self.timeout = setting('API_KEY_CACHE_TIMEOUT',300)
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = Lock()
+    
+    def get(self,digest):
+        """
+        Gets the (found, source) pair for the digest.
+        """
+        if not generations_shared():
+            return False, None
+        generation = get_generation('datasources')
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            entry = self.entries.get(digest)
+            if entry and entry[0] > time.time():
+                return True, entry[1]
+        return False, None
+    
+    def set(self,digest,source):
+        """
+        Caches the source, or None for an unknown key.
+        """
+        if not generations_shared():
+            return
+        with self.lock:
+            self.entries.pop(digest,None)
+            self.entries[digest] = (time.time() + self.timeout,source)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+    
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        with self.lock:
+            self.entries.clear()
+
+source_cache = SourceCache()
+
+def authenticate(api_key):
+    """
+    Gets the DataSource for the API key, or None if the key is unknown.  Callers must still
+    check that the source is active.
+    """
+    from telltrail.models import DataSource
+    digest = digest_key(api_key)
+    found, source = source_cache.get(digest)
+    if not found:
+        source = DataSource.objects.filter(api_key_digest=digest).first()
+        source_cache.set(digest,source)
+    return source
+
+def revoke_cached_sources():
+    """
+    Drops every cached source, in this process and, through the shared generation, in all the 
+    others.  Called whenever a DataSource is saved or deleted, so deactivation takes effect at
+    once.  Queryset updates and deletes send no signals, so code changing sources with
+    DataSource.objects.update() must call this itself.
+    """
+    source_cache.clear()
+    bump_generation('datasources')
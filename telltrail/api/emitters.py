@@ -0,0 +1,158 @@
+"""
+Fast JSON emitter for the TellTrail API.
+
+Piston's JSONEmitter first copies the whole response through Emitter.construct, a recursive
+walk that rebuilds every dict and list, then serializes the copy with the pure Python encoder
+json uses whenever indent is given.  Policy responses are nothing but dicts, lists, strings,
+numbers, booleans and None, so FastJSONEmitter writes them straight to JSON instead, producing
+exactly the same text: indent=4, ensure_ascii=False, keys in the order piston's copies have.
+Anything else falls back to piston.
+
+Encoded dict keys and the values of INTERNED_KEYS, which repeat across policies (service
+names, consumer names and domains, scope paths), are cached, as is the key order of each
+shape of dict.
+"""
+from json.encoder import encode_basestring, FLOAT_REPR, INFINITY
+from piston.emitters import Emitter, JSONEmitter
+from piston.validate_jsonp import is_valid_jsonp_callback_value
+
+INDENT = 4
+ITEM_SEPARATOR = ', '
+KEY_SEPARATOR = ': '
+INTERNED_KEYS = frozenset(['service','name','domain','scope'])
+CACHE_SIZE = 10000
+
+class Unencodable(TypeError):
+    """
+    Raised for a value the fast encoder leaves to piston.
+    """
+    pass
+
+_strings = {}
+_orders = {}
+
+def encode_string(value):
+    """
+    Encodes a string as piston does, decoding byte strings as UTF-8 first.
+    """
+    if isinstance(value,str):
+        value = value.decode('utf-8')
+    return encode_basestring(value)
+
+def interned(value):
+    """
+    Encodes a string that is likely to repeat, caching the encoding.
+    """
+    encoded = _strings.get(value)
+    if encoded is None:
+        if len(_strings) >= CACHE_SIZE:
+            _strings.clear()
+        encoded = _strings[value] = encode_string(value)
+    return encoded
+
+def key_order(data):
+    """
+    The order piston's copy of the dict iterates its keys in.  The copy is a new dict filled
+    in the original's order, so its order depends only on the keys and that order.
+    """
+    keys = tuple(data)
+    order = _orders.get(keys)
+    if order is None:
+        if len(_orders) >= CACHE_SIZE:
+            _orders.clear()
+        order = _orders[keys] = tuple(dict((key,None) for key in keys))
+    return order
+
+def encode_float(value):
+    """
+    Encodes a float as json does.
+    """
+    if value != value:
+        return 'NaN'
+    elif value == INFINITY:
+        return 'Infinity'
+    elif value == -INFINITY:
+        return '-Infinity'
+    return FLOAT_REPR(value)
+
+def encode(value,chunks,level=0,intern=False):
+    """
+    Appends the JSON encoding of the value to the list of chunks.
+    """
+    if isinstance(value,basestring):
+        chunks.append(interned(value) if intern else encode_string(value))
+    elif value is None:
+        chunks.append('null')
+    elif value is True:
+        chunks.append('true')
+    elif value is False:
+        chunks.append('false')
+    elif isinstance(value,(int,long)):
+        chunks.append(str(value))
+    elif isinstance(value,float):
+        chunks.append(encode_float(value))
+    elif isinstance(value,list):
+        if not value:
+            chunks.append('[]')
+            return
+        newline_indent = '\n' + ' ' * (INDENT * (level + 1))
+        separator = ITEM_SEPARATOR + newline_indent
+        chunks.append('[' + newline_indent)
+        first = True
+        for item in value:
+            if first:
+                first = False
+            else:
+                chunks.append(separator)
+            encode(item,chunks,level + 1)
+        chunks.append('\n' + ' ' * (INDENT * level) + ']')
+    elif isinstance(value,dict):
+        if not value:
+            chunks.append('{}')
+            return
+        newline_indent = '\n' + ' ' * (INDENT * (level + 1))
+        separator = ITEM_SEPARATOR + newline_indent
+        chunks.append('{' + newline_indent)
+        first = True
+        for key in key_order(value):
+            if not isinstance(key,basestring):
+                raise Unencodable(key)
+            if first:
+                first = False
+            else:
+                chunks.append(separator)
+            chunks.append(interned(key))
+            chunks.append(KEY_SEPARATOR)
+            encode(value[key],chunks,level + 1,key in INTERNED_KEYS)
+        chunks.append('\n' + ' ' * (INDENT * level) + '}')
+    else:
+        # tuples, sets, models, decimals, dates and responses are all left to piston
+        raise Unencodable(value)
+
+def dumps(data):
+    """
+    Encodes the data as piston's JSONEmitter does.  Raises Unencodable if the data holds
+    anything but dicts with string keys, lists, strings, numbers, booleans and None.
+    """
+    chunks = []
+    encode(data,chunks)
+    return u''.join(chunks)
+
+class FastJSONEmitter(JSONEmitter):
+    """
+    JSONEmitter writing plain data directly, and anything else through piston.
+    """
+    def render(self,request):
+        try:
+            seria = dumps(self.data)
+        except Unencodable:
+            return super(FastJSONEmitter,self).render(request)
+        
+        # Callback
+        cb = request.GET.get('callback',None)
+        if cb and is_valid_jsonp_callback_value(cb):
+            return '%s(%s)' % (cb,seria)
+        
+        return seria
+
+Emitter.register('json',FastJSONEmitter,'application/json; charset=utf-8')
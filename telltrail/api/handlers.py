@@ -3,8 +3,27 @@ Handlers for TellTrail API.
 """
 from piston.handler import BaseHandler
 from piston.utils import rc
-from telltrail.models import Identity, DataSource, Service
-from itertools import chain
+from telltrail.models import CanonicalIdentity, DataConsumer
+from telltrail.cache import get_policies
+from telltrail.decisions import decide_many
+from telltrail.audiences import audience_index
+from telltrail.lookups import resolve_profiles, resolve_identities, resolve_identity_pairs, MalformedLookup
+from telltrail.api.authentication import authenticate
+from telltrail.api.admission import admit, lookup_cost
+from telltrail.utils import setting, chunked
+from telltrail.changes import read_changes
+from telltrail.metrics import instrument
+from collections import OrderedDict
+import json
+
+def request_json(request):
+    """
+    Gets the JSON body of the request, as translated by piston or straight from the body.
+    """
+    data = getattr(request,'data',None)
+    if isinstance(data,(dict,list)):
+        return data
+    return json.loads(request.body)
 
 class PolicyHandler(BaseHandler):
     """
@@ -12,48 +31,150 @@ class PolicyHandler(BaseHandler):
     """
     allow_methods = ('GET','POST')
     
-    def process_profile(self,profile):
+    def render_canonical_identities(self,canonical_identity_ids):
         """
-        Processes a single profile.
+        Renders the policies for the canonical identity ids, in order.  Policies come from the
+        policy cache, with any misses rendered together in bulk.
         """
-        try:
-            identity = Identity.objects.get(profile=profile)
-            return [claim.canonical_identity.render_policy() for claim in identity.identity_claims.all()]
-        except Identity.DoesNotExist:
-            return []
+        canonical_identity_ids = list(canonical_identity_ids)
+        policies = get_policies(canonical_identity_ids)
+        return [policies[pk] for pk in canonical_identity_ids]
     
-    def process_profile_list(self,profile_list):
+    def lookup_inputs(self,params):
         """
-        Processes a list of profiles.
+        Gathers the profiles and identity strings named by the four lookup variables, in order
+        and without repeats.
         """
-        identities = Identity.objects.filter(profile__in=profile_list)
-        return [claim.canonical_identity.render_policy() for claim in chain(*[identity.identity_claims.all() for identity in identities])]
+        profiles = []
+        if 'profile' in params:
+            profiles.append(params['profile'])
+        if 'profile_list' in params:
+            profiles += params['profile_list'].split(',')
+        
+        identity_strings = []
+        if 'identity' in params:
+            identity_strings.append(params['identity'])
+        if 'identity_list' in params:
+            identity_strings += params['identity_list'].split(',')
+        
+        return list(OrderedDict.fromkeys(profiles)), list(OrderedDict.fromkeys(identity_strings))
     
-    def process_identity(self,identity_string):
+    def resolve_lookups(self,params):
         """
-        Processes an identity string.
+        Resolves the four lookup variables together.  Returns the matching canonical identity
+        pks, in order, mapped to the inputs that matched them as {"profiles":[...],"identities":[...]},
+        and error entries for malformed identity strings.
         """
-        identity_name, service_name = identity_string.split('@@')
-        try:
-            identity = Identity.objects.get(service__name__iexact=service_name,identity__iexact=identity_name)
-            return [claim.canonical_identity.render_policy() for claim in identity.identity_claims.all()]
-        except Identity.DoesNotExist:
-            return []
+        profiles, identity_strings = self.lookup_inputs(params)
+        resolved_profiles = resolve_profiles(profiles)
+        resolved_identities = resolve_identities(identity_strings)
+        
+        matches = OrderedDict()
+        errors = []
+        for profile in profiles:
+            for pk in resolved_profiles[profile]:
+                matched_by = matches.setdefault(pk,{'profiles':[],'identities':[]})
+                if profile not in matched_by['profiles']:
+                    matched_by['profiles'].append(profile)
+        for identity_string in identity_strings:
+            if isinstance(resolved_identities[identity_string],MalformedLookup):
+                errors.append({'identity':identity_string,'error':unicode(resolved_identities[identity_string])})
+                continue
+            for pk in resolved_identities[identity_string]:
+                matched_by = matches.setdefault(pk,{'profiles':[],'identities':[]})
+                if identity_string not in matched_by['identities']:
+                    matched_by['identities'].append(identity_string)
+        return matches, errors
     
-    def process_identity_list(self,identity_list):
+    def process_lookups(self,params,lookups=None,versions=None):
         """
-        Processes a list of identity strings.
+        Renders each canonical identity matching the four lookup variables once, however many of
+        the inputs matched it.  Each policy records the inputs that matched it as 'matched_by'.
+        Malformed identity strings get error entries after the policies.  Lookups already
+        resolved by resolve_lookups, and the policy versions they were checked against, may be
+        passed in.
         """
+        matches, errors = lookups or self.resolve_lookups(params)
+        policies = get_policies(matches.keys(),versions)
         policy_list = []
-        for identity_string in identity_list.split(','):
-            try:
-                print 'identity string',identity_string
-                identity_name, service_name = identity_string.split('@@')
-                identity = Identity.objects.get(identity__iexact=identity_name,service__name__iexact=service_name)
-                policy_list += [claim.canonical_identity.render_policy() for claim in identity.identity_claims.all()]
-            except Identity.DoesNotExist:
-                pass
-        return policy_list
+        for pk, matched_by in matches.items():
+            policy = dict(policies[pk]) # cached policies are shared, so annotate a copy
+            policy['matched_by'] = matched_by
+            policy_list.append(policy)
+        return policy_list + errors
+    
+    def process_bulk_profiles(self,profiles):
+        """
+        Processes a list of profiles from a bulk lookup, as a dictionary of policy lists keyed
+        by profile.
+        """
+        results = {}
+        for chunk in chunked(profiles,setting('BULK_LOOKUP_CHUNK_SIZE',500)):
+            resolved = resolve_profiles(chunk)
+            policies = get_policies(pk for pks in resolved.values() for pk in pks)
+            for profile, pks in resolved.items():
+                results[profile] = [policies[pk] for pk in pks]
+        return results
+    
+    def process_bulk_identities(self,identities):
+        """
+        Processes a list of {"service":...,"identity":...} entries from a bulk lookup.  Each 
+        entry is answered, in order, by a copy of itself with its policies, or with an error 
+        if it is malformed.
+        """
+        results = []
+        for chunk in chunked(identities,setting('BULK_LOOKUP_CHUNK_SIZE',500)):
+            pairs = []
+            for entry in chunk:
+                if isinstance(entry,dict) and isinstance(entry.get('identity'),(basestring,int,long)) and isinstance(entry.get('service'),basestring):
+                    pairs.append((unicode(entry['identity']),entry['service']))
+                else:
+                    pairs.append(None)
+            resolved = resolve_identity_pairs(pair for pair in pairs if pair and pair[0].strip() and pair[1].strip())
+            policies = get_policies(pk for pks in resolved.values() for pk in pks)
+            for entry, pair in zip(chunk,pairs):
+                if pair in resolved:
+                    results.append({'service':pair[1],'identity':pair[0],'policies':[policies[pk] for pk in resolved[pair]]})
+                else:
+                    results.append({'lookup':entry,'error':'Malformed identity, expected {"service":...,"identity":...}.'})
+        return results
+    
+    def process_bulk(self,request,api_key,lookups):
+        """
+        Bulk processing method, for a JSON body of the form:
+        
+        {"profiles":[<profile>,...],
+         "identities":[{"service":<service>,"identity":<identity>},...]}
+        
+        Answers with the same two keys: profiles maps each profile to its policies, and identities
+        answers each identity entry in order.  Profiles must be strings.  Lookups are resolved in chunks of the 
+        BULK_LOOKUP_CHUNK_SIZE setting, and at most BULK_LOOKUP_LIMIT entries are accepted.
+        """
+        source = authenticate(api_key)
+        if source is None:
+            return rc.NOT_FOUND
+        elif source.active:
+            # source is registered and active, proceed
+            profiles = lookups.get('profiles',[])
+            identities = lookups.get('identities',[])
+            if not isinstance(profiles,list) or not isinstance(identities,list):
+                return rc.BAD_REQUEST
+            if not all(isinstance(profile,basestring) for profile in profiles):
+                return rc.BAD_REQUEST
+            if len(profiles) + len(identities) > setting('BULK_LOOKUP_LIMIT',50000):
+                return rc.BAD_REQUEST
+            refused = admit(request,source,len(profiles) + len(identities))
+            if refused:
+                return refused
+            
+            results = {}
+            if 'profiles' in lookups:
+                results['profiles'] = self.process_bulk_profiles(profiles)
+            if 'identities' in lookups:
+                results['identities'] = self.process_bulk_identities(identities)
+            return results
+        else:
+            return rc.FORBIDDEN
     
     def process(self,request,api_key):
         """
@@ -66,40 +187,213 @@ class PolicyHandler(BaseHandler):
         identity  (syntax: <identity>@@<service>, for example: "LorenDavie@@Twitter")
         identity_list
         
+        Each matching policy is returned once, see process_lookups.  Lookups the policy view
+        resolved to check the ETag aren't resolved again.  A lookup costs the number of profiles
+        and identities it names, and is refused with 429 over the source's admission limits.
         """
-        try:
-            source = DataSource.objects.get(api_key=api_key)
-            if source.active:
-                # source is registered and active, proceed
-                policy_list = []
-                
-                if 'profile' in request.GET:
-                    policy_list += self.process_profile(request.GET['profile'])
-                
-                if 'profile_list' in request.GET:
-                    policy_list += self.process_profile_list(request.GET['profile_list'])
-                
-                if 'identity' in request.GET:
-                    policy_list += self.process_identity(request.GET['identity'])
-                
-                if 'identity_list' in request.GET:
-                    policy_list += self.process_identity_list(request.GET['identity_list'])
-                
-                return policy_list
-            else:
-                return rc.FORBIDDEN
-        except DataSource.DoesNotExist:
+        source = authenticate(api_key)
+        if source is None:
             return rc.NOT_FOUND
-        
+        elif source.active:
+            # source is registered and active, proceed
+            refused = admit(request,source,lookup_cost(request.GET))
+            if refused:
+                return refused
+            return self.process_lookups(request.GET,getattr(request,'policy_lookups',None),getattr(request,'policy_versions',None))
+        else:
+            return rc.FORBIDDEN
     
+    @instrument('PolicyHandler.read')
     def read(self,request,api_key):
         """
         GET Handler.
         """
         return self.process(request,api_key)
     
+    @instrument('PolicyHandler.create')
     def create(self,request,api_key):
         """
-        POST Handler
+        POST Handler.  A JSON body is a bulk lookup, otherwise the lookup variables in the query
+        string are processed as for GET.
         """
+        if request.META.get('CONTENT_TYPE','').startswith('application/json'):
+            try:
+                lookups = request_json(request)
+            except ValueError:
+                return rc.BAD_REQUEST
+            if not isinstance(lookups,dict):
+                return rc.BAD_REQUEST
+            return self.process_bulk(request,api_key,lookups)
         return self.process(request,api_key)
+
+class DecisionHandler(BaseHandler):
+    """
+    Handler for access decisions: may consumer X use data in scope Y about person Z?
+    """
+    allow_methods = ('GET','POST')
+    
+    def resolve_consumers(self,consumers):
+        """
+        Maps (name, domain) pairs to DataConsumer objects, or None for unknown consumers.
+        """
+        names = set(name for name, domain in consumers)
+        known = dict(((consumer.name,consumer.domain),consumer) for consumer in DataConsumer.objects.filter(name__in=names))
+        return dict((consumer,known.get(consumer)) for consumer in consumers)
+    
+    def decide(self,queries):
+        """
+        Decides a list of query dictionaries.  Each query names the person with either 'profile'
+        or 'identity' (syntax: <identity>@@<service>), the consumer with 'consumer' and 'domain',
+        and optionally a 'scope', by name or full path.  Without a scope the decision is for all data.
+        """
+        profiles = resolve_profiles(set(query['profile'] for query in queries if 'profile' in query))
+        identities = resolve_identities(set(query['identity'] for query in queries if 'identity' in query))
+        consumers = self.resolve_consumers(set((query.get('consumer'),query.get('domain')) for query in queries))
+        
+        triples = []
+        for query in queries:
+            if 'profile' in query:
+                canonical_identity_ids = profiles[query['profile']]
+            else:
+                canonical_identity_ids = identities.get(query.get('identity'),[])
+                if isinstance(canonical_identity_ids,MalformedLookup):
+                    canonical_identity_ids = []
+            scope = query.get('scope') or None
+            if scope:
+                scope = scope.split(' : ')[-1]
+            triples.append((canonical_identity_ids,consumers[(query.get('consumer'),query.get('domain'))],scope))
+        return decide_many(triples)
+    
+    def process(self,request,api_key,queries):
+        """
+        Main processing method.  Answers each query with true, false, or null if the person,
+        consumer or scope is unknown.  Queries must be objects with string values.
+        """
+        source = authenticate(api_key)
+        if source is None:
+            return rc.NOT_FOUND
+        elif source.active:
+            # source is registered and active, proceed
+            if not isinstance(queries,list) or len(queries) > setting('DECISION_BATCH_LIMIT',10000):
+                return rc.BAD_REQUEST
+            if not all(isinstance(query,dict) and all(isinstance(value,basestring) for value in query.values()) for query in queries):
+                return rc.BAD_REQUEST
+            return admit(request,source,len(queries)) or {'decisions':self.decide(queries)}
+        else:
+            return rc.FORBIDDEN
+    
+    @instrument('DecisionHandler.read')
+    def read(self,request,api_key):
+        """
+        GET Handler, for a single query given in the query string.
+        """
+        return self.process(request,api_key,[dict(request.GET.items())])
+    
+    @instrument('DecisionHandler.create')
+    def create(self,request,api_key):
+        """
+        POST Handler, for a JSON body of the form {"queries":[...]}.
+        """
+        try:
+            queries = request_json(request)['queries']
+        except (ValueError, KeyError, TypeError):
+            return rc.BAD_REQUEST
+        return self.process(request,api_key,queries)
+
+class AudienceHandler(BaseHandler):
+    """
+    Handler for audiences: how many people let consumer X use data in scope Y, and is person Z
+    one of them?
+    """
+    allow_methods = ('GET',)
+    
+    def audience(self,params):
+        """
+        Answers for the consumer named by 'consumer' and 'domain' and the optional 'scope', by
+        name or full path, with the audience count.  With a 'profile' or 'identity' (syntax:
+        <identity>@@<service>) it also answers whether that person is in the audience.  Unknown
+        consumers and scopes are answered with null.
+        """
+        scope = params.get('scope') or None
+        if scope:
+            scope = scope.split(' : ')[-1]
+        try:
+            consumer = DataConsumer.objects.get(name=params.get('consumer'),domain=params.get('domain'))
+        except DataConsumer.DoesNotExist:
+            consumer = None
+        
+        index = audience_index()
+        result = {'count':index.count(consumer,scope) if consumer else None}
+        if 'profile' in params or 'identity' in params:
+            if 'profile' in params:
+                canonical_identity_ids = resolve_profiles([params['profile']])[params['profile']]
+            else:
+                canonical_identity_ids = resolve_identities([params['identity']])[params['identity']]
+                if isinstance(canonical_identity_ids,MalformedLookup):
+                    canonical_identity_ids = []
+            answers = [index.permits(consumer,scope,pk) for pk in canonical_identity_ids] if consumer else []
+            # a contested identity is in the audience only if every claimant permits it
+            result['permits'] = None if not answers or None in answers else all(answers)
+        return result
+    
+    @instrument('AudienceHandler.read')
+    def read(self,request,api_key):
+        """
+        GET Handler.
+        """
+        source = authenticate(api_key)
+        if source is None:
+            return rc.NOT_FOUND
+        elif source.active:
+            # source is registered and active, proceed
+            return admit(request,source,1) or self.audience(request.GET)
+        else:
+            return rc.FORBIDDEN
+
+class ChangeHandler(BaseHandler):
+    """
+    Handler for the policy change feed: which policies changed since a data source last looked?
+    """
+    allow_methods = ('GET',)
+    
+    def changes(self,since,limit=None):
+        """
+        Answers with a page of changes after the cursor since, as {"changes":[...],"cursor":...,
+        "more":...}.  Each change is {"id":<canonical identity id>,"policy":{...}}, or
+        {"id":...,"deleted":true} for a deleted identity.  The cursor is passed back as since for
+        the next page, and more is true while there are more changes to read.
+        """
+        pks, cursor, more = read_changes(since,limit)
+        versions = dict(CanonicalIdentity.objects.filter(pk__in=pks).values_list('pk','policy_version'))
+        existing = set(versions)
+        policies = get_policies(existing,versions) # never older than the change, whichever worker cached it
+        changes = []
+        for pk in pks:
+            if pk in existing:
+                changes.append({'id':pk,'policy':policies[pk]})
+            else:
+                changes.append({'id':pk,'deleted':True})
+        return {'changes':changes,'cursor':cursor,'more':more}
+    
+    @instrument('ChangeHandler.read')
+    def read(self,request,api_key):
+        """
+        GET Handler, with the optional variables since (a cursor, 0 to read from the start of the
+        log) and limit (at most the CHANGE_FEED_PAGE_SIZE setting).
+        """
+        source = authenticate(api_key)
+        if source is None:
+            return rc.NOT_FOUND
+        elif source.active:
+            # source is registered and active, proceed
+            page_size = setting('CHANGE_FEED_PAGE_SIZE',500)
+            try:
+                since = int(request.GET.get('since',0))
+                limit = min(int(request.GET.get('limit',page_size)),page_size)
+            except ValueError:
+                return rc.BAD_REQUEST
+            if since < 0 or limit < 1:
+                return rc.BAD_REQUEST
+            return admit(request,source,limit) or self.changes(since,limit)
+        else:
+            return rc.FORBIDDEN
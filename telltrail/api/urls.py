@@ -1,10 +1,17 @@
 from piston.resource import Resource
+from telltrail.api import emitters # registers the fast JSON emitter in place of piston's
 from telltrail.api.handlers import *
+from telltrail.api.views import policy
 from django.conf.urls import *
-from django.conf.urls.defaults import *
+from telltrail.db.routers import read_only
 
-policy_handler = Resource(PolicyHandler)
+decision_handler = read_only(Resource(DecisionHandler))
+audience_handler = read_only(Resource(AudienceHandler))
+change_handler = read_only(Resource(ChangeHandler))
 
 urlpatterns = patterns('',
-    url(r'^(?P<api_key>[a-f0-9]+)/policy/$',policy_handler),
+    url(r'^(?P<api_key>[a-f0-9]+)/policy/$',policy),
+    url(r'^(?P<api_key>[a-f0-9]+)/decisions/$',decision_handler),
+    url(r'^(?P<api_key>[a-f0-9]+)/audiences/$',audience_handler),
+    url(r'^(?P<api_key>[a-f0-9]+)/changes/$',change_handler),
 )
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""
+Plain Django views for the TellTrail API, for responses piston can't produce.
+"""
+from django.http import StreamingHttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.csrf import csrf_exempt
+from piston.resource import Resource
+from piston.utils import rc
+from telltrail.models import CanonicalIdentity
+from telltrail.api.handlers import PolicyHandler
+from telltrail.api.authentication import authenticate
+from telltrail.api.admission import admit, lookup_cost
+from telltrail.db.routers import read_only
+from telltrail.utils import setting, chunked
+from collections import OrderedDict
+import hashlib
+import json
+
+policy_handler = Resource(PolicyHandler)
+
+def policy_chunks(handler,params,chunk_size):
+    """
+    Generates lists of rendered policies for the four lookup variables.  The lookups are
+    resolved together first, so each matching canonical identity is streamed once with the
+    inputs that matched it, as process_lookups renders it, then rendered one chunk at a time.
+    Error entries for malformed identity strings come last.
+    """
+    matches, errors = handler.resolve_lookups(params)
+    for pks in chunked(matches.keys(),chunk_size):
+        yield handler.process_lookups(params,(OrderedDict((pk,matches[pk]) for pk in pks),[]))
+    yield errors
+
+def ndjson(chunks):
+    """
+    Writes each chunk of policies as newline delimited JSON, one policy per line.
+    """
+    for policies in chunks:
+        if policies:
+            yield ''.join(json.dumps(policy) + '\n' for policy in policies)
+
+def policy_etag(query_string,matches,versions):
+    """
+    The ETag of a policy lookup, from the query (which decides the inputs, their order and the
+    format) and the policy version of each matching canonical identity.
+    """
+    digest = hashlib.md5(query_string)
+    for pk in matches:
+        digest.update('%d:%s,' % (pk,versions.get(pk)))
+    return quote_etag(digest.hexdigest())
+
+def conditional_policy(request,api_key):
+    """
+    Answers a GET lookup with 304 Not Modified when If-None-Match has the ETag of the current
+    policy versions.  Checking costs the lookup and one query for the versions, by pk, and
+    nothing is rendered.  Otherwise the lookup and versions are left on the request for
+    PolicyHandler, and the response gets the ETag.
+    """
+    handler = PolicyHandler()
+    lookups = handler.resolve_lookups(request.GET)
+    versions = dict(CanonicalIdentity.objects.filter(pk__in=lookups[0].keys()).values_list('pk','policy_version'))
+    etag = policy_etag(request.META.get('QUERY_STRING',''),lookups[0],versions)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (if_none_match.strip() == '*' or etag in [quote_etag(tag) for tag in parse_etags(if_none_match)]):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    
+    request.policy_lookups = lookups
+    request.policy_versions = versions
+    response = policy_handler(request,api_key=api_key)
+    if response.status_code == 200:
+        response['ETag'] = etag
+    return response
+
+@read_only
+@csrf_exempt
+def policy(request,api_key):
+    """
+    The policy endpoint.  With format=ndjson the policies are streamed as newline delimited
+    JSON while they are rendered, keeping memory bounded however large the lookup is.  Any
+    other request is handled by PolicyHandler as usual, with GETs from active sources made
+    conditional on the policy versions, once admitted.  Lookups are read only, so even POSTs
+    may be served from a replica.
+    """
+    source = authenticate(api_key)
+    if request.GET.get('format') != 'ndjson':
+        if request.method == 'GET' and source is not None and source.active:
+            return admit(request,source,lookup_cost(request.GET)) or conditional_policy(request,api_key)
+        return policy_handler(request,api_key=api_key)
+    
+    if source is None:
+        return rc.NOT_FOUND
+    elif not source.active:
+        return rc.FORBIDDEN
+    refused = admit(request,source,lookup_cost(request.GET))
+    if refused:
+        return refused
+    
+    chunks = policy_chunks(PolicyHandler(),request.GET,setting('STREAM_CHUNK_SIZE',500))
+    return StreamingHttpResponse(ndjson(chunks),content_type='application/x-ndjson')
@@ -0,0 +1,14 @@
+"""
+Application configuration for TellTrail.
+"""
+from django.apps import AppConfig
+
+class TellTrailConfig(AppConfig):
+    """
+    Configuration for the telltrail app.
+    """
+    name = 'telltrail'
+    verbose_name = 'TellTrail'
+    
+    def ready(self):
+        import telltrail.signals
@@ -0,0 +1,267 @@
+"""
+Audience index for TellTrail: which canonical identities permit a data consumer to use data in
+a given scope.
+
+Each canonical identity gets a dense ordinal, and the index keeps bitsets (Python ints, bit n
+for ordinal n) of the identities contributing to each part of the decision rules in
+telltrail.decisions:
+
+('all', minimum_grade)            identities with a single granting element for all data
+('scope', scope, minimum_grade)   identities with scoped elements, whose effective element
+                                  for the scope grants at the minimum grade
+('allow', consumer pk, scope)     identities whose effective exception for the consumer and
+('deny', consumer pk, scope)      scope grants or denies outright
+
+The audience of a consumer in a scope is then the grant bitsets its letter grade satisfies, less
+the deny bitset, plus the allow bitset.  Audiences are cached until the index changes.
+
+Every process keeps its own index, which catches up with the policy change log (see
+telltrail.changes) every AUDIENCE_CHECK_INTERVAL seconds, so changes made by other processes
+are applied too.  The index is built when the WSGI application is loaded, so under gunicorn
+--preload the master builds it once and the workers inherit it, and requests only rebuild it
+when the scope hierarchy changes or the change log no longer reaches back to it.
+"""
+from django.db import connections, DatabaseError
+from django.utils import timezone
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Lock
+import binascii
+import time
+from telltrail.decisions import DEFAULT_ELEMENT, DecisionTable, grade_permits, load_policies, scope_ancestry
+from telltrail.scopes import scope_index
+from telltrail.utils import setting, chunked
+
+def bitset(ordinals):
+    """
+    Builds a bitset from a list of ordinals in one go, rather than setting bits one at a time.
+    """
+    if not ordinals:
+        return 0
+    data = bytearray(max(ordinals) // 8 + 1)
+    for ordinal in ordinals:
+        data[ordinal >> 3] |= 1 << (ordinal & 7)
+    data.reverse()
+    return int(binascii.hexlify(data),16)
+
+def contributions(elements,exceptions,ancestry):
+    """
+    The bitsets an identity belongs to, given its scoped elements and exceptions as loaded by
+    telltrail.decisions.load_policies.
+    """
+    keys = set()
+    if not exceptions and not [scope for scope in elements if scope is not None]:
+        # the common case, a single policy for all data
+        grant, minimum_grade = elements.get(None,DEFAULT_ELEMENT)
+        if grant:
+            keys.add(('all',minimum_grade))
+        return keys
+    
+    table = DecisionTable.compile(elements,exceptions,ancestry)
+    for scope, (grant, minimum_grade) in table.elements.items():
+        if grant:
+            keys.add(('scope',scope,minimum_grade))
+    for (consumer, scope), grant in table.exceptions.items():
+        keys.add(('allow' if grant else 'deny',consumer,scope))
+    return keys
+
+class AudienceIndex(object):
+    """
+    The audience bitsets for every canonical identity, for the scope hierarchy it was built with.
+    """
+    def __init__(self,parents,ancestry):
+        self.parents = parents
+        self.ancestry = ancestry
+        self.ordinals = {}
+        self.keys = [] # the bitsets each ordinal belongs to
+        self.bitsets = {}
+        self.grades = set()
+        self.interned = {}
+        self.audiences = OrderedDict()
+        self.counts = {}
+        self.lock = Lock()
+        self.checked = time.time()
+        self.caught_up = timezone.now()
+    
+    @classmethod
+    def build(cls):
+        """
+        Builds the index for every canonical identity, loading policies in chunks of the
+        AUDIENCE_INDEX_CHUNK_SIZE setting.
+        """
+        from telltrail.models import CanonicalIdentity
+        index = cls(dict(scope_index().parents),scope_ancestry())
+        members = {}
+        pks = list(CanonicalIdentity.objects.order_by('pk').values_list('pk',flat=True))
+        for chunk in chunked(pks,setting('AUDIENCE_INDEX_CHUNK_SIZE',5000)):
+            elements, exceptions = load_policies(chunk)
+            for pk in chunk:
+                ordinal = index.add(pk,index.intern(contributions(elements[pk],exceptions[pk],index.ancestry)))
+                for key in index.keys[ordinal]:
+                    members.setdefault(key,[]).append(ordinal)
+        index.bitsets = dict((key,bitset(ordinals)) for key, ordinals in members.items())
+        return index
+    
+    def intern(self,keys):
+        """
+        Shares one frozenset between identities with the same contributions, which is most of them.
+        """
+        keys = frozenset(keys)
+        for key in keys:
+            if key[0] in ('all','scope'):
+                self.grades.add(key[-1])
+        return self.interned.setdefault(keys,keys)
+    
+    def add(self,pk,keys):
+        """
+        Gives the canonical identity the next ordinal.
+        """
+        ordinal = len(self.keys)
+        self.ordinals[pk] = ordinal
+        self.keys.append(keys)
+        return ordinal
+    
+    def update(self,canonical_identity_ids):
+        """
+        Brings the canonical identities up to date, toggling only the bits that changed.
+        Deleted identities keep their ordinals, with every bit cleared.
+        """
+        from telltrail.models import CanonicalIdentity
+        pks = set(canonical_identity_ids)
+        existing = set(CanonicalIdentity.objects.filter(pk__in=pks).values_list('pk',flat=True))
+        elements, exceptions = load_policies(existing)
+        with self.lock:
+            for pk in pks:
+                keys = self.intern(contributions(elements[pk],exceptions[pk],self.ancestry) if pk in existing else ())
+                ordinal = self.ordinals.get(pk)
+                if ordinal is None:
+                    if pk not in existing:
+                        continue
+                    ordinal = self.add(pk,frozenset())
+                bit = 1 << ordinal
+                for key in self.keys[ordinal] - keys:
+                    self.bitsets[key] &= ~bit
+                for key in keys - self.keys[ordinal]:
+                    self.bitsets[key] = self.bitsets.get(key,0) | bit
+                self.keys[ordinal] = keys
+            self.audiences.clear()
+            self.counts.clear()
+    
+    def catch_up(self):
+        """
+        Updates the identities whose policies were logged as changed since the index was built
+        or last caught up, by this process or any other, in chunks of the
+        AUDIENCE_INDEX_CHUNK_SIZE setting.  Entries are read from the CHANGE_FEED_DELAY setting
+        before then, as a transaction committing late may have logged its change earlier.
+        Returns False, changing nothing, if the index is older than the change log is kept
+        (the POLICY_CHANGE_RETENTION_DAYS setting), so it must be rebuilt instead.
+        """
+        from telltrail.models import PolicyChange
+        now = timezone.now()
+        if now - self.caught_up > timedelta(days=setting('POLICY_CHANGE_RETENTION_DAYS',30)):
+            return False
+        since = self.caught_up - timedelta(seconds=setting('CHANGE_FEED_DELAY',5))
+        pks = list(set(PolicyChange.objects.filter(changed__gte=since).values_list('canonical_identity_id',flat=True)))
+        for chunk in chunked(pks,setting('AUDIENCE_INDEX_CHUNK_SIZE',5000)):
+            self.update(chunk)
+        self.caught_up = now
+        return True
+    
+    def audience(self,consumer,scope=None):
+        """
+        The bitset of canonical identities permitting the DataConsumer to use data in the named
+        scope, or in all data if no scope is given.  Returns None if the scope is unknown.
+        """
+        if scope not in self.ancestry:
+            return None
+        key = (consumer.pk,consumer.letter_grade,scope)
+        with self.lock:
+            bits = self.audiences.pop(key,None)
+            if bits is None:
+                bits = 0
+                for minimum_grade in self.grades:
+                    if grade_permits(consumer.letter_grade,minimum_grade):
+                        bits |= self.bitsets.get(('all',minimum_grade),0) | self.bitsets.get(('scope',scope,minimum_grade),0)
+                bits = (bits & ~self.bitsets.get(('deny',consumer.pk,scope),0)) | self.bitsets.get(('allow',consumer.pk,scope),0)
+            self.audiences[key] = bits # re-insert as most recently used
+            while len(self.audiences) > setting('AUDIENCE_CACHE_SIZE',1000):
+                self.counts.pop(self.audiences.popitem(last=False)[0],None)
+        return bits
+    
+    def count(self,consumer,scope=None):
+        """
+        The number of canonical identities permitting the DataConsumer to use data in the scope.
+        """
+        bits = self.audience(consumer,scope)
+        if bits is None:
+            return None
+        key = (consumer.pk,consumer.letter_grade,scope)
+        count = self.counts.get(key)
+        if count is None:
+            count = self.counts[key] = bin(bits).count('1')
+        return count
+    
+    def permits(self,consumer,scope,canonical_identity_id):
+        """
+        Whether the canonical identity permits the DataConsumer to use data in the scope.
+        Returns None if the scope or identity is unknown to the index.
+        """
+        bits = self.audience(consumer,scope)
+        ordinal = self.ordinals.get(canonical_identity_id)
+        if bits is None or ordinal is None:
+            return None
+        return bool((bits >> ordinal) & 1)
+
+_audience_index = None
+_lock = Lock()
+
+def audience_index():
+    """
+    Gets the process-wide audience index, building it if preload_audience_index didn't.  Policy
+    changes update the index of the process that made them at once, and those of other
+    processes within the AUDIENCE_CHECK_INTERVAL setting.  The index is only rebuilt when the
+    scope hierarchy changes, or when it can no longer catch up with the change log.
+    """
+    global _audience_index
+    index = _audience_index
+    stale = index is None or index.parents != scope_index().parents
+    if not stale and time.time() - index.checked > setting('AUDIENCE_CHECK_INTERVAL',2):
+        index.checked = time.time()
+        stale = not index.catch_up()
+    if stale:
+        with _lock:
+            if _audience_index is index:
+                _audience_index = AudienceIndex.build()
+            index = _audience_index
+    return index
+
+def update_audiences(canonical_identity_ids):
+    """
+    Updates the audience index for the canonical identities, if it has been built.
+    """
+    index = _audience_index
+    if index is not None:
+        pks = list(canonical_identity_ids)
+        if pks:
+            index.update(pks)
+
+def reset_audience_index():
+    """
+    Drops the audience index, so the next use rebuilds it.
+    """
+    global _audience_index
+    _audience_index = None
+
+def preload_audience_index():
+    """
+    Builds the audience index outside any request, if the AUDIENCE_PRELOAD setting is on, then
+    closes the database connections used, which the workers mustn't share.
+    """
+    global _audience_index
+    if setting('AUDIENCE_PRELOAD',False):
+        try:
+            _audience_index = AudienceIndex.build()
+        except DatabaseError:
+            pass # the workers build it on first use instead
+        for connection in connections.all():
+            connection.close()
@@ -0,0 +1,218 @@
+"""
+Caching of rendered policies for TellTrail.
+"""
+from collections import OrderedDict
+from threading import Lock
+import time
+from telltrail.utils import setting, gf
+from telltrail.metrics import count_policies
+
+class PolicyCache(object):
+    """
+    Base class for rendered policy caches, keeping their hit and miss counts.  Policies are
+    keyed by CanonicalIdentity pk, and get_policies caches them as (policy version, policy)
+    pairs.  Subclasses provide:
+    
+    get_many(pks)        the cached pairs for the pks, as a dictionary keyed by pk, leaving
+                         out pks that aren't cached
+    set_many(policies)   caches the pairs in the dictionary, which is keyed by pk
+    delete_many(pks)     removes the pairs for the pks
+    clear()              removes every pair
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+    
+    def count(self,hits,misses):
+        """
+        Counts hits and misses, as get_policies finds them once versions are checked.
+        """
+        self.hits += hits
+        self.misses += misses
+    
+    def stats(self):
+        """
+        Hit and miss counters for the cache.
+        """
+        return {'hits':self.hits,'misses':self.misses}
+
+class LRUPolicyCache(PolicyCache):
+    """
+    In-process LRU cache, bounded by the POLICY_CACHE_SIZE setting.  Each worker has its own
+    cache, and invalidation only reaches the worker that made the change, so get_policies checks
+    hits against the current policy versions.  Entries also expire after POLICY_CACHE_TIMEOUT
+    seconds.
+    """
+    def __init__(self):
+        super(LRUPolicyCache,self).__init__()
+        self.size = setting('POLICY_CACHE_SIZE',10000)
+        self.timeout = setting('POLICY_CACHE_TIMEOUT',30)
+        self.entries = OrderedDict()
+        self.lock = Lock()
+    
+    def get_many(self,pks):
+        found = {}
+        now = time.time()
+        with self.lock:
+            for pk in pks:
+                entry = self.entries.pop(pk,None)
+                if entry and entry[0] > now:
+                    self.entries[pk] = entry # re-insert as most recently used
+                    found[pk] = entry[1]
+        return found
+    
+    def set_many(self,policies):
+        expires = time.time() + self.timeout
+        with self.lock:
+            for pk, policy in policies.items():
+                self.entries.pop(pk,None)
+                self.entries[pk] = (expires,policy)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+    
+    def delete_many(self,pks):
+        with self.lock:
+            for pk in pks:
+                self.entries.pop(pk,None)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class SharedPolicyCache(PolicyCache):
+    """
+    Cache backed by the Django cache named in the POLICY_CACHE_ALIAS setting, typically a local
+    memcached shared by all the gunicorn workers.  Clearing bumps a generation number that is
+    part of every key, rather than flushing the whole Django cache.
+    """
+    generation_key = 'telltrail:policy:generation'
+    
+    def __init__(self):
+        super(SharedPolicyCache,self).__init__()
+        from django.core.cache import caches
+        self.cache = caches[setting('POLICY_CACHE_ALIAS','default')]
+        self.timeout = setting('POLICY_CACHE_TIMEOUT',30)
+    
+    def generation(self):
+        """
+        Gets the current key generation.
+        """
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            generation = 1
+            self.cache.add(self.generation_key,generation,None)
+        return generation
+    
+    def keys(self,pks):
+        """
+        Maps cache keys to pks.
+        """
+        generation = self.generation()
+        return dict(('telltrail:versioned-policy:%d:%d' % (generation,pk),pk) for pk in pks)
+    
+    def get_many(self,pks):
+        keys = self.keys(pks)
+        return dict((keys[key],policy) for key, policy in self.cache.get_many(keys.keys()).items())
+    
+    def set_many(self,policies):
+        keys = self.keys(policies.keys())
+        self.cache.set_many(dict((key,policies[pk]) for key, pk in keys.items()),self.timeout)
+    
+    def delete_many(self,pks):
+        self.cache.delete_many(self.keys(pks).keys())
+    
+    def clear(self):
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            self.cache.set(self.generation_key,self.generation() + 1,None)
+
+def get_generation(name):
+    """
+    Gets the named generation number from the default Django cache.  Processes compare it with the
+    generation they last saw to learn that something they cache locally has changed elsewhere.
+    The generation is only shared between workers if the default cache is, as with memcached.
+    """
+    from django.core.cache import cache
+    generation = cache.get('telltrail:generation:%s' % name)
+    if generation is None:
+        generation = 1
+        cache.add('telltrail:generation:%s' % name,generation,None)
+    return generation
+
+def generations_shared():
+    """
+    Whether generations are shared between processes, which they aren't when the default cache
+    is local memory, or a dummy cache.
+    """
+    from django.core.cache import caches
+    from django.core.cache.backends.locmem import LocMemCache
+    from django.core.cache.backends.dummy import DummyCache
+    return not isinstance(caches['default'],(LocMemCache,DummyCache))
+
+def bump_generation(name):
+    """
+    Moves the named generation on.
+    """
+    from django.core.cache import cache
+    try:
+        cache.incr('telltrail:generation:%s' % name)
+    except ValueError:
+        cache.set('telltrail:generation:%s' % name,get_generation(name) + 1,None)
+
+_policy_cache = None
+
+def policy_cache():
+    """
+    Gets the policy cache configured by the POLICY_CACHE_BACKEND setting.
+    """
+    global _policy_cache
+    if _policy_cache is None:
+        _policy_cache = gf(setting('POLICY_CACHE_BACKEND','telltrail.cache.LRUPolicyCache'))()
+    return _policy_cache
+
+def get_policies(pks,versions=None):
+    """
+    Gets rendered policies for the CanonicalIdentity pks as a dictionary keyed by pk, from the
+    cache where possible.  Misses come from the policy snapshot if they are unchanged in it,
+    and the rest are rendered together, then all are cached.
+    
+    Cached and snapshot policies of other than the current policy versions count as misses,
+    so a policy changed in another worker, whose invalidation only reached that worker's cache,
+    isn't served stale.  The versions, keyed by pk, are read with one query by pk unless given.
+    """
+    from telltrail.models import CanonicalIdentity
+    pks = set(pks)
+    if versions is None:
+        versions = dict(CanonicalIdentity.objects.filter(pk__in=pks).values_list('pk','policy_version'))
+    cache = policy_cache()
+    policies = {}
+    for pk, (version, policy) in cache.get_many(pks).items():
+        if version == versions.get(pk):
+            policies[pk] = policy
+    missing = pks.difference(policies)
+    cache.count(len(policies),len(missing))
+    if missing:
+        from telltrail.snapshot import snapshot_policies
+        rendered = snapshot_policies(missing,versions)
+        missing.difference_update(rendered)
+        if missing:
+            rendered.update(CanonicalIdentity.objects.render_versioned_policies(missing))
+        cache.set_many(rendered)
+        policies.update((pk,policy) for pk, (version, policy) in rendered.items())
+    count_policies(len(policies))
+    return policies
+
+def invalidate_policies(pks):
+    """
+    Removes the cached policies for the CanonicalIdentity pks.
+    """
+    pks = list(pks)
+    if pks:
+        policy_cache().delete_many(pks)
+
+def invalidate_all_policies():
+    """
+    Removes every cached policy.
+    """
+    policy_cache().clear()
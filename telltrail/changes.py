@@ -0,0 +1,66 @@
+"""
+The policy change log for TellTrail.
+
+Every change to a canonical identity's policy appends an entry to the log, and data sources
+keep up by reading the entries after the last cursor they saw, rather than looking up every
+identity again.  Cursors are PolicyChange pks.
+"""
+from django.db import connection
+from django.utils import timezone
+from datetime import timedelta
+from telltrail.utils import setting
+
+def log_changes(canonical_identity_ids,changed=None):
+    """
+    Logs changes to the policies of the canonical identities.
+    """
+    from telltrail.models import PolicyChange
+    changed = changed or timezone.now()
+    PolicyChange.objects.bulk_create([PolicyChange(canonical_identity_id=pk,changed=changed) for pk in canonical_identity_ids])
+
+def read_changes(since=0,limit=None):
+    """
+    Reads a page of at most limit (or the CHANGE_FEED_PAGE_SIZE setting) changes after the
+    cursor since.  Returns the changed canonical identity pks, once each in the order of their
+    first change, the cursor to read the next page from, and whether there are more changes.
+    
+    Entries younger than the CHANGE_FEED_DELAY setting are left for a later page, as a
+    transaction still in progress may yet commit an earlier one.
+    """
+    from telltrail.models import PolicyChange
+    limit = limit or setting('CHANGE_FEED_PAGE_SIZE',500)
+    settled = timezone.now() - timedelta(seconds=setting('CHANGE_FEED_DELAY',5))
+    entries = list(PolicyChange.objects.filter(pk__gt=since).order_by('pk').values_list('pk','canonical_identity_id','changed')[:limit + 1])
+    more = len(entries) > limit
+    pks = []
+    seen = set()
+    cursor = since
+    for pk, canonical_identity_id, changed in entries[:limit]:
+        if changed >= settled:
+            more = True
+            break
+        if canonical_identity_id not in seen:
+            seen.add(canonical_identity_id)
+            pks.append(canonical_identity_id)
+        cursor = pk
+    return pks, cursor, more
+
+def compact_changes(days=None):
+    """
+    Compacts the log, deleting entries superseded by a later change to the same canonical
+    identity, and entries older than days (or the POLICY_CHANGE_RETENTION_DAYS setting).
+    Returns the numbers of superseded and expired entries deleted.
+    
+    Readers miss nothing when superseded entries go, but a source whose cursor is older than
+    the retention period may miss expired changes, and must look its identities up again.
+    """
+    from telltrail.models import PolicyChange
+    days = days if days is not None else setting('POLICY_CHANGE_RETENTION_DAYS',30)
+    table = connection.ops.quote_name(PolicyChange._meta.db_table)
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE id < (SELECT MAX(later.id) FROM %s later WHERE later.canonical_identity_id = %s.canonical_identity_id)' % (table,table,table))
+    superseded = cursor.rowcount
+    old = PolicyChange.objects.filter(changed__lt=timezone.now() - timedelta(days=days))
+    expired = old.count()
+    old.delete()
+    return superseded, expired
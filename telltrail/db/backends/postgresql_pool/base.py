@@ -0,0 +1,53 @@
+"""
+PostgreSQL backend that takes connections from a bounded per-process pool.
+
+Django opens a connection when a request first needs one and closes it when the request
+finishes.  This backend hands out pooled connections instead and takes them back on close, so
+requests stop paying for a fresh connection, and a gevent worker never holds more than
+DB_POOL_SIZE connections however many greenlets are serving requests.  Under gevent, psycopg2
+is made cooperative before the first connection in each worker.
+"""
+from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper as PostgresDatabaseWrapper, Database
+from psycopg2 import extensions
+from telltrail.db.pool import get_pool
+from telltrail.db.green import ensure_green
+
+def check_connection(connection):
+    """
+    Health check for an idle pooled connection.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    finally:
+        cursor.close()
+
+class DatabaseWrapper(PostgresDatabaseWrapper):
+    """
+    The postgresql_psycopg2 wrapper, with pooled connections.
+    """
+    def pool(self,conn_params=None):
+        """
+        The connection pool for this database.
+        """
+        if conn_params is None:
+            conn_params = self.get_connection_params()
+        return get_pool(self.alias,lambda: Database.connect(**conn_params),check_connection)
+    
+    def get_new_connection(self,conn_params):
+        ensure_green() # before connecting, which waits on the socket too
+        return self.pool(conn_params).get()
+    
+    def _close(self):
+        if self.connection is None:
+            return
+        connection = self.connection
+        usable = not connection.closed
+        if usable and connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except Database.Error:
+                usable = False
+        if usable and self.errors_occurred:
+            usable = self.is_usable()
+        self.pool().put(connection,usable)
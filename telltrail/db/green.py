@@ -0,0 +1,54 @@
+"""
+Cooperative psycopg2 for the gevent worker model.
+"""
+
+def gevent_wait_callback(conn,timeout=None):
+    """
+    Waits for the connection's socket through the gevent hub, so a greenlet waiting on the 
+    database yields to the others instead of blocking the worker.
+    """
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(),timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(),timeout=timeout)
+        else:
+            raise OperationalError('Bad result from poll: %r' % state)
+
+def make_psycopg_green():
+    """
+    Makes psycopg2 cooperative with gevent.  Call once per process, after gevent has patched
+    the standard library, or use ensure_green.
+    """
+    import psycopg2
+    from psycopg2 import extensions
+    if not hasattr(extensions,'set_wait_callback'):
+        raise ImportError('psycopg2 %s has no support for coroutines.' % psycopg2.__version__)
+    extensions.set_wait_callback(gevent_wait_callback)
+
+def gevent_patched():
+    """
+    Whether gevent has patched the standard library in this process, as the gunicorn gevent
+    worker does.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return 'socket' in monkey.saved
+
+def ensure_green():
+    """
+    Makes psycopg2 cooperative if gevent has patched this process and it isn't already, as
+    when a gunicorn worker forks from a --preload master and gevent patches it afterwards.
+    Cheap enough to call before every new connection.
+    """
+    if gevent_patched():
+        from psycopg2 import extensions
+        if extensions.get_wait_callback() is None:
+            make_psycopg_green()
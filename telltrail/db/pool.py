@@ -0,0 +1,178 @@
+"""
+Bounded database connection pool.
+"""
+import os
+import threading
+import time
+from telltrail.utils import setting
+
+class PoolTimeout(Exception):
+    """
+    No connection became free within the pool timeout.
+    """
+    pass
+
+class ConnectionPool(object):
+    """
+    A bounded pool of DB-API connections, made with the connect function.  Checkouts wait up to
+    timeout seconds for a free connection once size connections are open.  A connection idle for
+    longer than check_interval seconds is health checked with check before it is handed out, and
+    connections older than max_age seconds are closed rather than reused.  Pools are made in the
+    process that uses them, once gevent has patched threading, so waits yield to other greenlets.
+    """
+    def __init__(self,connect,check,size=5,timeout=10,check_interval=30,max_age=600):
+        self.connect = connect
+        self.check = check
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.idle = [] # (connection, created, returned)
+        self.created = {} # id(connection) -> created
+        self.connecting = 0
+        self.condition = threading.Condition(threading.Lock())
+        self.metrics = {'checkouts':0,'waits':0,'wait_time':0.0,'max_wait_time':0.0,
+                        'timeouts':0,'connects':0,'discards':0,'failed_checks':0}
+    
+    def get(self):
+        """
+        Checks a connection out of the pool, opening a new one if none is idle and the pool has
+        room.  Raises PoolTimeout if none becomes free in time.
+        """
+        start = time.time()
+        waited = False
+        while True:
+            with self.condition:
+                while not self.idle and len(self.created) + self.connecting >= self.size:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        self.metrics['timeouts'] += 1
+                        raise PoolTimeout('No database connection free after %s seconds.' % self.timeout)
+                    waited = True
+                    self.condition.wait(remaining)
+                if not self.idle:
+                    self.connecting += 1 # hold a slot while connecting outside the lock
+                    break
+                connection, created, returned = self.idle.pop()
+            
+            # checked outside the lock, so a slow check doesn't hold up other checkouts
+            if self.usable(connection,created,returned):
+                with self.condition:
+                    self.checked_out(start,waited)
+                return connection
+            self.discard(connection)
+        
+        try:
+            connection = self.connect()
+        except Exception:
+            with self.condition:
+                self.connecting -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.connecting -= 1
+            self.created[id(connection)] = time.time()
+            self.metrics['connects'] += 1
+            self.checked_out(start,waited)
+        return connection
+    
+    def put(self,connection,usable=True):
+        """
+        Returns a connection to the pool, or closes it if it is unusable or too old.
+        """
+        with self.condition:
+            created = self.created.get(id(connection))
+            if usable and created is not None and time.time() - created < self.max_age:
+                self.idle.append((connection,created,time.time()))
+                self.condition.notify()
+                return
+        self.discard(connection)
+    
+    def usable(self,connection,created,returned):
+        """
+        Whether an idle connection may be handed out, health checking it if it has been idle a while.
+        Call without the condition held.
+        """
+        now = time.time()
+        if now - created >= self.max_age:
+            return False
+        if now - returned >= self.check_interval:
+            try:
+                self.check(connection)
+            except Exception:
+                with self.condition:
+                    self.metrics['failed_checks'] += 1
+                return False
+        return True
+    
+    def discard(self,connection):
+        """
+        Closes a connection and frees its slot.  Call without the condition held, as closing
+        may block.
+        """
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self.condition:
+            self.created.pop(id(connection),None)
+            self.metrics['discards'] += 1
+            self.condition.notify()
+    
+    def checked_out(self,start,waited):
+        """
+        Records a checkout.  Call with the condition held.
+        """
+        wait_time = time.time() - start
+        self.metrics['checkouts'] += 1
+        if waited:
+            self.metrics['waits'] += 1
+        self.metrics['wait_time'] += wait_time
+        self.metrics['max_wait_time'] = max(self.metrics['max_wait_time'],wait_time)
+    
+    def stats(self):
+        """
+        Pool size, usage and checkout metrics.
+        """
+        with self.condition:
+            stats = dict(self.metrics)
+            stats['size'] = self.size
+            stats['open'] = len(self.created) + self.connecting
+            stats['idle'] = len(self.idle)
+            stats['in_use'] = stats['open'] - len(self.idle)
+        return stats
+
+_processes = {} # pid -> (lock, pools by alias)
+
+def process_pools():
+    """
+    The lock and pools of this process.  They are made on first use in each process, so a
+    gunicorn worker never shares the master's connections, and gets primitives gevent has
+    patched even when the master loaded this module before forking it.
+    """
+    pid = os.getpid()
+    state = _processes.get(pid)
+    if state is None:
+        state = _processes.setdefault(pid,(threading.Lock(),{}))
+    return state
+
+def get_pool(alias,connect,check):
+    """
+    Gets the pool for the database alias, creating it from the DB_POOL_* settings on first use.
+    """
+    lock, pools = process_pools()
+    with lock:
+        if alias not in pools:
+            pools[alias] = ConnectionPool(connect,check,
+                                           size=setting('DB_POOL_SIZE',5),
+                                           timeout=setting('DB_POOL_TIMEOUT',10),
+                                           check_interval=setting('DB_POOL_CHECK_INTERVAL',30),
+                                           max_age=setting('DB_POOL_MAX_AGE',600))
+        return pools[alias]
+
+def pool_stats():
+    """
+    Stats for every pool in this process, keyed by database alias.
+    """
+    lock, pools = process_pools()
+    return dict((alias,pool.stats()) for alias, pool in pools.items())
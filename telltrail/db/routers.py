@@ -0,0 +1,69 @@
+"""
+Database routing for TellTrail.
+
+Reads go to the primary database unless the current request has turned replica reads on (see
+telltrail.middleware.ReplicaMiddleware), in which case they go to one of the DATABASE_REPLICAS
+chosen for the request.  Once a request writes anything, its later reads go to the primary so
+it sees its own writes.  Writes and migrations always go to the primary.
+"""
+import os
+import random
+import threading
+from telltrail.utils import setting
+
+_states = {} # pid -> request state
+
+def request_state():
+    """
+    The routing state of the current request, local to its thread, or its greenlet under gevent.
+    It is made on first use in each process, so a gunicorn worker gets a local gevent has
+    patched even when the master loaded this module before forking it.
+    """
+    pid = os.getpid()
+    state = _states.get(pid)
+    if state is None:
+        state = _states.setdefault(pid,threading.local())
+    return state
+
+def use_replicas(enabled):
+    """
+    Turns replica reads on or off for the current request.
+    """
+    replicas = setting('DATABASE_REPLICAS',[])
+    state = request_state()
+    state.replica = random.choice(replicas) if enabled and replicas else None
+    state.wrote = False
+
+def wrote():
+    """
+    Whether the current request has written to the primary.
+    """
+    return getattr(request_state(),'wrote',False)
+
+def read_only(view):
+    """
+    Marks a view (or a piston Resource) as safe to serve from a replica whatever the request
+    method, as for lookups made with POST.
+    """
+    view.read_only = True
+    return view
+
+class ReplicaRouter(object):
+    """
+    Routes reads to the request's replica, if it has one.
+    """
+    def db_for_read(self,model,**hints):
+        replica = getattr(request_state(),'replica',None)
+        if replica and not wrote():
+            return replica
+        return 'default'
+    
+    def db_for_write(self,model,**hints):
+        request_state().wrote = True
+        return 'default'
+    
+    def allow_relation(self,obj1,obj2,**hints):
+        return True # replicas hold the same data as the primary
+    
+    def allow_migrate(self,db,model):
+        return db == 'default'
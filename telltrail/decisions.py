@@ -0,0 +1,126 @@
+"""
+Access decisions for TellTrail.
+
+A canonical identity's policy is compiled into a flat decision table, which answers whether a
+data consumer may use data about the person in a given scope with dictionary lookups alone.
+The rules, from strongest to weakest:
+
+1. A PolicyException for the consumer, on the scope or its nearest ancestor, decides outright.
+   An exception with no scope covers all data.
+2. Otherwise the PolicyElement on the scope or its nearest ancestor applies, falling back to the
+   default policy.  The element grants access if its default_grant is set and the consumer's
+   letter_grade is at least as good as its minimum_grade.
+"""
+from telltrail.models import PolicyElement, PolicyException
+from telltrail.scopes import scope_index
+
+DEFAULT_ELEMENT = (True,'C') # the default policy of an identity that has never saved one
+
+def grade_permits(letter_grade,minimum_grade):
+    """
+    Whether a consumer with the letter grade meets the minimum grade.  'A' is the best grade,
+    and no minimum grade means any consumer will do.
+    """
+    return minimum_grade is None or letter_grade <= minimum_grade
+
+def scope_ancestry():
+    """
+    Maps every scope name, and None for all data, to the list of scopes that govern it, from
+    the scope itself up through its ancestors to None.
+    """
+    index = scope_index()
+    ancestry = dict((name,index.chain(name)) for name in index.parents)
+    ancestry[None] = index.chain(None)
+    return ancestry
+
+class DecisionTable(object):
+    """
+    The compiled policy of a single canonical identity.  Elements map every scope to its
+    effective (grant, minimum_grade), and exceptions map (consumer pk, scope) to the effective
+    grant, for every consumer the identity has exceptions for.
+    """
+    def __init__(self,elements,exceptions):
+        self.elements = elements
+        self.exceptions = exceptions
+    
+    @classmethod
+    def compile(cls,elements,exceptions,ancestry):
+        """
+        Compiles the table from the identity's scoped elements, {scope: (grant, minimum_grade)},
+        and exceptions, {(consumer pk, scope): grant}, where a scope of None is all data.
+        """
+        elements = dict(elements)
+        elements.setdefault(None,DEFAULT_ELEMENT)
+        consumers = set(consumer for consumer, scope in exceptions)
+        flat_elements = {}
+        flat_exceptions = {}
+        for scope, chain in ancestry.items():
+            flat_elements[scope] = next(elements[s] for s in chain if s in elements)
+            for consumer in consumers:
+                for s in chain:
+                    if (consumer,s) in exceptions:
+                        flat_exceptions[(consumer,scope)] = exceptions[(consumer,s)]
+                        break
+        return cls(flat_elements,flat_exceptions)
+    
+    def decide(self,consumer,scope=None):
+        """
+        Whether the DataConsumer may use data in the named scope, or in all data if no scope is
+        given.  Returns None if the scope is unknown.
+        """
+        grant = self.exceptions.get((consumer.pk,scope))
+        if grant is not None:
+            return grant
+        element = self.elements.get(scope)
+        if element is None:
+            return None
+        grant, minimum_grade = element
+        return grant and grade_permits(consumer.letter_grade,minimum_grade)
+
+def load_policies(canonical_identity_ids):
+    """
+    Loads the scoped elements and exceptions of the canonical identities, as two dictionaries
+    keyed by pk in the form DecisionTable.compile takes.  Sends two queries.
+    """
+    pks = set(canonical_identity_ids)
+    elements = dict((pk,{}) for pk in pks)
+    exceptions = dict((pk,{}) for pk in pks)
+    if pks:
+        for pk, scope, grant, minimum_grade in PolicyElement.objects.filter(canonical_identity__in=pks).values_list('canonical_identity','scope','default_grant','minimum_grade'):
+            elements[pk][scope] = (grant,minimum_grade)
+        for pk, consumer, scope, grant in PolicyException.objects.filter(canonical_identity__in=pks).values_list('canonical_identity','consumer','scope','grant'):
+            exceptions[pk][(consumer,scope)] = grant
+    return elements, exceptions
+
+def compile_tables(canonical_identity_ids):
+    """
+    Compiles the decision tables for the canonical identities, keyed by pk.  Sends a fixed
+    number of queries, no matter how many identities are compiled.
+    """
+    pks = set(canonical_identity_ids)
+    if not pks:
+        return {}
+    
+    elements, exceptions = load_policies(pks)
+    ancestry = scope_ancestry()
+    return dict((pk,DecisionTable.compile(elements[pk],exceptions[pk],ancestry)) for pk in pks)
+
+def decide_many(queries):
+    """
+    Decides many queries at once.  Each query is a (canonical identity pks, DataConsumer, scope
+    name) triple, and is permitted only if every one of the canonical identities permits it,
+    since a contested identity may belong to any of its claimants.  Answers are True, False, or
+    None where the identities, consumer or scope are unknown.
+    """
+    tables = compile_tables(pk for pks, consumer, scope in queries for pk in pks)
+    decisions = []
+    for pks, consumer, scope in queries:
+        if not pks or consumer is None:
+            decisions.append(None)
+            continue
+        answers = [tables[pk].decide(consumer,scope) for pk in pks]
+        if None in answers:
+            decisions.append(None)
+        else:
+            decisions.append(all(answers))
+    return decisions
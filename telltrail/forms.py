@@ -4,7 +4,9 @@ Forms for TellTrail.
 from django import forms
 from django.contrib.auth.models import User
 from django.contrib import auth
+from django.forms.models import ModelChoiceIterator
 from telltrail.models import *
+from telltrail.reference import reference_data, current_reference_data
 import re
 
 class SignupForm(forms.Form):
@@ -79,6 +81,7 @@ class SignupForm(forms.Form):
         if self.cleaned_data.get('zip_code',None):
             can_id.zip_code = self.cleaned_data['zip_code']
         can_id.save()
+        PolicyElement.objects.create(canonical_identity=can_id,scope=None,default_grant=True,minimum_grade='C')
         
         retrieved_user = auth.authenticate(username=self.cleaned_data['username'],password=self.cleaned_data['password'])
         auth.login(request,retrieved_user)
@@ -107,7 +110,7 @@ class LoginForm(forms.Form):
         """
         user = auth.authenticate(username=self.cleaned_data['username'],password=self.cleaned_data['password'])
         auth.login(request,user)
-    
+
 
 class PersonalInfoForm(forms.Form):
     """
@@ -136,21 +139,20 @@ class PersonalInfoForm(forms.Form):
         else:
             return zc
     
-    def init(self,user):
+    def init(self,ci):
         """
-        Initializes the form with the user data.
+        Initializes the form with the data of the canonical identity and its user.
         """
-        ci = CanonicalIdentity.objects.get(user=user)
-        self.initial['first_name'] = user.first_name
-        self.initial['last_name'] = user.last_name
+        self.initial['first_name'] = ci.user.first_name
+        self.initial['last_name'] = ci.user.last_name
         self.initial['city'] = ci.city
         self.initial['zip_code'] = ci.zip_code
     
-    def update_user(self,user):
+    def update_user(self,ci):
         """
-        Updates the user.
+        Updates the canonical identity and its user.
         """
-        ci = CanonicalIdentity.objects.get(user=user)
+        user = ci.user
         ci.city = self.cleaned_data.get('city',None)
         ci.zip_code = self.cleaned_data.get('zip_code',None)
         ci.save()
@@ -177,12 +179,52 @@ specific_choices = (
     ('no','Nobody may access this data.'),
 )
 
+class ReferenceChoiceIterator(ModelChoiceIterator):
+    """
+    The choices of a ReferenceChoiceField, from the reference data registry.
+    """
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('',self.field.empty_label)
+        for obj in getattr(reference_data(),self.field.kind):
+            yield self.choice(obj)
+    
+    def __len__(self):
+        return len(getattr(reference_data(),self.field.kind)) + (1 if self.field.empty_label is not None else 0)
+
+class ReferenceChoiceField(forms.ModelChoiceField):
+    """
+    A ModelChoiceField for services, consumers or scopes (as kind is 'services', 'consumers' or
+    'scopes'), whose choices and cleaned objects come from the reference data registry rather
+    than queries.
+    """
+    def __init__(self,kind,queryset,*args,**kwargs):
+        self.kind = kind
+        super(ReferenceChoiceField,self).__init__(queryset,*args,**kwargs)
+    
+    def _get_choices(self):
+        return ReferenceChoiceIterator(self)
+    
+    choices = property(_get_choices,forms.ChoiceField._set_choices)
+    
+    def to_python(self,value):
+        if value in self.empty_values:
+            return None
+        try:
+            pk = self.queryset.model._meta.pk.to_python(value)
+        except forms.ValidationError:
+            raise forms.ValidationError(self.error_messages['invalid_choice'],code='invalid_choice')
+        obj = current_reference_data(self.kind,[pk]).get(self.kind,pk)
+        if obj is None:
+            raise forms.ValidationError(self.error_messages['invalid_choice'],code='invalid_choice')
+        return obj
+
 class PolicyForm(forms.Form):
     """
     Form for a data policy.
     """
     grant = forms.CharField(widget=forms.RadioSelect(choices=specific_choices))
-
+    
     def init(self,policy):
         """
         Initializes the form.
@@ -206,36 +248,29 @@ class IdentityForm(forms.Form):
     """
     A form for an identity claim.
     """
-    service = forms.ModelChoiceField(queryset=Service.objects.all(),empty_label='Choose a Service')
+    service = ReferenceChoiceField('services',Service.objects.all(),empty_label='Choose a Service')
     identity = forms.CharField()
     
-    def add_identity(self,user):
+    def add_identity(self,ci):
         """
-        Adds a new identity.
+        Adds a new identity claimed by the canonical identity.
         """
-        ci = CanonicalIdentity.objects.get(user=user)
         identity, created = Identity.objects.get_or_create(service=self.cleaned_data['service'],identity=self.cleaned_data['identity'])
-        if created:
-            IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=75)
-        else:
-            claim_count = identity.identity_claims.count()
-            claim_confidence = min(100 / claim_count,75) if claim_count else 75
-            IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=claim_confidence)
+        IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=identity.next_claim_confidence)
 
 
 class ExceptionForm(forms.Form):
     """
     A form for a policy exception.
     """
-    consumer = forms.ModelChoiceField(queryset=DataConsumer.objects.all(),empty_label='Choose a data consumer')
+    consumer = ReferenceChoiceField('consumers',DataConsumer.objects.all(),empty_label='Choose a data consumer')
     grant = forms.CharField(widget=forms.RadioSelect(choices=grant_choices))
-    scope = forms.ModelChoiceField(queryset=DataScope.objects.all(),empty_label='All Data',required=False)
+    scope = ReferenceChoiceField('scopes',DataScope.objects.all(),empty_label='All Data',required=False)
     
-    def add_exception(self,user):
+    def add_exception(self,ci):
         """
-        Adds an exception.
+        Adds an exception to the canonical identity's policy.
         """
-        ci = CanonicalIdentity.objects.get(user=user)
         PolicyException.objects.create(canonical_identity=ci,
                                        consumer=self.cleaned_data['consumer'],
                                        scope=self.cleaned_data['scope'],
@@ -248,18 +283,16 @@ class SpecificPolicyForm(forms.Form):
     """
     Form for a specific policy.
     """
-    scope = forms.ModelChoiceField(queryset=DataScope.objects.all(),empty_label='Choose a data type')
+    scope = ReferenceChoiceField('scopes',DataScope.objects.all(),empty_label='Choose a data type')
     grant = forms.CharField(widget=forms.RadioSelect(choices=specific_choices))
     
-    def add_specific(self,user):
+    def add_specific(self,ci):
         """
-        Creates a specific policy for the specified user.
+        Creates a specific policy for the canonical identity.
         """
-        ci = CanonicalIdentity.objects.get(user=user)
         granted = self.cleaned_data['grant'] != 'no'
         min_grade = self.cleaned_data['grant'] if granted else None
         PolicyElement.objects.create(canonical_identity=ci,
                                      scope=self.cleaned_data['scope'],
                                      default_grant=granted,
                                      minimum_grade=min_grade)
-        
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""
+Versions for cached control panel fragments.
+
+The identity, exception and specific policy lists of a canonical identity are cached under a
+version made of a global part, bumped when reference data shown in every list changes, and a
+part for the canonical identity, bumped when its own claims, exceptions or policies change.
+Versions start from the time in milliseconds, so a version dropped from the cache doesn't come
+back at a value that stale fragments are still cached under.
+"""
+from django.core.cache import caches
+import time
+
+GLOBAL_KEY = 'telltrail:fragments:all'
+
+def version_key(canonical_identity_id):
+    return 'telltrail:fragments:%d' % canonical_identity_id
+
+def fragment_version(canonical_identity_id):
+    """
+    The current fragment version for the canonical identity.
+    """
+    cache = caches['fragments']
+    keys = [GLOBAL_KEY,version_key(canonical_identity_id)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key,new_version(),None)
+            versions[key] = cache.get(key,0)
+    return '%d.%d' % (versions[GLOBAL_KEY],versions[keys[1]])
+
+def new_version():
+    return int(time.time() * 1000)
+
+def bump(key):
+    cache = caches['fragments']
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key,new_version(),None)
+
+def bump_fragment_versions(canonical_identity_ids):
+    """
+    Moves the fragment versions of the canonical identities on.
+    """
+    for pk in set(canonical_identity_ids):
+        bump(version_key(pk))
+
+def bump_all_fragment_versions():
+    """
+    Moves the fragment versions of every canonical identity on.
+    """
+    bump(GLOBAL_KEY)
@@ -0,0 +1,238 @@
+"""
+Bulk import of identities and identity claims for TellTrail.
+
+Rows are dictionaries with 'user' (a username), 'service' (a service name), 'identity' and
+'profile'.  Each row makes sure the user has a canonical identity, that the identity exists
+with that profile, and that the user's canonical identity claims it.  Rows are written a chunk
+at a time with a handful of queries, and each chunk is its own transaction.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+import csv
+import json
+import os
+import time
+from telltrail.models import CanonicalIdentity, Identity, IdentityClaim, PolicyElement, Service, claim_confidence, profile_key
+from telltrail.lookups import service_ids, normalize_identity
+from telltrail.cache import invalidate_policies
+from telltrail.fragments import bump_fragment_versions
+from telltrail.snapshot import touch_policies, touch_identities
+from telltrail.utils import setting
+
+class MalformedRow(ValueError):
+    """
+    Raised for a row that can't be imported.
+    """
+    pass
+
+def read_rows(f,format='csv'):
+    """
+    Reads rows from a CSV file with a header row, or from a file of JSON lines.
+    """
+    if format == 'csv':
+        for row in csv.DictReader(f):
+            yield dict((key,(value or '').decode('utf-8')) for key, value in row.items() if key)
+    elif format == 'jsonl':
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError('Unknown import format "%s".' % format)
+
+def clean_row(row,services):
+    """
+    Checks the row, returning (username, service id, identity, profile).
+    """
+    try:
+        username = row['user'].strip()
+        service_name = row['service'].strip()
+        identity = row['identity'].strip()
+        profile = (row.get('profile') or '').strip()
+    except (KeyError, AttributeError):
+        raise MalformedRow('Expected user, service, identity and profile.')
+    if not username or not identity:
+        raise MalformedRow('User and identity are required.')
+    service_id = services.get(service_name.lower())
+    if service_id is None:
+        raise MalformedRow('Unknown service "%s".' % service_name)
+    return username, service_id, identity, profile
+
+def canonical_identities(usernames):
+    """
+    Maps the usernames to canonical identity ids, creating users without passwords, and
+    canonical identities with default policies, as needed.
+    """
+    usernames = set(usernames)
+    existing = set(User.objects.filter(username__in=usernames).values_list('username',flat=True))
+    new_users = []
+    for username in usernames - existing:
+        user = User(username=username)
+        user.set_unusable_password()
+        new_users.append(user)
+    User.objects.bulk_create(new_users)
+    
+    user_ids = dict(User.objects.filter(username__in=usernames).values_list('username','pk'))
+    found = dict(CanonicalIdentity.objects.filter(user__in=user_ids.values()).values_list('user','pk'))
+    missing = [user_id for user_id in user_ids.values() if user_id not in found]
+    if missing:
+        CanonicalIdentity.objects.bulk_create([CanonicalIdentity(user_id=user_id) for user_id in missing])
+        created = dict(CanonicalIdentity.objects.filter(user__in=missing).values_list('user','pk'))
+        PolicyElement.objects.bulk_create([PolicyElement(canonical_identity_id=pk,scope=None,default_grant=True,minimum_grade='C') for pk in created.values()])
+        found.update(created)
+    return dict((username,found[user_id]) for username, user_id in user_ids.items())
+
+def upsert_identities(rows):
+    """
+    Maps (service id, identity key) to Identity ids for the cleaned rows, creating identities
+    that don't exist and updating changed profiles.  Identities are matched on their normalized
+    identity_key, as API lookups are, so 'foo' finds an existing 'Foo' at the same service.
+    Returns the map, and the ids of identities whose profile changed.
+    """
+    profiles = {}
+    names = {}
+    for username, service_id, identity, profile in rows:
+        key = (service_id,normalize_identity(identity))
+        names.setdefault(key,identity)
+        if profile or key not in profiles:
+            profiles[key] = profile
+    found = {}
+    changed = []
+    case_rules = dict(Service.objects.filter(pk__in=set(service_id for service_id, identity_key in profiles)).values_list('pk','case_insensitive_profiles'))
+    existing = Identity.objects.filter(service__in=set(service_id for service_id, identity_key in profiles),
+                                       identity_key__in=set(identity_key for service_id, identity_key in profiles)).order_by('pk')
+    for pk, service_id, identity_key, profile in existing.values_list('pk','service','identity_key','profile'):
+        key = (service_id,identity_key)
+        if key in profiles and key not in found:
+            found[key] = pk
+            if profiles[key] and profiles[key] != profile:
+                Identity.objects.filter(pk=pk).update(profile=profiles[key],profile_key=profile_key(profiles[key],case_rules[service_id]))
+                changed.append(pk)
+    
+    new = [key for key in profiles if key not in found]
+    if new:
+        Identity.objects.bulk_create([Identity(service_id=service_id,identity=names[(service_id,identity_key)],identity_key=identity_key,profile=profiles[(service_id,identity_key)],
+                                               profile_key=profile_key(profiles[(service_id,identity_key)],case_rules[service_id]))
+                                      for service_id, identity_key in new])
+        created = Identity.objects.filter(service__in=set(service_id for service_id, identity_key in new),
+                                          identity_key__in=set(identity_key for service_id, identity_key in new)).order_by('pk')
+        for pk, service_id, identity_key in created.values_list('pk','service','identity_key'):
+            found.setdefault((service_id,identity_key),pk)
+    return found, changed
+
+@transaction.atomic
+def import_chunk(rows,services):
+    """
+    Imports a chunk of rows in one transaction.  Returns the number of claims created, the rows
+    that failed as (index in the chunk, row, error), and the ids of the canonical identities
+    whose policies changed.
+    """
+    cleaned = []
+    failed = []
+    for i, row in enumerate(rows):
+        try:
+            cleaned.append(clean_row(row,services))
+        except MalformedRow, e:
+            failed.append((i,row,unicode(e)))
+    if not cleaned:
+        return 0, failed, set()
+    
+    canonical_ids = canonical_identities(username for username, service_id, identity, profile in cleaned)
+    identity_ids, changed = upsert_identities(cleaned)
+    
+    claims = set(IdentityClaim.objects.filter(identity__in=identity_ids.values(),canonical_identity__in=canonical_ids.values())
+                                      .values_list('canonical_identity','identity'))
+    claim_counts = dict(Identity.objects.filter(pk__in=identity_ids.values()).values_list('pk','claim_count'))
+    
+    new_claims = []
+    for username, service_id, identity, profile in cleaned:
+        key = (canonical_ids[username],identity_ids[(service_id,normalize_identity(identity))])
+        if key in claims:
+            continue # already claimed, as when a chunk is imported again
+        claims.add(key)
+        count = claim_counts[key[1]]
+        new_claims.append(IdentityClaim(canonical_identity_id=key[0],identity_id=key[1],claim_confidence=claim_confidence(count)))
+        claim_counts[key[1]] = count + 1
+    IdentityClaim.objects.bulk_create(new_claims)
+    Identity.objects.reconcile_claim_counts(set(claim.identity_id for claim in new_claims)) # bulk writes send no signals
+    
+    affected = set(claim.canonical_identity_id for claim in new_claims)
+    if changed:
+        affected.update(IdentityClaim.objects.filter(identity__in=changed).values_list('canonical_identity',flat=True))
+    touch_policies(affected)
+    touch_identities(set(claim.identity_id for claim in new_claims).union(changed))
+    return len(new_claims), failed, affected
+
+def import_identities(rows,chunk_size=None,start=0,progress=None,report=None):
+    """
+    Imports an iterable of rows in chunks of chunk_size rows, or the IMPORT_CHUNK_SIZE setting.
+    
+    The first start rows are skipped, to resume an import.  After each chunk is committed,
+    progress (if given) is called with the number of rows done so far, and report (if given)
+    with the running totals.  Returns the totals: rows, claims, failed (a list of (row number,
+    row, error)), seconds and rows_per_second.
+    """
+    chunk_size = chunk_size or setting('IMPORT_CHUNK_SIZE',500)
+    services = service_ids()
+    totals = {'rows':0,'claims':0,'failed':[],'seconds':0.0,'rows_per_second':0.0}
+    began = time.time()
+    done = start
+    chunk = []
+    for n, row in enumerate(rows):
+        if n < start:
+            continue
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            done = _import(chunk,services,done,totals,began,progress,report)
+            chunk = []
+    if chunk:
+        done = _import(chunk,services,done,totals,began,progress,report)
+    return totals
+
+def _import(chunk,services,done,totals,began,progress,report):
+    """
+    Imports one chunk and brings the totals up to date.
+    """
+    claims, failed, affected = import_chunk(chunk,services)
+    # bulk writes send no signals, and caches are only cleared once the chunk is committed
+    invalidate_policies(affected)
+    bump_fragment_versions(affected)
+    totals['failed'] += [(done + i + 1,row,error) for i, row, error in failed]
+    totals['rows'] += len(chunk)
+    totals['claims'] += claims
+    totals['seconds'] = time.time() - began
+    totals['rows_per_second'] = totals['rows'] / totals['seconds'] if totals['seconds'] else 0.0
+    done += len(chunk)
+    if progress:
+        progress(done)
+    if report:
+        report(totals)
+    return done
+
+class ProgressFile(object):
+    """
+    Records how many rows of an import are done, so an interrupted import can resume.
+    """
+    def __init__(self,path):
+        self.path = path
+    
+    def read(self):
+        """
+        The number of rows done, or 0 for a new import.
+        """
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+    
+    def __call__(self,done):
+        with open(self.path + '.tmp','w') as f:
+            f.write('%d\n' % done)
+        os.rename(self.path + '.tmp',self.path)
+    
+    def finish(self):
+        """
+        Removes the progress file once the import is complete.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
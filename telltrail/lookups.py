@@ -0,0 +1,101 @@
+"""
+Resolution of API lookups to canonical identities.
+"""
+from telltrail.models import IdentityClaim, profile_lookup_keys
+from telltrail.reference import reference_data
+from telltrail.snapshot import snapshot_profiles, snapshot_identities
+
+class MalformedLookup(ValueError):
+    """
+    A lookup that can't be parsed.
+    """
+    pass
+
+def service_ids():
+    """
+    Maps lower cased service names to Service pks, from the reference data registry.
+    """
+    return reference_data().service_ids
+
+def normalize_identity(identity_name):
+    """
+    The normalized form of an identity name, as stored in Identity.identity_key.
+    """
+    return identity_name.strip().lower()
+
+def parse_identity(identity_string):
+    """
+    Parses an identity string (<identity>@@<service>) into an (identity, service name) pair.
+    Raises MalformedLookup if the string isn't of that form.
+    """
+    parts = identity_string.split('@@')
+    if len(parts) != 2 or not parts[0].strip() or not parts[1].strip():
+        raise MalformedLookup('Malformed identity "%s", expected <identity>@@<service>.' % identity_string)
+    return parts[0], parts[1]
+
+def resolve_profiles(profiles):
+    """
+    Maps each of the profiles to the ids of the canonical identities claiming it, from the
+    policy snapshot where it is unchanged.  Profiles are matched on the indexed
+    Identity.profile_key, so differences in scheme, host case and trailing slashes, and in
+    path case at services that ignore it, don't matter.
+    """
+    resolved = dict((profile,[]) for profile in profiles)
+    found = snapshot_profiles(resolved)
+    resolved.update(found)
+    keys = {}
+    for profile in resolved:
+        if profile not in found:
+            for key in profile_lookup_keys(profile):
+                keys.setdefault(key,[]).append(profile)
+    if keys:
+        claims = IdentityClaim.objects.filter(identity__profile_key__in=keys.keys()).order_by('pk')
+        for key, canonical_identity_id in claims.values_list('identity__profile_key','canonical_identity'):
+            for profile in keys[key]:
+                resolved[profile].append(canonical_identity_id)
+    return resolved
+
+def resolve_identity_pairs(pairs):
+    """
+    Maps each (identity, service name) pair to the ids of the canonical identities claiming it.
+    Names are matched case insensitively.  Pairs unchanged in the policy snapshot are answered
+    from it, and the rest are matched in a single query on the indexed Identity.identity_key.
+    """
+    resolved = dict((pair,[]) for pair in pairs)
+    keys = {}
+    ids = service_ids()
+    for pair in resolved:
+        identity_name, service_name = pair
+        service_id = ids.get(service_name.strip().lower())
+        if service_id is not None:
+            keys.setdefault((normalize_identity(identity_name),service_id),[]).append(pair)
+    
+    for key, canonical_identity_ids in snapshot_identities(keys).items():
+        for pair in keys.pop(key):
+            resolved[pair] = list(canonical_identity_ids)
+    
+    if keys:
+        claims = IdentityClaim.objects.filter(identity__identity_key__in=set(key for key, service in keys),
+                                              identity__service__in=set(service for key, service in keys)).order_by('pk')
+        for identity_key, service_id, canonical_identity_id in claims.values_list('identity__identity_key','identity__service','canonical_identity'):
+            for pair in keys.get((identity_key,service_id),[]):
+                resolved[pair].append(canonical_identity_id)
+    return resolved
+
+def resolve_identities(identity_strings):
+    """
+    Maps each of the identity strings (<identity>@@<service>) to the ids of the canonical 
+    identities claiming it, or to a MalformedLookup if the string can't be parsed.
+    """
+    resolved = {}
+    pairs = {}
+    for identity_string in identity_strings:
+        try:
+            pairs[identity_string] = parse_identity(identity_string)
+        except MalformedLookup, e:
+            resolved[identity_string] = e
+    
+    matched = resolve_identity_pairs(pairs.values())
+    for identity_string, pair in pairs.items():
+        resolved[identity_string] = matched[pair]
+    return resolved
@@ -0,0 +1,124 @@
+"""
+Benchmarks the policy API in-process against data from generate_load_data.
+"""
+from optparse import make_option
+import json
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from telltrail.models import Identity, DataSource
+
+LOOKUPS = ('profile','profile_list','identity','identity_list')
+
+def percentile(values,fraction):
+    """
+    The nearest-rank percentile of the sorted values.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1,max(0,int(round(fraction * len(values) + 0.5)) - 1))]
+
+def summarize(samples,elapsed=None):
+    """
+    Summarizes (latency, queries, bytes) samples taken over elapsed seconds, which defaults to 
+    the time spent in the sampled requests themselves.
+    """
+    latencies = sorted(sample[0] for sample in samples)
+    queries = [sample[1] for sample in samples]
+    if elapsed is None:
+        elapsed = sum(latencies)
+    return {'requests':len(samples),
+            'throughput':len(samples) / elapsed if elapsed else None,
+            'latency_ms':{'p50':percentile(latencies,0.50) * 1000,
+                          'p95':percentile(latencies,0.95) * 1000,
+                          'p99':percentile(latencies,0.99) * 1000,
+                          'max':latencies[-1] * 1000,
+                          'mean':sum(latencies) / len(latencies) * 1000},
+            'queries_per_request':{'mean':float(sum(queries)) / len(queries),'max':max(queries)},
+            'bytes_per_request':float(sum(sample[2] for sample in samples)) / len(samples)}
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', dest='requests', type='int', default=500,
+            help='Number of measured requests.'),
+        make_option('--warmup', dest='warmup', type='int', default=20,
+            help='Number of unmeasured requests sent first.'),
+        make_option('--mix', dest='mix', default='profile=1,profile_list=1,identity=1,identity_list=1',
+            help='Relative weights of the lookup variables, as lookup=weight pairs.'),
+        make_option('--list-size', dest='list_size', type='int', default=50,
+            help='Entries in each profile_list and identity_list lookup.'),
+        make_option('--prefix', dest='prefix', default='load',
+            help='Prefix the data was generated with.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Random seed, for a reproducible request sequence.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the JSON report to, instead of standard output.'),
+    )
+    help = 'Benchmarks the policy API in-process, reporting latency percentiles, throughput and queries per request as JSON.'
+    
+    def handle(self,*args,**options):
+        prefix = options['prefix']
+        try:
+            source = DataSource.objects.get(account_name=prefix,instance_name='benchmark')
+        except DataSource.DoesNotExist:
+            raise CommandError('No benchmark data with the prefix "%s", run generate_load_data first.' % prefix)
+        identities = list(Identity.objects.filter(identity__startswith='%s_User' % prefix).values_list('profile','identity','service__name'))
+        
+        mix = []
+        for pair in options['mix'].split(','):
+            lookup, weight = pair.split('=')
+            if lookup not in LOOKUPS:
+                raise CommandError('Unknown lookup "%s" in the mix.' % lookup)
+            mix += [lookup] * int(weight)
+        
+        rand = random.Random(options['seed'])
+        plan = [self.make_request(rand.choice(mix),identities,options['list_size'],rand) for i in range(options['warmup'] + options['requests'])]
+        
+        # far more is looked up than a data source is admitted, so admission control is off
+        with override_settings(ADMISSION_CONTROL=False):
+            client = Client()
+            url = '/api/%s/policy/' % source.api_key
+            for lookup, params in plan[:options['warmup']]:
+                client.get(url,params)
+            
+            samples = dict((lookup,[]) for lookup in LOOKUPS)
+            started = time.time()
+            for lookup, params in plan[options['warmup']:]:
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.time()
+                    response = client.get(url,params)
+                    content = ''.join(response.streaming_content) if response.streaming else response.content
+                    latency = time.time() - start
+                if response.status_code != 200:
+                    raise CommandError('%s lookup failed with status %d.' % (lookup,response.status_code))
+                samples[lookup].append((latency,len(queries),len(content)))
+            elapsed = time.time() - started
+        
+        report = {'settings':{'requests':options['requests'],'warmup':options['warmup'],'mix':options['mix'],
+                              'list_size':options['list_size'],'seed':options['seed'],'identities':len(identities),
+                              'database':connection.vendor},
+                  'overall':summarize([sample for lookup in LOOKUPS for sample in samples[lookup]],elapsed),
+                  'lookups':dict((lookup,summarize(samples[lookup])) for lookup in LOOKUPS if samples[lookup])}
+        output = json.dumps(report,indent=4,sort_keys=True)
+        if options['output']:
+            with open(options['output'],'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+    
+    def make_request(self,lookup,identities,list_size,rand):
+        """
+        Makes the query parameters for a lookup of randomly chosen identities.
+        """
+        if lookup == 'profile':
+            return lookup, {'profile':rand.choice(identities)[0]}
+        elif lookup == 'profile_list':
+            return lookup, {'profile_list':','.join(identity[0] for identity in rand.sample(identities,min(list_size,len(identities))))}
+        elif lookup == 'identity':
+            identity = rand.choice(identities)
+            return lookup, {'identity':'%s@@%s' % (identity[1],identity[2])}
+        else:
+            return lookup, {'identity_list':','.join('%s@@%s' % (identity[1],identity[2]) for identity in rand.sample(identities,min(list_size,len(identities))))}
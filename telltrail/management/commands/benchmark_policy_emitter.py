@@ -0,0 +1,59 @@
+"""
+Benchmarks the fast JSON emitter against piston's, on policy responses.
+"""
+from optparse import make_option
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from piston.emitters import JSONEmitter
+from telltrail.models import CanonicalIdentity
+from telltrail.api.emitters import FastJSONEmitter
+
+def best_time(emitter,payload,request,repeat):
+    """
+    The best of repeat renders of the payload, in seconds, and the last rendering.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        content = emitter(payload,{},None).render(request)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best,elapsed)
+    return best, content
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--policies', dest='policies', type='int', default=500,
+            help='Policies in each response.'),
+        make_option('--repeat', dest='repeat', type='int', default=20,
+            help='Renders of each response, of which the fastest is reported.'),
+    )
+    help = 'Renders policy responses with piston\'s JSON emitter and the fast one, checking they match, and reports timings as JSON.'
+    
+    def handle(self,*args,**options):
+        pks = list(CanonicalIdentity.objects.order_by('pk').values_list('pk',flat=True)[:options['policies']])
+        if not pks:
+            raise CommandError('No canonical identities to render, run generate_load_data first.')
+        policies = CanonicalIdentity.objects.render_policies(pks)
+        
+        # as returned by PolicyHandler for a lookup, and for a bulk lookup
+        lookup = []
+        for pk in pks:
+            policy = dict(policies[pk])
+            policy['matched_by'] = {'profiles':[identity['profile'] for identity in policy['identities']],'identities':[]}
+            lookup.append(policy)
+        bulk = {'profiles':dict((identity['profile'],[policies[pk]]) for pk in pks for identity in policies[pk]['identities'])}
+        
+        request = RequestFactory().get('/')
+        report = {'settings':{'policies':len(pks),'repeat':options['repeat']},'responses':{}}
+        for name, payload in (('lookup',lookup),('bulk',bulk)):
+            piston_time, piston_content = best_time(JSONEmitter,payload,request,options['repeat'])
+            fast_time, fast_content = best_time(FastJSONEmitter,payload,request,options['repeat'])
+            if fast_content != piston_content:
+                raise CommandError('The fast emitter\'s %s response differs from piston\'s.' % name)
+            report['responses'][name] = {'bytes':len(piston_content.encode('utf-8')),
+                                         'piston_ms':piston_time * 1000,
+                                         'fast_ms':fast_time * 1000,
+                                         'speedup':piston_time / fast_time if fast_time else None}
+        self.stdout.write(json.dumps(report,indent=4,sort_keys=True))
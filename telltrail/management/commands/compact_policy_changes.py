@@ -0,0 +1,17 @@
+"""
+Compacts the policy change log.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from telltrail.changes import compact_changes
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=None,
+            help='Days of changes to keep.  Defaults to the POLICY_CHANGE_RETENTION_DAYS setting.'),
+    )
+    help = 'Deletes policy changes superseded by later ones, and changes older than the retention period.'
+    
+    def handle(self,*args,**options):
+        superseded, expired = compact_changes(options['days'])
+        self.stdout.write('Deleted %d superseded and %d expired policy changes.' % (superseded,expired))
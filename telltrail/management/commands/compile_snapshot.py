@@ -0,0 +1,24 @@
+"""
+Compiles the policy snapshot shared by the API workers.
+"""
+from optparse import make_option
+import time
+from django.core.management.base import BaseCommand, CommandError
+from telltrail.snapshot import compile_snapshot
+from telltrail.utils import setting
+
+class Command(BaseCommand):
+    args = '[<path>]'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int', default=None,
+            help='Canonical identities rendered at a time.  Defaults to the SNAPSHOT_CHUNK_SIZE setting.'),
+    )
+    help = 'Compiles every policy and lookup into a snapshot file, by default at the SNAPSHOT_PATH setting.'
+    
+    def handle(self,*args,**options):
+        path = args[0] if args else setting('SNAPSHOT_PATH',None)
+        if not path:
+            raise CommandError('Give the snapshot path, or set SNAPSHOT_PATH.')
+        started = time.time()
+        count = compile_snapshot(path,chunk_size=options['chunk_size'])
+        self.stdout.write('Compiled %d policies into %s in %.1fs.' % (count,path,time.time() - started))
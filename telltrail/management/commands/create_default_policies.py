@@ -0,0 +1,25 @@
+"""
+Creates default policies for canonical identities that don't have one.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from telltrail.models import CanonicalIdentity, PolicyElement
+from telltrail.cache import invalidate_policies
+from telltrail.utils import chunked
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Canonical identities per transaction.'),
+    )
+    help = 'Creates the default policy of every canonical identity that is missing one, as sign up now does.'
+    
+    def handle(self,*args,**options):
+        with_default = PolicyElement.objects.filter(scope__isnull=True).values('canonical_identity')
+        missing = list(CanonicalIdentity.objects.exclude(pk__in=with_default).order_by('pk').values_list('pk',flat=True))
+        for batch in chunked(missing,options['batch_size']):
+            with transaction.atomic():
+                PolicyElement.objects.bulk_create([PolicyElement(canonical_identity_id=pk,scope=None,default_grant=True,minimum_grade='C') for pk in batch])
+            invalidate_policies(batch)
+        self.stdout.write('Created %d default policies.' % len(missing))
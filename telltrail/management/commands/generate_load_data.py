@@ -0,0 +1,133 @@
+"""
+Generates synthetic users, identities and policies for load testing the policy API.
+"""
+from optparse import make_option
+import random
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from telltrail.models import *
+from telltrail.utils import random_hex, chunked
+
+BATCH_SIZE = 400
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--users', dest='users', type='int', default=1000,
+            help='Number of users, each with a CanonicalIdentity.'),
+        make_option('--claims', dest='claims', type='int', default=2,
+            help='Identity claims per user, spread across the services.'),
+        make_option('--contested', dest='contested', type='float', default=0.05,
+            help='Fraction of users that also claim another user\'s identity.'),
+        make_option('--exceptions', dest='exceptions', type='int', default=2,
+            help='Policy exceptions per user.'),
+        make_option('--specific', dest='specific', type='int', default=2,
+            help='Specific policies per user.'),
+        make_option('--consumers', dest='consumers', type='int', default=20,
+            help='Number of data consumers.'),
+        make_option('--prefix', dest='prefix', default='load',
+            help='Prefix for generated names, so runs at different scales can coexist.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Random seed, for reproducible data.'),
+        make_option('--api-key', dest='api_key', default=None,
+            help='API key for the benchmark data source.  Generated if not given.'),
+    )
+    help = 'Generates synthetic users, identities and policies for load testing the policy API.'
+    
+    def handle(self,*args,**options):
+        rand = random.Random(options['seed'])
+        prefix = options['prefix']
+        services = list(Service.objects.all())
+        scopes = list(DataScope.objects.values_list('name',flat=True))
+        if not services or not scopes:
+            raise CommandError('Services and data scopes are missing, run migrate first.')
+        if User.objects.filter(username__startswith='%s-' % prefix).exists():
+            raise CommandError('Data with the prefix "%s" already exists.' % prefix)
+        
+        with transaction.atomic():
+            consumers = self.make_consumers(prefix,options['consumers'],rand)
+            canonical_ids = self.make_users(prefix,options['users'])
+            self.make_claims(prefix,canonical_ids,services,options['claims'],options['contested'],rand)
+            self.make_policies(canonical_ids,consumers,scopes,options['exceptions'],options['specific'],rand)
+            api_key = options['api_key'] or random_hex()
+            DataSource.objects.create(account_name=prefix,instance_name='benchmark',api_key=api_key)
+        
+        self.stdout.write('Generated %d users with prefix "%s".  API key: %s' % (len(canonical_ids),prefix,api_key))
+    
+    def make_consumers(self,prefix,count,rand):
+        """
+        Creates the data consumers, with a spread of letter grades.
+        """
+        DataConsumer.objects.bulk_create([DataConsumer(name='%s-consumer-%d' % (prefix,i),
+                                                       domain='http://%s-consumer-%d.example.com' % (prefix,i),
+                                                       letter_grade=rand.choice('ABC'))
+                                          for i in range(count)])
+        return list(DataConsumer.objects.filter(name__startswith='%s-consumer-' % prefix).values_list('pk',flat=True))
+    
+    def make_users(self,prefix,count):
+        """
+        Creates the users and their canonical identities, returning the canonical identity ids.
+        """
+        usernames = ['%s-%d' % (prefix,i) for i in range(count)]
+        for batch in chunked(usernames,BATCH_SIZE):
+            User.objects.bulk_create([User(username=username,first_name='Load',last_name=username) for username in batch])
+        user_ids = list(User.objects.filter(username__startswith='%s-' % prefix).order_by('pk').values_list('pk',flat=True))
+        for batch in chunked(user_ids,BATCH_SIZE):
+            CanonicalIdentity.objects.bulk_create([CanonicalIdentity(user_id=user_id,city='Brooklyn',zip_code='11201') for user_id in batch])
+        return list(CanonicalIdentity.objects.filter(user__username__startswith='%s-' % prefix).order_by('pk').values_list('pk',flat=True))
+    
+    def make_claims(self,prefix,canonical_ids,services,claims,contested,rand):
+        """
+        Creates identities on the services and claims on them, with some identities claimed by
+        two canonical identities.
+        """
+        identities = []
+        for n, canonical_id in enumerate(canonical_ids):
+            for i in range(claims):
+                service = services[(n + i) % len(services)]
+                name = '%s_User%d_%d' % (prefix,n,i)
+                site = service.url.rstrip('/') or 'http://%s.example.com' % service.name.lower()
+                profile = '%s/%s' % (site,name.lower())
+                identities.append(Identity(service=service,identity=name,identity_key=name.lower(),
+                                           profile=profile,profile_key=profile_key(profile,service.case_insensitive_profiles)))
+        for batch in chunked(identities,BATCH_SIZE):
+            Identity.objects.bulk_create(batch)
+        
+        identity_ids = list(Identity.objects.filter(identity__startswith='%s_User' % prefix).order_by('pk').values_list('pk',flat=True))
+        claim_objects = []
+        for n, canonical_id in enumerate(canonical_ids):
+            for identity_id in identity_ids[n * claims:(n + 1) * claims]:
+                claim_objects.append(IdentityClaim(canonical_identity_id=canonical_id,identity_id=identity_id,claim_confidence=75))
+            if n and claims and rand.random() < contested:
+                other = rand.choice(identity_ids[:n * claims])
+                claim_objects.append(IdentityClaim(canonical_identity_id=canonical_id,identity_id=other,claim_confidence=50))
+        for batch in chunked(claim_objects,BATCH_SIZE):
+            IdentityClaim.objects.bulk_create(batch)
+        for batch in chunked(identity_ids,BATCH_SIZE):
+            Identity.objects.reconcile_claim_counts(batch)
+    
+    def make_policies(self,canonical_ids,consumers,scopes,exceptions,specific,rand):
+        """
+        Creates a default policy, specific policies and exceptions for every canonical identity.
+        """
+        elements = []
+        policy_exceptions = []
+        for canonical_id in canonical_ids:
+            granted = rand.random() < 0.9
+            elements.append(PolicyElement(canonical_identity_id=canonical_id,scope=None,default_grant=granted,
+                                          minimum_grade=rand.choice('ABC') if granted else None))
+            for scope in rand.sample(scopes,min(specific,len(scopes))):
+                granted = rand.random() < 0.7
+                elements.append(PolicyElement(canonical_identity_id=canonical_id,scope_id=scope,default_grant=granted,
+                                              minimum_grade=rand.choice('ABC') if granted else None))
+            seen = set()
+            for i in range(exceptions if consumers else 0):
+                key = (rand.choice(consumers),rand.choice(scopes + [None]))
+                if key not in seen:
+                    seen.add(key)
+                    policy_exceptions.append(PolicyException(canonical_identity_id=canonical_id,consumer_id=key[0],
+                                                             scope_id=key[1],grant=rand.random() < 0.5))
+        for batch in chunked(elements,BATCH_SIZE):
+            PolicyElement.objects.bulk_create(batch)
+        for batch in chunked(policy_exceptions,BATCH_SIZE):
+            PolicyException.objects.bulk_create(batch)
@@ -0,0 +1,49 @@
+"""
+Imports identities and identity claims from a CSV or JSON lines file.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from telltrail.imports import import_identities, read_rows, ProgressFile
+
+class Command(BaseCommand):
+    args = '<file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='csv or jsonl.  Guessed from the file extension if not given.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=None,
+            help='Rows per chunk, each written in its own transaction.  Defaults to the IMPORT_CHUNK_SIZE setting.'),
+        make_option('--progress', dest='progress', default=None,
+            help='Progress file, for resuming an interrupted import.  Defaults to <file>.progress.'),
+        make_option('--restart', dest='restart', action='store_true', default=False,
+            help='Ignore any recorded progress and import from the first row.'),
+    )
+    help = 'Imports (user, service, identity, profile) rows from a CSV file with a header row, or a JSON lines file.'
+    
+    def handle(self,*args,**options):
+        if len(args) != 1:
+            raise CommandError('Give the file to import.')
+        path = args[0]
+        format = options['format'] or ('jsonl' if path.endswith(('.jsonl','.json')) else 'csv')
+        if format not in ('csv','jsonl'):
+            raise CommandError('Unknown format "%s", expected csv or jsonl.' % format)
+        
+        progress = ProgressFile(options['progress'] or path + '.progress')
+        start = 0 if options['restart'] else progress.read()
+        if start:
+            self.stdout.write('Resuming after row %d.' % start)
+        
+        with open(path,'rb') as f:
+            totals = import_identities(read_rows(f,format),chunk_size=options['chunk_size'],start=start,
+                                       progress=progress,report=self.report if int(options['verbosity']) > 1 else None)
+        progress.finish()
+        
+        for row_number, row, error in totals['failed']:
+            self.stderr.write('Row %d: %s' % (row_number,error))
+        self.stdout.write('Imported %d rows (%d new claims, %d failed) in %.1fs, %.0f rows/sec.' %
+                          (totals['rows'],totals['claims'],len(totals['failed']),totals['seconds'],totals['rows_per_second']))
+    
+    def report(self,totals):
+        """
+        Reports progress after each chunk.
+        """
+        self.stdout.write('%d rows, %d new claims, %.0f rows/sec' % (totals['rows'],totals['claims'],totals['rows_per_second']))
@@ -0,0 +1,23 @@
+"""
+Repairs the claim counters of identities.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from telltrail.models import Identity
+from telltrail.utils import chunked
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=5000,
+            help='Identities per transaction.'),
+    )
+    help = 'Recounts the claims on every identity, repairing claim counts that have drifted.'
+    
+    def handle(self,*args,**options):
+        pks = list(Identity.objects.order_by('pk').values_list('pk',flat=True))
+        repaired = 0
+        for batch in chunked(pks,options['batch_size']):
+            with transaction.atomic():
+                repaired += Identity.objects.reconcile_claim_counts(batch)
+        self.stdout.write('Checked %d identities, repaired %d.' % (len(pks),repaired))
@@ -0,0 +1,375 @@
+"""
+Request instrumentation and Prometheus metrics for TellTrail.
+
+Each worker aggregates per-endpoint request metrics in memory and every METRICS_FLUSH_INTERVAL
+seconds writes them to its own file in METRICS_DIR, which defaults to the /dev/shm shared memory
+filesystem where there is one.  The /metrics view merges the files of every worker, folding the
+totals of workers that have exited into an archive file so counters never go backwards.
+"""
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from django.http import HttpResponse, HttpResponseForbidden
+from threading import local, Lock
+from functools import wraps
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+from telltrail.utils import setting
+
+log = logging.getLogger('telltrail')
+
+DURATION_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+QUERY_BUCKETS = (1,2,5,10,20,50,100,200,500)
+SIZE_BUCKETS = (1000,10000,100000,1000000,10000000)
+
+# ====================
+# = Per-request data =
+# ====================
+
+_request = local()
+
+def start_request():
+    """
+    Starts collecting metrics for the request being served by this thread or greenlet.
+    """
+    _request.queries = 0
+    _request.db_time = 0.0
+    _request.policies = 0
+    _request.endpoint = None
+    _request.active = True
+
+def set_endpoint(endpoint):
+    """
+    Names the endpoint serving the current request.
+    """
+    _request.endpoint = endpoint
+
+def count_policies(count):
+    """
+    Counts rendered policies returned for the current request.
+    """
+    if getattr(_request,'active',False):
+        _request.policies += count
+
+class CountingCursorWrapper(CursorWrapper):
+    """
+    Wraps a cursor wrapper to count queries and time spent in the database for the current request.
+    """
+    def timed(self,method,*args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            if getattr(_request,'active',False):
+                _request.queries += 1
+                _request.db_time += time.time() - start
+    
+    def callproc(self,procname,params=None):
+        return self.timed(self.cursor.callproc,procname,params)
+    
+    def execute(self,sql,params=None):
+        return self.timed(self.cursor.execute,sql,params)
+    
+    def executemany(self,sql,param_list):
+        return self.timed(self.cursor.executemany,sql,param_list)
+
+def install_query_counter(connection):
+    """
+    Makes the database connection count the queries of the current request.  Connections are
+    per thread, so this is done for each connection the first time a request sees it.
+    """
+    if getattr(connection,'counting_queries',False):
+        return
+    cursor = connection.cursor
+    connection.cursor = lambda: CountingCursorWrapper(cursor(),connection)
+    connection.counting_queries = True
+
+# ===============
+# = Aggregation =
+# ===============
+
+class Histogram(object):
+    """
+    A cumulative histogram, as in Prometheus.
+    """
+    def __init__(self,buckets,counts=None,total=0.0):
+        self.buckets = buckets
+        self.counts = counts or [0] * (len(buckets) + 1)
+        self.total = total
+    
+    def observe(self,value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+
+class Metrics(object):
+    """
+    The metrics of one worker, per endpoint.
+    """
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = Lock()
+        self.flushed = time.time()
+    
+    def record(self,endpoint,duration,queries,db_time,policies,size):
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = {'duration':Histogram(DURATION_BUCKETS),
+                                            'queries':Histogram(QUERY_BUCKETS),
+                                            'size':Histogram(SIZE_BUCKETS),
+                                            'db_time':0.0,
+                                            'policies':0}
+            metrics = self.endpoints[endpoint]
+            metrics['duration'].observe(duration)
+            metrics['queries'].observe(queries)
+            metrics['size'].observe(size)
+            metrics['db_time'] += db_time
+            metrics['policies'] += policies
+    
+    def dump(self):
+        """
+        The metrics as JSON-compatible data, with process-wide cache and pool stats alongside.
+        """
+        from telltrail.cache import policy_cache
+        from telltrail.db.pool import pool_stats
+        with self.lock:
+            endpoints = {}
+            for endpoint, metrics in self.endpoints.items():
+                endpoints[endpoint] = {'duration':[metrics['duration'].counts,metrics['duration'].total],
+                                       'queries':[metrics['queries'].counts,metrics['queries'].total],
+                                       'size':[metrics['size'].counts,metrics['size'].total],
+                                       'db_time':metrics['db_time'],
+                                       'policies':metrics['policies']}
+        cache_stats = policy_cache().stats()
+        pools = pool_stats()
+        return {'endpoints':endpoints,
+                'counters':{'policy_cache_hits':cache_stats['hits'],
+                            'policy_cache_misses':cache_stats['misses'],
+                            'db_pool_checkouts':sum(pool['checkouts'] for pool in pools.values()),
+                            'db_pool_waits':sum(pool['waits'] for pool in pools.values()),
+                            'db_pool_wait_seconds':sum(pool['wait_time'] for pool in pools.values()),
+                            'db_pool_timeouts':sum(pool['timeouts'] for pool in pools.values())}}
+    
+    def flush(self,force=False):
+        """
+        Writes this worker's metrics file, if the flush interval has passed.
+        """
+        now = time.time()
+        if not force and now - self.flushed < setting('METRICS_FLUSH_INTERVAL',5):
+            return
+        self.flushed = now
+        directory = metrics_dir()
+        fd, path = tempfile.mkstemp(dir=directory,prefix='.tmp')
+        with os.fdopen(fd,'w') as f:
+            json.dump(self.dump(),f)
+        os.rename(path,os.path.join(directory,'%d.json' % os.getpid()))
+
+_metrics = Metrics()
+
+def metrics_dir():
+    """
+    The directory the workers share their metrics through.
+    """
+    default = '/dev/shm/telltrail-metrics' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(),'telltrail-metrics')
+    directory = setting('METRICS_DIR',default)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    return directory
+
+def record_request(request,path,status,duration,size):
+    """
+    Records a finished request, and logs it if it was slow.
+    """
+    _request.active = False
+    endpoint = _request.endpoint or 'unknown'
+    _metrics.record(endpoint,duration,_request.queries,_request.db_time,_request.policies,size)
+    threshold = setting('SLOW_REQUEST_THRESHOLD',None)
+    if threshold and duration >= threshold:
+        log.warning('Slow request to %s (%s): %.3fs, status %d, %d queries in %.3fs, %d policies, %d bytes' %
+                    (path,endpoint,duration,status,_request.queries,_request.db_time,_request.policies,size))
+    _metrics.flush()
+
+# ==============
+# = Middleware =
+# ==============
+
+class MetricsMiddleware(object):
+    """
+    Records wall time, query count, database time, rendered policies and response size for
+    every request, per endpoint.  Goes first in MIDDLEWARE_CLASSES.
+    """
+    def process_request(self,request):
+        for connection in connections.all():
+            install_query_counter(connection)
+        start_request()
+        request.metrics_start = time.time()
+    
+    def process_view(self,request,view_func,view_args,view_kwargs):
+        if getattr(_request,'endpoint',None) is None:
+            handler = getattr(view_func,'handler',None) # piston resources
+            if handler is not None:
+                set_endpoint(handler.__class__.__name__)
+            else:
+                set_endpoint('%s.%s' % (view_func.__module__,getattr(view_func,'__name__',view_func.__class__.__name__)))
+    
+    def process_response(self,request,response):
+        start = getattr(request,'metrics_start',None)
+        if start is None or not getattr(_request,'active',False):
+            return response
+        if response.streaming:
+            response.streaming_content = self.measure_stream(request.path,response.status_code,start,response.streaming_content)
+        else:
+            record_request(request,request.path,response.status_code,time.time() - start,len(response.content))
+        return response
+    
+    def measure_stream(self,path,status,start,content):
+        """
+        Passes the streamed content through, recording the request once the stream is done.
+        """
+        size = 0
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            record_request(None,path,status,time.time() - start,size)
+
+def instrument(endpoint):
+    """
+    Decorator naming the endpoint of a handler method in the metrics, so piston handlers are
+    recorded per method rather than per resource.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args,**kwargs):
+            set_endpoint(endpoint)
+            return method(*args,**kwargs)
+        return wrapper
+    return decorator
+
+# ===========
+# = Scrapes =
+# ===========
+
+def merge(totals,data):
+    """
+    Adds one worker's metrics into the totals.
+    """
+    for endpoint, metrics in data['endpoints'].items():
+        if endpoint not in totals['endpoints']:
+            totals['endpoints'][endpoint] = metrics
+            continue
+        merged = totals['endpoints'][endpoint]
+        for name in ('duration','queries','size'):
+            merged[name] = [[a + b for a, b in zip(merged[name][0],metrics[name][0])],merged[name][1] + metrics[name][1]]
+        merged['db_time'] += metrics['db_time']
+        merged['policies'] += metrics['policies']
+    for name, value in data['counters'].items():
+        totals['counters'][name] = totals['counters'].get(name,0) + value
+    return totals
+
+def pid_alive(pid):
+    """
+    Whether the process is still running.
+    """
+    try:
+        os.kill(pid,0)
+    except OSError:
+        return False
+    return True
+
+def collect():
+    """
+    Merges the metrics of every worker, past and present.  Files of workers that have exited
+    are folded into the archive file under a lock, so concurrent scrapes don't count them twice.
+    """
+    _metrics.flush(force=True)
+    directory = metrics_dir()
+    archive_path = os.path.join(directory,'archive.json')
+    with open(os.path.join(directory,'.lock'),'w') as lock:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            try:
+                with open(archive_path) as f:
+                    archive = json.load(f)
+            except (IOError, ValueError):
+                archive = {'endpoints':{},'counters':{}}
+            totals = json.loads(json.dumps(archive))
+            archived = False
+            for name in os.listdir(directory):
+                if not name.endswith('.json') or name == 'archive.json':
+                    continue
+                path = os.path.join(directory,name)
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (IOError, ValueError):
+                    continue
+                merge(totals,data)
+                if not pid_alive(int(name[:-5])):
+                    merge(archive,data)
+                    os.remove(path)
+                    archived = True
+            if archived:
+                fd, path = tempfile.mkstemp(dir=directory,prefix='.tmp')
+                with os.fdopen(fd,'w') as f:
+                    json.dump(archive,f)
+                os.rename(path,archive_path)
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+    return totals
+
+def histogram_lines(name,label,buckets,counts,total):
+    """
+    Prometheus text lines for a histogram.
+    """
+    lines = []
+    cumulative = 0
+    for bound, count in zip([str(bucket) for bucket in buckets] + ['+Inf'],counts):
+        cumulative += count
+        lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name,label,bound,cumulative))
+    lines.append('%s_sum{endpoint="%s"} %s' % (name,label,repr(float(total))))
+    lines.append('%s_count{endpoint="%s"} %d' % (name,label,cumulative))
+    return lines
+
+def render_prometheus(totals):
+    """
+    Renders merged metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    endpoints = sorted(totals['endpoints'].items())
+    for name, key, buckets, description in (('telltrail_request_duration_seconds','duration',DURATION_BUCKETS,'Request wall time.'),
+                                            ('telltrail_request_queries','queries',QUERY_BUCKETS,'Database queries per request.'),
+                                            ('telltrail_response_size_bytes','size',SIZE_BUCKETS,'Response size.')):
+        lines.append('# HELP %s %s' % (name,description))
+        lines.append('# TYPE %s histogram' % name)
+        for endpoint, metrics in endpoints:
+            lines += histogram_lines(name,endpoint.replace('"','\\"'),buckets,metrics[key][0],metrics[key][1])
+    for name, key, description in (('telltrail_db_seconds_total','db_time','Time spent in the database.'),
+                                   ('telltrail_policies_rendered_total','policies','Rendered policies returned.')):
+        lines.append('# HELP %s %s' % (name,description))
+        lines.append('# TYPE %s counter' % name)
+        for endpoint, metrics in endpoints:
+            lines.append('%s{endpoint="%s"} %s' % (name,endpoint.replace('"','\\"'),repr(float(metrics[key]))))
+    for name, value in sorted(totals['counters'].items()):
+        lines.append('# TYPE telltrail_%s_total counter' % name)
+        lines.append('telltrail_%s_total %s' % (name,repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, only answered for the addresses in METRICS_ALLOWED_IPS.
+    """
+    if request.META.get('REMOTE_ADDR') not in setting('METRICS_ALLOWED_IPS',('127.0.0.1','::1')):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(collect()),content_type='text/plain; version=0.0.4')
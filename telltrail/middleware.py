@@ -0,0 +1,86 @@
+"""
+Middleware for TellTrail.
+"""
+from django.utils.functional import SimpleLazyObject
+import time
+from telltrail.models import CanonicalIdentity
+from telltrail.db.routers import use_replicas, wrote
+from telltrail.api.admission import renew, release
+from telltrail.utils import setting
+
+def get_canonical_identity(request):
+    """
+    Gets the canonical identity of the logged in user, with the user, or None.  Loaded once
+    per request.
+    """
+    if not hasattr(request,'_cached_canonical_identity'):
+        ci = None
+        if request.user.is_authenticated():
+            try:
+                ci = CanonicalIdentity.objects.select_related('user').get(user=request.user)
+            except CanonicalIdentity.DoesNotExist:
+                pass
+        request._cached_canonical_identity = ci
+    return request._cached_canonical_identity
+
+class CanonicalIdentityMiddleware(object):
+    """
+    Adds request.canonical_identity, loaded on first use, for the decorator, views and forms
+    to share.  Goes after AuthenticationMiddleware.
+    """
+    def process_request(self,request):
+        request.canonical_identity = SimpleLazyObject(lambda: get_canonical_identity(request))
+
+class ReplicaMiddleware(object):
+    """
+    Serves GET and HEAD requests, and requests for views marked read_only, from a replica.  A
+    client whose request wrote to the primary is pinned to the primary with a cookie for the
+    next REPLICA_STICKY_SECONDS, so it sees its own writes despite replication lag.  Goes before
+    any middleware that reads the database.
+    """
+    cookie_name = 'telltrail_primary'
+    
+    def pinned(self,request):
+        try:
+            return float(request.COOKIES.get(self.cookie_name,0)) > time.time()
+        except ValueError:
+            return False
+    
+    def process_request(self,request):
+        use_replicas(request.method in ('GET','HEAD') and not self.pinned(request))
+    
+    def process_view(self,request,view_func,view_args,view_kwargs):
+        if getattr(view_func,'read_only',False) and not wrote() and not self.pinned(request):
+            use_replicas(True)
+    
+    def process_response(self,request,response):
+        if wrote() and setting('DATABASE_REPLICAS',[]):
+            window = setting('REPLICA_STICKY_SECONDS',10)
+            response.set_cookie(self.cookie_name,'%d' % (time.time() + window),max_age=window,httponly=True)
+        return response
+
+class AdmissionMiddleware(object):
+    """
+    Releases the admission lease of an API request once its response is done, which for a
+    streaming response is after its last chunk.  Streaming responses renew the lease every
+    third of ADMISSION_LEASE seconds meanwhile, so it doesn't expire while they run.
+    """
+    def process_response(self,request,response):
+        if hasattr(request,'admission_lease'):
+            if response.streaming:
+                response.streaming_content = self.stream(request,response.streaming_content)
+            else:
+                release(request)
+        return response
+    
+    def stream(self,request,content):
+        interval = setting('ADMISSION_LEASE',60) / 3.0
+        renewed = time.time()
+        try:
+            for chunk in content:
+                if time.time() - renewed > interval:
+                    renew(request)
+                    renewed = time.time()
+                yield chunk
+        finally:
+            release(request)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CanonicalIdentity',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('city', models.CharField(max_length=100, null=True)),
+                ('zip_code', models.CharField(max_length=10, null=True)),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL, unique=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='DataConsumer',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=100)),
+                ('domain', models.URLField()),
+                ('letter_grade', models.CharField(default=b'C', max_length=1)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='DataScope',
+            fields=[
+                ('name', models.CharField(max_length=100, serialize=False, primary_key=True)),
+                ('parent', models.ForeignKey(to='telltrail.DataScope', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='DataSource',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('account_name', models.CharField(max_length=100)),
+                ('instance_name', models.CharField(max_length=100)),
+                ('api_key', models.CharField(max_length=100)),
+                ('active', models.BooleanField(default=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Identity',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('identity', models.CharField(max_length=100)),
+                ('profile', models.CharField(max_length=100)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='IdentityClaim',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('claim_confidence', models.IntegerField()),
+                ('canonical_identity', models.ForeignKey(related_name='identity_claims', to='telltrail.CanonicalIdentity')),
+                ('identity', models.ForeignKey(related_name='identity_claims', to='telltrail.Identity')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='PolicyElement',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('default_grant', models.BooleanField(default=True)),
+                ('minimum_grade', models.CharField(max_length=1, null=True)),
+                ('canonical_identity', models.ForeignKey(related_name='policy_elements', to='telltrail.CanonicalIdentity')),
+                ('scope', models.ForeignKey(to='telltrail.DataScope', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='PolicyException',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('grant', models.BooleanField(default=True)),
+                ('canonical_identity', models.ForeignKey(related_name='policy_exceptions', to='telltrail.CanonicalIdentity')),
+                ('consumer', models.ForeignKey(to='telltrail.DataConsumer')),
+                ('scope', models.ForeignKey(to='telltrail.DataScope', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Service',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=100)),
+                ('url', models.URLField(blank=True)),
+                ('verified', models.BooleanField(default=False)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='policyexception',
+            unique_together=set([('canonical_identity', 'consumer', 'scope')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='policyelement',
+            unique_together=set([('canonical_identity', 'scope')]),
+        ),
+        migrations.AddField(
+            model_name='identity',
+            name='service',
+            field=models.ForeignKey(related_name='identities', to='telltrail.Service'),
+            preserve_default=True,
+        ),
+        migrations.AlterUniqueTogether(
+            name='identity',
+            unique_together=set([('service', 'identity')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='datasource',
+            unique_together=set([('account_name', 'instance_name')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dataconsumer',
+            unique_together=set([('name', 'domain')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import json
+import os
+
+def load_initial_data(apps, schema_editor):
+    """
+    Loads the services and data scopes in fixtures/reference_data.json, which Django no longer
+    loads automatically once an app has migrations.  Rows that already exist are left alone.
+    """
+    Service = apps.get_model('telltrail','Service')
+    DataScope = apps.get_model('telltrail','DataScope')
+    fixture = os.path.join(os.path.dirname(os.path.dirname(__file__)),'fixtures','reference_data.json')
+    with open(fixture) as f:
+        data = json.load(f)
+    
+    for item in data:
+        if item['model'] == 'telltrail.service':
+            Service.objects.get_or_create(pk=item['pk'],defaults={'name':item['fields']['name'],'url':item['fields'].get('url','')})
+        elif item['model'] == 'telltrail.datascope':
+            DataScope.objects.get_or_create(name=item['pk'])
+    
+    # parents once every scope exists
+    for item in data:
+        if item['model'] == 'telltrail.datascope' and item['fields'].get('parent'):
+            DataScope.objects.filter(name=item['pk'],parent__isnull=True).update(parent=item['fields']['parent'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(load_initial_data, lambda apps, schema_editor: None),
+    ]
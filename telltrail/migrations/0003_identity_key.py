@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+def fill_identity_keys(apps, schema_editor):
+    """
+    Sets the identity key of every existing identity, in a single statement.
+    """
+    schema_editor.execute('UPDATE telltrail_identity SET identity_key = LOWER(TRIM(identity))')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0002_initial_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identity',
+            name='identity_key',
+            field=models.CharField(default='', max_length=100, editable=False, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_identity_keys, lambda apps, schema_editor: None),
+    ]
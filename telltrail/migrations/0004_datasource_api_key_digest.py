@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import hashlib
+
+def fill_api_key_digests(apps, schema_editor):
+    """
+    Sets the api key digest of every existing data source.
+    """
+    DataSource = apps.get_model('telltrail','DataSource')
+    for source in DataSource.objects.all():
+        source.api_key_digest = hashlib.sha256(source.api_key.encode('utf-8')).hexdigest()
+        source.save(update_fields=['api_key_digest'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0003_identity_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='api_key_digest',
+            field=models.CharField(default='', max_length=64, editable=False, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_api_key_digests, lambda apps, schema_editor: None),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0004_datasource_api_key_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='canonicalidentity',
+            name='policy_modified',
+            field=models.DateTimeField(null=True, editable=False, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='identity',
+            name='claims_modified',
+            field=models.DateTimeField(null=True, editable=False, db_index=True),
+            preserve_default=True,
+        ),
+    ]
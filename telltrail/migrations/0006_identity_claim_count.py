@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count, Sum
+
+
+def count_claims(apps, schema_editor):
+    Identity = apps.get_model('telltrail', 'Identity')
+    IdentityClaim = apps.get_model('telltrail', 'IdentityClaim')
+    counts = IdentityClaim.objects.values('identity').annotate(count=Count('pk'), total=Sum('claim_confidence'))
+    for row in counts.iterator():
+        Identity.objects.filter(pk=row['identity']).update(claim_count=row['count'], claim_confidence_total=row['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0005_modified_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identity',
+            name='claim_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='identity',
+            name='claim_confidence_total',
+            field=models.IntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(count_claims, lambda apps, schema_editor: None),
+    ]
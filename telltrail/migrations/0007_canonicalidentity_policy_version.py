@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0006_identity_claim_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='canonicalidentity',
+            name='policy_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import json
+import os
+
+def fill_profile_keys(apps, schema_editor):
+    """
+    Takes the case rules of the initial services from fixtures/reference_data.json, then sets
+    the profile key of every existing identity.
+    """
+    from telltrail.models import profile_key
+    Service = apps.get_model('telltrail','Service')
+    Identity = apps.get_model('telltrail','Identity')
+    fixture = os.path.join(os.path.dirname(os.path.dirname(__file__)),'fixtures','reference_data.json')
+    with open(fixture) as f:
+        data = json.load(f)
+    for item in data:
+        if item['model'] == 'telltrail.service' and item['fields'].get('case_insensitive_profiles'):
+            Service.objects.filter(pk=item['pk'],name=item['fields']['name']).update(case_insensitive_profiles=True)
+    
+    case_rules = dict(Service.objects.values_list('pk','case_insensitive_profiles'))
+    for pk, service_id, profile in Identity.objects.values_list('pk','service','profile').iterator():
+        Identity.objects.filter(pk=pk).update(profile_key=profile_key(profile,case_rules[service_id]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0008_policychange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='service',
+            name='case_insensitive_profiles',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='identity',
+            name='profile_key',
+            field=models.CharField(default='', max_length=32, editable=False, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_profile_keys, lambda apps, schema_editor: None),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0009_identity_profile_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='burst_limit',
+            field=models.PositiveIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='datasource',
+            name='concurrency_limit',
+            field=models.PositiveIntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='datasource',
+            name='rate_limit',
+            field=models.FloatField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def count_grades(apps, schema_editor):
+    Identity = apps.get_model('telltrail', 'Identity')
+    IdentityClaim = apps.get_model('telltrail', 'IdentityClaim')
+    grades = (
+        ('high_confidence_claims', IdentityClaim.objects.filter(claim_confidence__gte=75)),
+        ('medium_confidence_claims', IdentityClaim.objects.filter(claim_confidence__gte=50, claim_confidence__lt=75)),
+        ('low_confidence_claims', IdentityClaim.objects.filter(claim_confidence__lt=50)),
+    )
+    for field, claims in grades:
+        for row in claims.values('identity').annotate(count=Count('pk')).iterator():
+            Identity.objects.filter(pk=row['identity']).update(**{field: row['count']})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telltrail', '0010_datasource_admission_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='identity',
+            name='high_confidence_claims',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='identity',
+            name='medium_confidence_claims',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='identity',
+            name='low_confidence_claims',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(count_grades, lambda apps, schema_editor: None),
+    ]
@@ -1,8 +1,13 @@
 """
 Models for TellTrail.
 """
-from django.db import models
+from django.db import models, connection
+from django.db.models import F
 from django.contrib.auth.models import User
+from telltrail.scopes import scope_index, reset_scope_index
+from itertools import chain
+import hashlib
+import re
 
 class CanonicalIdentityManager(models.Manager):
     """
@@ -20,6 +25,64 @@ class CanonicalIdentityManager(models.Manager):
         if there is more than one claim on the identity.
         """
         return IdentityClaim.objects.get(identity=identity).canonical_identity
+    
+    def render_policies(self,canonical_identities):
+        """
+        Renders the policies of many canonical identities at once.  Accepts CanonicalIdentity
+        objects or primary keys, and returns a dictionary of rendered policies keyed by primary key.
+        The number of queries is fixed, no matter how many identities are rendered.
+        """
+        return dict((pk,policy) for pk, (version, policy) in self.render_versioned_policies(canonical_identities).items())
+    
+    def render_versioned_policies(self,canonical_identities):
+        """
+        Renders policies as render_policies does, as (policy version, policy) pairs.  Versions are
+        read before the rest of the policy, so a policy is never older than its version.
+        """
+        pks = set(getattr(ci,'pk',ci) for ci in canonical_identities)
+        if not pks:
+            return {}
+        
+        canonical_identities = list(self.filter(pk__in=pks).select_related('user'))
+        
+        claims = dict((pk,[]) for pk in pks)
+        for claim in IdentityClaim.objects.filter(canonical_identity__in=pks).select_related('identity__service').order_by('pk'):
+            claims[claim.canonical_identity_id].append(claim)
+        
+        default_policies = {}
+        specific_policies = dict((pk,[]) for pk in pks)
+        for element in PolicyElement.objects.filter(canonical_identity__in=pks).order_by('pk'):
+            if element.scope_id is None:
+                default_policies[element.canonical_identity_id] = element
+            else:
+                specific_policies[element.canonical_identity_id].append(element)
+        
+        # Identities without a default policy get an unsaved one, as from CanonicalIdentity.default_policy
+        for pk in pks.difference(default_policies):
+            default_policies[pk] = PolicyElement(canonical_identity_id=pk,scope=None,default_grant=True,minimum_grade='C')
+        
+        policy_exceptions = dict((pk,[]) for pk in pks)
+        # Services and consumers are joined rather than taken from the reference data registry,
+        # which other processes refresh later than the policy versions move on
+        for policy_exception in PolicyException.objects.filter(canonical_identity__in=pks).select_related('consumer').order_by('pk'):
+            policy_exceptions[policy_exception.canonical_identity_id].append(policy_exception)
+        
+        # A scope added since the scope index was loaded means the index is stale
+        scope_paths = scope_index().paths
+        scope_ids = set(element.scope_id for elements in chain(specific_policies.values(),policy_exceptions.values()) for element in elements)
+        scope_ids.discard(None)
+        if not scope_ids.issubset(scope_paths):
+            reset_scope_index()
+            scope_paths = scope_index().paths
+        
+        policies = {}
+        for ci in canonical_identities:
+            policies[ci.pk] = (ci.policy_version,ci.build_policy(claims[ci.pk],
+                                                                 default_policies[ci.pk],
+                                                                 policy_exceptions[ci.pk],
+                                                                 specific_policies[ci.pk],
+                                                                 scope_paths))
+        return policies
 
 class CanonicalIdentity(models.Model):
     """
@@ -28,22 +91,34 @@ class CanonicalIdentity(models.Model):
     user = models.ForeignKey(User,unique=True)
     city = models.CharField(null=True, max_length=100)
     zip_code = models.CharField(null=True, max_length=10)
+    policy_modified = models.DateTimeField(null=True, db_index=True, editable=False) # when anything in the rendered policy last changed
+    policy_version = models.PositiveIntegerField(default=1, editable=False) # moved on with policy_modified
     
     objects = CanonicalIdentityManager()
     
     def __unicode__(self):
         return self.user.username
     
+    def save(self,*args,**kwargs):
+        """
+        The policy version and modified time are only written by telltrail.snapshot.touch_policies,
+        so saving an identity loaded before a policy change doesn't move its version back.
+        """
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in ('policy_modified','policy_version')]
+        super(CanonicalIdentity,self).save(*args,**kwargs)
+    
     @property
     def default_policy(self):
         """
-        Gets the default policy.
+        Gets the default policy.  Identities without one, from before default policies were
+        created at sign up, get an unsaved one, which is saved when it is first edited.
         """
-        policy, created = self.policy_elements.get_or_create(scope__isnull=True)
-        if created:
-            policy.minimum_grade = 'C'
-            policy.save()
-        return policy
+        try:
+            return self.policy_elements.get(scope__isnull=True)
+        except PolicyElement.DoesNotExist:
+            return PolicyElement(canonical_identity=self,scope=None,default_grant=True,minimum_grade='C')
     
     @property
     def specific_policies(self):
@@ -52,10 +127,45 @@ class CanonicalIdentity(models.Model):
         """
         return self.policy_elements.filter(scope__isnull=False)
     
+    @property
+    def fragment_version(self):
+        """
+        The version of the cached control panel lists of this identity.
+        """
+        from telltrail.fragments import fragment_version
+        return fragment_version(self.pk)
+    
+    def claim_list(self):
+        """
+        Identity claims for the control panel, with identities and services.
+        """
+        return list(self.identity_claims.select_related('identity__service').order_by('pk'))
+    
+    def exception_list(self):
+        """
+        Policy exceptions for the control panel, with consumers and scopes.
+        """
+        return list(self.policy_exceptions.select_related('consumer','scope').order_by('pk'))
+    
+    def specific_policy_list(self):
+        """
+        Specific policies for the control panel, with scopes.
+        """
+        return list(self.specific_policies.select_related('scope').order_by('pk'))
+    
     def render_policy(self):
         """
         Renders the policy into a structure suitable for JSON serialization.
         """
+        return CanonicalIdentity.objects.render_policies([self])[self.pk]
+    
+    def build_policy(self,claims,default_policy,policy_exceptions,specific_policies,scope_paths):
+        """
+        Builds the rendered policy from already loaded claims (with identities and services),
+        policy elements and exceptions (with consumers), as render_policies loads them.  Scope paths map scope names to the 
+        full path of the scope.  Sends no queries of its own beyond the user, which callers
+        should select_related.
+        """
         # Personal Info
         policy = {'username':self.user.username,'first_name':self.user.first_name,'last_name':self.user.last_name}
         if self.city:
@@ -65,7 +175,7 @@ class CanonicalIdentity(models.Model):
         
         # Identities
         identities = []
-        for claim in self.identity_claims.all():
+        for claim in claims:
             rendered_identity = {'identity':claim.identity.identity,
                                  'service':claim.identity.service.name,
                                  'profile':claim.identity.profile,
@@ -74,28 +184,27 @@ class CanonicalIdentity(models.Model):
         policy['identities'] = identities
         
         # Default Policy
-        default_policy = self.default_policy
         policy['default_grant'] = default_policy.default_grant
         policy['minimum_grade'] = default_policy.minimum_grade
         
         # Exceptions
         exceptions = []
-        for policy_exception in self.policy_exceptions.all():
+        for policy_exception in policy_exceptions:
             rendered_exception = {'grant':policy_exception.grant,
                                   'consumer':{'name':policy_exception.consumer.name,'domain':policy_exception.consumer.domain}}
-            if policy_exception.scope:
-                rendered_exception['scope'] = unicode(policy_exception.scope)
+            if policy_exception.scope_id:
+                rendered_exception['scope'] = scope_paths[policy_exception.scope_id]
             exceptions.append(rendered_exception)
         policy['exceptions'] = exceptions
         
         
         # Specific Policies
-        specific_policies = []
-        for specific_policy in self.specific_policies:
-            specific_policies.append({'scope':unicode(specific_policy.scope),
-                                      'grant':specific_policy.default_grant,
-                                      'minimum_grade':specific_policy.minimum_grade})
-        policy['specific_policies'] = specific_policies
+        rendered_specific_policies = []
+        for specific_policy in specific_policies:
+            rendered_specific_policies.append({'scope':scope_paths[specific_policy.scope_id],
+                                               'grant':specific_policy.default_grant,
+                                               'minimum_grade':specific_policy.minimum_grade})
+        policy['specific_policies'] = rendered_specific_policies
         
         return policy
 
@@ -106,21 +215,169 @@ class Service(models.Model):
     name = models.CharField(unique=True, max_length=100)
     url = models.URLField(blank=True,)
     verified = models.BooleanField(default=False)
+    case_insensitive_profiles = models.BooleanField(default=False) # whether profile URL paths ignore case, as at Twitter
     
     def __unicode__(self):
         return self.name
 
+SCHEME = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*://')
+
+def normalize_profile(profile,case_insensitive=False):
+    """
+    The normalized form of a profile URL: without its scheme or a trailing slash, with the host
+    lower cased, and the path too if the service's profile URLs ignore case.
+    """
+    host, slash, path = SCHEME.sub('',profile.strip()).partition('/')
+    path = path.rstrip('/')
+    if case_insensitive:
+        path = path.lower()
+    return host.lower() + ('/' + path if path else '')
+
+def profile_key(profile,case_insensitive=False):
+    """
+    The hashed, normalized profile URL stored in Identity.profile_key, or '' for no profile.
+    Keys of case insensitive profiles can't collide with case sensitive ones.
+    """
+    normalized = normalize_profile(profile,case_insensitive)
+    if not normalized:
+        return ''
+    return hashlib.md5((u'%s:%s' % ('i' if case_insensitive else 's',normalized)).encode('utf-8')).hexdigest()
+
+def profile_lookup_keys(profile):
+    """
+    The keys a profile URL may be stored under, whichever service it belongs to.
+    """
+    return [key for key in (profile_key(profile),profile_key(profile,True)) if key]
+
+def claim_confidence(claim_count):
+    """
+    The confidence of a new claim on an identity that already has claim_count claims.
+    """
+    return min(100 / claim_count,75) if claim_count else 75
+
+CONFIDENCE_GRADES = (('high',75),('medium',50),('low',None)) # grade, least confidence
+
+def confidence_grade(confidence):
+    """
+    The grade of a claim's confidence: high for 75 or more, as the first two claims on an
+    identity get, medium for 50 or more, as the third gets, otherwise low.
+    """
+    return next(grade for grade, least in CONFIDENCE_GRADES if least is None or confidence >= least)
+
+def grade_counter(grade):
+    """
+    The Identity field counting claims of the confidence grade.
+    """
+    return '%s_confidence_claims' % grade
+
+CLAIM_COUNTERS = ('claim_count','claim_confidence_total') + tuple(grade_counter(grade) for grade, least in CONFIDENCE_GRADES)
+
+class IdentityManager(models.Manager):
+    """
+    Manager class for Identity.
+    """
+    def count_claims(self,identity_id,confidence,claims=1):
+        """
+        Adds claims of the confidence (negative claims when they are deleted) to the identity's
+        claim counters, in the database so concurrent claims don't lose counts.
+        """
+        counter = grade_counter(confidence_grade(confidence))
+        return self.filter(pk=identity_id).update(**{'claim_count':F('claim_count') + claims,
+                                                     'claim_confidence_total':F('claim_confidence_total') + claims * confidence,
+                                                     counter:F(counter) + claims})
+    
+    def rekey_profiles(self,service):
+        """
+        Brings the profile keys of the service's identities up to date with its case rule.
+        Returns the ids of the identities whose key changed.
+        """
+        changed = []
+        for pk, profile, key in self.filter(service=service).values_list('pk','profile','profile_key').iterator():
+            new_key = profile_key(profile,service.case_insensitive_profiles)
+            if new_key != key:
+                changed.append((pk,new_key))
+        for pk, new_key in changed:
+            self.filter(pk=pk).update(profile_key=new_key)
+        return [pk for pk, new_key in changed]
+    
+    def reconcile_claim_counts(self,identity_ids=None):
+        """
+        Recounts the claims of the identities, or of every identity, repairing counters that
+        have drifted.  Returns the number of identities repaired.
+        """
+        identity_table = connection.ops.quote_name(self.model._meta.db_table)
+        claim_table = connection.ops.quote_name(IdentityClaim._meta.db_table)
+        claims = 'FROM %s c WHERE c.identity_id = %s.id' % (claim_table,identity_table)
+        counters = [('claim_count','(SELECT COUNT(*) %s)' % claims),
+                    ('claim_confidence_total','(SELECT COALESCE(SUM(c.claim_confidence),0) %s)' % claims)]
+        upper = None
+        for grade, least in CONFIDENCE_GRADES:
+            bounds = ''.join([' AND c.claim_confidence >= %d' % least if least is not None else '',
+                              ' AND c.claim_confidence < %d' % upper if upper is not None else ''])
+            counters.append((grade_counter(grade),'(SELECT COUNT(*) %s%s)' % (claims,bounds)))
+            upper = least
+        sql = 'UPDATE %s SET %s WHERE (%s)' % (identity_table,
+                                                ', '.join('%s = %s' % counter for counter in counters),
+                                                ' OR '.join('%s <> %s' % counter for counter in counters))
+        params = []
+        if identity_ids is not None:
+            identity_ids = list(identity_ids)
+            if not identity_ids:
+                return 0
+            sql += ' AND id IN (%s)' % ','.join(['%s'] * len(identity_ids))
+            params = identity_ids
+        cursor = connection.cursor()
+        cursor.execute(sql,params)
+        return cursor.rowcount
+
 class Identity(models.Model):
     """
     An identity at a service.
     """
     service = models.ForeignKey(Service,related_name='identities')
     identity = models.CharField(max_length=100)
+    identity_key = models.CharField(max_length=100, db_index=True, editable=False) # lower cased identity, for case insensitive lookups
     profile = models.CharField(max_length=100)
+    profile_key = models.CharField(max_length=32, db_index=True, editable=False) # hashed, normalized profile, for indexed lookups
+    claims_modified = models.DateTimeField(null=True, db_index=True, editable=False) # when the identity or its claims last changed
+    claim_count = models.PositiveIntegerField(default=0, editable=False) # kept by the IdentityClaim signals
+    claim_confidence_total = models.IntegerField(default=0, editable=False) # sum of the claims' confidence
+    high_confidence_claims = models.PositiveIntegerField(default=0, editable=False) # claims by confidence grade, see confidence_grade
+    medium_confidence_claims = models.PositiveIntegerField(default=0, editable=False)
+    low_confidence_claims = models.PositiveIntegerField(default=0, editable=False)
+    
+    objects = IdentityManager()
     
     def __unicode__(self):
         return '%s@%s' (unicode(self.identity),unicode(self.service))
     
+    def save(self,*args,**kwargs):
+        """
+        Keeps the identity and profile keys in step with the identity and profile.  The claim
+        counters are only written by count_claims, so saving an identity loaded before a claim
+        was made doesn't undo it.
+        """
+        self.identity_key = self.identity.strip().lower()
+        self.profile_key = profile_key(self.profile,self.service.case_insensitive_profiles)
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in CLAIM_COUNTERS]
+        super(Identity,self).save(*args,**kwargs)
+    
+    @property
+    def confidence_distribution(self):
+        """
+        The number of claims on this identity of each confidence grade, by grade.
+        """
+        return dict((grade,getattr(self,grade_counter(grade))) for grade, least in CONFIDENCE_GRADES)
+    
+    @property
+    def next_claim_confidence(self):
+        """
+        The confidence of another claim on this identity.
+        """
+        return claim_confidence(self.claim_count)
+    
     class Meta:
         unique_together = (('service','identity'),)
 
@@ -155,7 +412,10 @@ class DataScope(models.Model):
     parent = models.ForeignKey('self',null=True)
     
     def __unicode__(self):
-        if self.parent:
+        index = scope_index()
+        if self.name in index and index.parents[self.name] == self.parent_id:
+            return index.path(self.name)
+        elif self.parent:
             return '%s : %s' % (unicode(self.parent),self.name)
         else:
             return self.name
@@ -184,6 +444,14 @@ class PolicyException(models.Model):
     class Meta:
         unique_together = (('canonical_identity','consumer','scope'),)
 
+class PolicyChange(models.Model):
+    """
+    An entry in the append-only log of policy changes, which data sources read through the
+    change feed.  Written by telltrail.changes.log_changes.
+    """
+    canonical_identity_id = models.IntegerField(db_index=True) # not a foreign key, so deletions are logged too
+    changed = models.DateTimeField(db_index=True)
+
 class DataSource(models.Model):
     """
     A source of data.
@@ -191,10 +459,22 @@ class DataSource(models.Model):
     account_name = models.CharField(max_length=100)
     instance_name = models.CharField(max_length=100)
     api_key = models.CharField(max_length=100)
+    api_key_digest = models.CharField(max_length=64, db_index=True, editable=False) # sha256 of the api key, for indexed lookups
     active = models.BooleanField(default=True)
+    rate_limit = models.FloatField(null=True, blank=True) # identities looked up per second, or the ADMISSION_RATE setting
+    burst_limit = models.PositiveIntegerField(null=True, blank=True) # identities looked up at once, or the ADMISSION_BURST setting
+    concurrency_limit = models.PositiveIntegerField(null=True, blank=True) # requests in progress, or the ADMISSION_CONCURRENCY setting
     
     def __unicode__(self):
         return '%s:%s' % (self.account_name,self.instance_name)
     
+    def save(self,*args,**kwargs):
+        """
+        Keeps the api key digest in step with the api key.
+        """
+        from telltrail.api.authentication import digest_key
+        self.api_key_digest = digest_key(self.api_key)
+        super(DataSource,self).save(*args,**kwargs)
+    
     class Meta:
         unique_together = (('account_name','instance_name'),)
@@ -0,0 +1,126 @@
+"""
+In-memory registry of reference data: services, data consumers and data scopes.
+
+These tables are small, rarely change, and are needed by every control panel dialog and
+identity lookup, so each process keeps them in memory.  Rendered policies still join them,
+since a policy's version moves on at once when one changes, and the registry in other
+processes only later.  The registry is loaded when the WSGI
+application is, so under gunicorn --preload the master loads it once and the workers inherit
+it when they fork.
+
+The registry carries the generation of reference data it was loaded at.  Changes through the
+ORM reset the registry in the process that made them and bump the generation in the default
+cache, which other processes check every REFERENCE_DATA_CHECK_INTERVAL seconds.  Registries
+are also reloaded once they are older than the REFERENCE_DATA_TIMEOUT setting, for caches
+that aren't shared between processes.
+"""
+from django.core.cache import caches
+from django.db import connections, DatabaseError
+from threading import Lock
+import time
+from telltrail.utils import setting
+
+GENERATION_KEY = 'telltrail:reference:generation'
+
+class ReferenceData(object):
+    """
+    All services, data consumers and data scopes, in pk order, and by pk.
+    """
+    def __init__(self,generation):
+        from telltrail.models import Service, DataConsumer, DataScope
+        self.generation = generation
+        self.services = list(Service.objects.order_by('pk'))
+        self.consumers = list(DataConsumer.objects.order_by('pk'))
+        self.scopes = list(DataScope.objects.order_by('pk'))
+        self.by_pk = {}
+        for kind in ('services','consumers','scopes'):
+            self.by_pk[kind] = dict((obj.pk,obj) for obj in getattr(self,kind))
+        self.service_ids = dict((service.name.lower(),service.pk) for service in self.services)
+        self.loaded = self.checked = time.time()
+    
+    def get(self,kind,pk):
+        """
+        The service, consumer or scope (as kind is 'services', 'consumers' or 'scopes') with the
+        pk, or None if there isn't one.  The objects are shared, and must not be changed.
+        """
+        return self.by_pk[kind].get(pk)
+    
+    def covers(self,kind,pks):
+        """
+        Whether the registry has every one of the pks of the kind.
+        """
+        return set(pks).issubset(self.by_pk[kind])
+
+_reference_data = None
+_lock = Lock()
+
+def reference_generation():
+    """
+    The current generation of reference data, shared through the default cache.
+    """
+    cache = caches['default']
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY,int(time.time() * 1000),None)
+        generation = cache.get(GENERATION_KEY,0)
+    return generation
+
+def reference_data():
+    """
+    Gets the process-wide registry, loading it with a query per table when there is none or
+    it is out of date.
+    """
+    global _reference_data
+    data = _reference_data
+    now = time.time()
+    if data is not None and now - data.checked > setting('REFERENCE_DATA_CHECK_INTERVAL',2):
+        data.checked = now
+        if now - data.loaded > setting('REFERENCE_DATA_TIMEOUT',60) or reference_generation() != data.generation:
+            data = None
+    if data is None:
+        with _lock:
+            data = ReferenceData(reference_generation())
+            _reference_data = data
+    return data
+
+def current_reference_data(kind,pks):
+    """
+    Gets the registry, reloading it if it lacks any of the pks of the kind, which reference
+    data added since it was loaded would.
+    """
+    data = reference_data()
+    if not data.covers(kind,pks):
+        reset_reference_data()
+        data = reference_data()
+    return data
+
+def reset_reference_data():
+    """
+    Drops the registry, so the next use reloads it.
+    """
+    global _reference_data
+    _reference_data = None
+
+def reference_data_changed():
+    """
+    Drops the registry and moves the shared generation on, so every process reloads.
+    """
+    reset_reference_data()
+    cache = caches['default']
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY,int(time.time() * 1000),None)
+
+def preload_reference_data():
+    """
+    Loads the registry before the workers fork, then closes the database and cache
+    connections used, which the workers mustn't share.
+    """
+    try:
+        reference_data()
+    except DatabaseError:
+        pass # the workers load it on first use instead
+    for connection in connections.all():
+        connection.close()
+    caches['default'].close()
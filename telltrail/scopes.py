@@ -0,0 +1,70 @@
+"""
+In-memory index of the DataScope hierarchy.
+"""
+from threading import Lock
+import time
+from telltrail.utils import setting
+
+class ScopeIndex(object):
+    """
+    The full path, ancestors and descendants of every scope, built from a map of scope names
+    to parent names.
+    """
+    def __init__(self,parents):
+        self.parents = parents
+        self.paths = {}
+        self.ancestors = {}
+        self.descendants = dict((name,set()) for name in parents)
+        for name in parents:
+            ancestors = []
+            parent = parents[name]
+            while parent:
+                ancestors.append(parent)
+                self.descendants[parent].add(name)
+                parent = parents.get(parent)
+            self.ancestors[name] = ancestors
+            self.paths[name] = ' : '.join(reversed([name] + ancestors))
+        self.loaded = time.time()
+    
+    def __contains__(self,name):
+        return name in self.parents
+    
+    def path(self,name):
+        """
+        The full path of the scope, as in 'Entertainment : Books'.
+        """
+        return self.paths[name]
+    
+    def chain(self,name):
+        """
+        The scopes governing the named scope, from the scope itself up through its ancestors,
+        ending with None for all data.  The chain for None is just [None].
+        """
+        if name is None:
+            return [None]
+        return [name] + self.ancestors[name] + [None]
+
+_scope_index = None
+_lock = Lock()
+
+def scope_index():
+    """
+    Gets the process-wide scope index, loading it with a single query the first time.  Changes
+    to DataScope rebuild the index in the process that made them, and other processes reload
+    it once it is older than the SCOPE_INDEX_TIMEOUT setting.
+    """
+    global _scope_index
+    index = _scope_index
+    if index is None or time.time() - index.loaded > setting('SCOPE_INDEX_TIMEOUT',60):
+        from telltrail.models import DataScope
+        with _lock:
+            index = ScopeIndex(dict(DataScope.objects.values_list('name','parent')))
+            _scope_index = index
+    return index
+
+def reset_scope_index():
+    """
+    Drops the scope index, so the next use reloads it.
+    """
+    global _scope_index
+    _scope_index = None
@@ -42,11 +42,15 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'telltrail.metrics.MetricsMiddleware',
+    'telltrail.middleware.ReplicaMiddleware',
+    'telltrail.middleware.AdmissionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'telltrail.middleware.CanonicalIdentityMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -83,6 +87,137 @@ if LOCAL_DB:
 else:
     DATABASES['default'] = dj_database_url.config()
 
+# Read replicas, as database URLs separated by commas.  Read-only requests are routed to them
+# (see telltrail.db.routers), except for clients that wrote in the last REPLICA_STICKY_SECONDS.
+REPLICA_DATABASE_URLS = [url.strip() for url in os.environ.get('REPLICA_DATABASE_URLS','').split(',') if url.strip()]
+DATABASE_REPLICAS = []
+for n, url in enumerate(REPLICA_DATABASE_URLS):
+    DATABASES['replica_%d' % n] = dj_database_url.parse(url)
+    DATABASE_REPLICAS.append('replica_%d' % n)
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ['telltrail.db.routers.ReplicaRouter']
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS',10))
+
+# Postgres connections come from a bounded per-worker pool (see telltrail.db.pool)
+DB_POOL = os.environ.get('DB_POOL','true').lower() in ('true','1','yes')
+for database in DATABASES.values():
+    if DB_POOL and database.get('ENGINE') == 'django.db.backends.postgresql_psycopg2':
+        database['ENGINE'] = 'telltrail.db.backends.postgresql_pool'
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE',5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT',10))
+DB_POOL_CHECK_INTERVAL = float(os.environ.get('DB_POOL_CHECK_INTERVAL',30))
+DB_POOL_MAX_AGE = float(os.environ.get('DB_POOL_MAX_AGE',600))
+
+# Caching
+# POLICY_CACHE_BACKEND is telltrail.cache.LRUPolicyCache for a per-worker LRU cache, or
+# telltrail.cache.SharedPolicyCache to use the Django cache named by POLICY_CACHE_ALIAS, the
+# default when memcached is configured.  Either way cached policies are checked against the
+# current policy versions, so a change made in one worker is never served stale by another.
+# Rendered control panel fragments are only cached, in the 'fragments' cache, when memcached is
+# shared by every worker, since their versions are bumped by whichever worker made a change.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+MEMCACHED_LOCATION = os.environ.get('MEMCACHED_LOCATION',None)
+if MEMCACHED_LOCATION:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': MEMCACHED_LOCATION,
+        },
+        'fragments': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': MEMCACHED_LOCATION,
+            'KEY_PREFIX': 'fragments',
+        },
+    }
+
+POLICY_CACHE_BACKEND = os.environ.get('POLICY_CACHE_BACKEND','telltrail.cache.SharedPolicyCache' if MEMCACHED_LOCATION else 'telltrail.cache.LRUPolicyCache')
+POLICY_CACHE_ALIAS = 'default'
+POLICY_CACHE_SIZE = int(os.environ.get('POLICY_CACHE_SIZE',10000))
+POLICY_CACHE_TIMEOUT = int(os.environ.get('POLICY_CACHE_TIMEOUT',30))
+
+# Policy snapshot
+# A snapshot compiled with the compile_snapshot command (say from cron) is shared by the API
+# workers when SNAPSHOT_PATH is set.  Changes since it was compiled are answered from the
+# database, and once there are more than SNAPSHOT_MAX_CHANGES the snapshot isn't used at all,
+# so recompile it often.
+
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH',None)
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get('SNAPSHOT_CHECK_INTERVAL',2))
+SNAPSHOT_MAX_CHANGES = int(os.environ.get('SNAPSHOT_MAX_CHANGES',100000))
+
+# Reference data
+# Services, consumers and scopes are kept in memory by every process.  Changes elsewhere are
+# noticed within REFERENCE_DATA_CHECK_INTERVAL seconds through the default cache, or within
+# REFERENCE_DATA_TIMEOUT seconds when that cache isn't shared.
+
+REFERENCE_DATA_CHECK_INTERVAL = float(os.environ.get('REFERENCE_DATA_CHECK_INTERVAL',2))
+REFERENCE_DATA_TIMEOUT = float(os.environ.get('REFERENCE_DATA_TIMEOUT',60))
+
+# Policy change feed
+# Data sources page through /api/<key>/changes/.  Changes younger than CHANGE_FEED_DELAY seconds
+# wait for a later page, so none are skipped while transactions commit.  The
+# compact_policy_changes command drops changes older than POLICY_CHANGE_RETENTION_DAYS, so
+# sources must read the feed more often than that.
+
+CHANGE_FEED_PAGE_SIZE = int(os.environ.get('CHANGE_FEED_PAGE_SIZE',500))
+CHANGE_FEED_DELAY = float(os.environ.get('CHANGE_FEED_DELAY',5))
+POLICY_CHANGE_RETENTION_DAYS = int(os.environ.get('POLICY_CHANGE_RETENTION_DAYS',30))
+
+# Audience index
+# Each worker keeps an audience index, built when the WSGI application loads if AUDIENCE_PRELOAD
+# is set (under gunicorn --preload, once in the master), and brought up to date from the policy
+# change log every AUDIENCE_CHECK_INTERVAL seconds.
+
+AUDIENCE_PRELOAD = os.environ.get('AUDIENCE_PRELOAD','true').lower() in ('true','1','yes')
+AUDIENCE_CHECK_INTERVAL = float(os.environ.get('AUDIENCE_CHECK_INTERVAL',2))
+
+# Admission control
+# Each data source may look up ADMISSION_RATE identities a second, ADMISSION_BURST at once, with
+# ADMISSION_CONCURRENCY requests in progress, unless its own limits say otherwise.  Workers share
+# the buckets through the file at ADMISSION_PATH.
+
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL','true').lower() in ('true','1','yes')
+ADMISSION_PATH = os.environ.get('ADMISSION_PATH','/dev/shm/telltrail-admission' if os.path.isdir('/dev/shm') else '/tmp/telltrail-admission')
+ADMISSION_RATE = float(os.environ.get('ADMISSION_RATE',1000))
+ADMISSION_BURST = int(os.environ.get('ADMISSION_BURST',10000))
+ADMISSION_CONCURRENCY = int(os.environ.get('ADMISSION_CONCURRENCY',4))
+ADMISSION_LEASE = float(os.environ.get('ADMISSION_LEASE',60))
+
+# Metrics
+# Workers share request metrics through files in METRICS_DIR, scraped from /metrics.  Requests
+# slower than SLOW_REQUEST_THRESHOLD seconds are logged, if it is set.
+
+METRICS_DIR = os.environ.get('METRICS_DIR','/dev/shm/telltrail-metrics' if os.path.isdir('/dev/shm') else '/tmp/telltrail-metrics')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL',5))
+METRICS_ALLOWED_IPS = ('127.0.0.1','::1')
+SLOW_REQUEST_THRESHOLD = float(os.environ['SLOW_REQUEST_THRESHOLD']) if 'SLOW_REQUEST_THRESHOLD' in os.environ else None
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'telltrail': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 
@@ -0,0 +1,168 @@
+"""
+Signal receivers for TellTrail.
+"""
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+from telltrail.models import *
+from telltrail.cache import invalidate_policies, invalidate_all_policies
+from telltrail.scopes import scope_index, reset_scope_index
+from telltrail.audiences import update_audiences, reset_audience_index
+from telltrail.fragments import bump_fragment_versions, bump_all_fragment_versions
+from telltrail.reference import reference_data_changed
+from telltrail.snapshot import touch_policies, touch_identities
+from telltrail.api.authentication import revoke_cached_sources
+
+# ===========================
+# = Rendered policy changes =
+# ===========================
+
+def policies_changed(canonical_identity_ids):
+    """
+    Invalidates the cached policies of the canonical identities, and marks them modified so
+    the policy snapshot isn't used for them.
+    """
+    canonical_identity_ids = list(canonical_identity_ids)
+    invalidate_policies(canonical_identity_ids)
+    touch_policies(canonical_identity_ids)
+
+@receiver([post_save,post_delete],sender=CanonicalIdentity)
+def canonical_identity_changed(sender,instance,**kwargs):
+    """
+    The canonical identity's own policy changed.
+    """
+    policies_changed([instance.pk])
+    update_audiences([instance.pk])
+
+POLICY_USER_FIELDS = frozenset(['username','first_name','last_name']) # the personal info in policies
+
+@receiver([post_save,post_delete],sender=User)
+def user_changed(sender,instance,**kwargs):
+    """
+    Personal info in the policy of the user's canonical identity changed.  Saves of other
+    fields only, such as the last_login update at every login, leave the policy alone.
+    """
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and not POLICY_USER_FIELDS.intersection(update_fields):
+        return
+    policies_changed(CanonicalIdentity.objects.filter(user=instance).values_list('pk',flat=True))
+
+@receiver([post_save,post_delete],sender=IdentityClaim)
+@receiver([post_save,post_delete],sender=PolicyElement)
+@receiver([post_save,post_delete],sender=PolicyException)
+def policy_part_changed(sender,instance,**kwargs):
+    """
+    A claim, policy element or exception belonging to a canonical identity changed.
+    """
+    policies_changed([instance.canonical_identity_id])
+    bump_fragment_versions([instance.canonical_identity_id])
+    if sender is IdentityClaim:
+        touch_identities([instance.identity_id])
+    else:
+        update_audiences([instance.canonical_identity_id])
+
+@receiver(pre_save,sender=IdentityClaim)
+def claim_saving(sender,instance,**kwargs):
+    """
+    Notes the identity and confidence an existing claim was counted with.
+    """
+    instance._counted = IdentityClaim.objects.filter(pk=instance.pk).values_list('identity','claim_confidence').first() if instance.pk else None
+
+@receiver(post_save,sender=IdentityClaim)
+def claim_saved(sender,instance,created,**kwargs):
+    """
+    Counts a new claim on its identity, or moves a changed claim's count and confidence.
+    """
+    counted = getattr(instance,'_counted',None)
+    if counted is None:
+        Identity.objects.count_claims(instance.identity_id,instance.claim_confidence)
+    elif counted != (instance.identity_id,instance.claim_confidence):
+        Identity.objects.count_claims(counted[0],counted[1],-1)
+        Identity.objects.count_claims(instance.identity_id,instance.claim_confidence)
+
+@receiver(post_delete,sender=IdentityClaim)
+def claim_deleted(sender,instance,**kwargs):
+    """
+    Uncounts a deleted claim.  When the identity itself was deleted there's nothing to update.
+    """
+    Identity.objects.count_claims(instance.identity_id,instance.claim_confidence,-1)
+
+@receiver(post_save,sender=Identity)
+def identity_changed(sender,instance,**kwargs):
+    """
+    An identity changed, affecting every canonical identity with a claim on it.  Deleted
+    identities take their claims with them, which are handled by policy_part_changed.
+    """
+    canonical_identity_ids = list(instance.identity_claims.values_list('canonical_identity',flat=True))
+    policies_changed(canonical_identity_ids)
+    bump_fragment_versions(canonical_identity_ids)
+    touch_identities([instance.pk])
+
+@receiver([post_save,post_delete],sender=DataConsumer)
+def consumer_changed(sender,instance,**kwargs):
+    """
+    A data consumer changed, so the reference data registry is reloaded.  A saved consumer
+    affects every canonical identity with an exception for it.  Deleted consumers take their
+    exceptions with them, which are handled by policy_part_changed.
+    """
+    reference_data_changed()
+    if kwargs['signal'] is post_save:
+        canonical_identity_ids = list(PolicyException.objects.filter(consumer=instance).values_list('canonical_identity',flat=True))
+        policies_changed(canonical_identity_ids)
+        bump_fragment_versions(canonical_identity_ids)
+
+@receiver([post_save,post_delete],sender=DataScope)
+def scope_changed(sender,instance,**kwargs):
+    """
+    A data scope changed.  The scope index and reference data registry are rebuilt, and since scope paths appear in policies
+    throughout and scope changes are rare, every cached policy goes, and so do the
+    audience index and cached control panel lists.  Policies naming the scope or one of its
+    descendants, whose paths may have changed, move on to new versions.  Deleted scopes take
+    their elements and exceptions with them, which are handled by policy_part_changed.
+    """
+    reset_scope_index()
+    reference_data_changed()
+    reset_audience_index()
+    invalidate_all_policies()
+    bump_all_fragment_versions()
+    if kwargs['signal'] is post_save:
+        scopes = set([instance.name]).union(scope_index().descendants.get(instance.name,()))
+        canonical_identity_ids = set(PolicyElement.objects.filter(scope__in=scopes).values_list('canonical_identity',flat=True))
+        canonical_identity_ids.update(PolicyException.objects.filter(scope__in=scopes).values_list('canonical_identity',flat=True))
+        touch_policies(canonical_identity_ids)
+
+# ==================
+# = Reference data =
+# ==================
+
+@receiver(pre_save,sender=Service)
+def service_saving(sender,instance,**kwargs):
+    """
+    Notes whether the service's profile case rule is changing.
+    """
+    instance._case_rule_changed = Service.objects.filter(pk=instance.pk).exclude(case_insensitive_profiles=instance.case_insensitive_profiles).exists()
+
+@receiver([post_save,post_delete],sender=Service)
+def service_changed(sender,instance,**kwargs):
+    """
+    A service changed, so the reference data registry is reloaded, and lists of identities show the
+    new name, as do the policies of every canonical identity claiming an identity at the service.
+    A new profile case rule re-keys the service's identities.
+    """
+    reference_data_changed()
+    bump_all_fragment_versions()
+    if kwargs['signal'] is post_save:
+        if getattr(instance,'_case_rule_changed',False):
+            touch_identities(Identity.objects.rekey_profiles(instance))
+        policies_changed(IdentityClaim.objects.filter(identity__service=instance).values_list('canonical_identity',flat=True).distinct())
+
+# ================
+# = Data sources =
+# ================
+
+@receiver([post_save,post_delete],sender=DataSource)
+def source_changed(sender,instance,**kwargs):
+    """
+    A data source changed, perhaps deactivated or given a new key, so cached sources are revoked.
+    """
+    revoke_cached_sources()
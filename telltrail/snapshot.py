@@ -0,0 +1,400 @@
+"""
+Compiled policy snapshots for TellTrail.
+
+compile_snapshot writes every canonical identity's rendered policy, and the profile and
+(service, identity) lookup tables, into one binary file.  API workers mmap the file read-only,
+so every process shares the same pages and a freshly started worker answers from it at once.
+A newer file moved into place is picked up within SNAPSHOT_CHECK_INTERVAL seconds.
+
+Anything changed since the snapshot was compiled is answered from the database instead.
+Workers learn what changed from CanonicalIdentity.policy_modified and Identity.claims_modified,
+and a snapshot compiled against different scopes or services is not used at all.  A lookup key
+is only answered from the snapshot if none of the canonical identities it lists has changed,
+since an identity whose profile or name changed, or which was deleted, leaves its old keys
+behind in the snapshot, and its claimants' policies change with it.
+
+The changes are read incrementally, but accumulate until a newer snapshot is compiled, so
+snapshots should be recompiled often.  Once more than SNAPSHOT_MAX_CHANGES have accumulated
+the snapshot is no longer used.
+
+The file is laid out as a header, three sorted indexes, then the data they point into:
+
+header          HEADER: magic, format, compiled at (ms), reference data digest, and the
+                count and offset of each index, then the offset of the data
+policy index    (canonical identity pk, offset, length, policy version) of the policy as
+                JSON, by pk
+profile index   (key hash, offset) of each lookup entry, by hash, keyed by Identity.profile_key
+identity index  likewise, keyed by '<service pk>:<identity key>'
+
+Each lookup entry is the key's length and UTF-8 bytes, then the number of canonical identity
+pks claiming it and the pks, in claim order.
+"""
+from django.db.models import F
+from django.utils import timezone
+from datetime import datetime, timedelta
+from threading import Lock
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import time
+from telltrail.utils import setting, chunked
+
+MAGIC = 'TTSNAP'
+FORMAT = 3
+HEADER = struct.Struct('<6sHQ16sQQQQQQQ')
+POLICY_RECORD = struct.Struct('<QQII')
+LOOKUP_RECORD = struct.Struct('<QQ')
+KEY_LENGTH = struct.Struct('<H')
+COUNT = struct.Struct('<I')
+
+def key_hash(key):
+    """
+    64 bit hash of a lookup key.
+    """
+    return struct.unpack('<Q',hashlib.md5(key).digest()[:8])[0]
+
+def identity_lookup_key(service_id,identity_key):
+    """
+    The lookup key of an identity, as its service pk and normalized identity.
+    """
+    return (u'%d:%s' % (service_id,identity_key)).encode('utf-8')
+
+def profile_lookup_key(profile_key):
+    """
+    The lookup key of a profile, as its Identity.profile_key.
+    """
+    return profile_key.encode('ascii')
+
+def reference_digest():
+    """
+    Digest of the reference data that appears in rendered policies and lookups, the scope
+    hierarchy and the service names and case rules.  Canonical identities and identities aren't
+    marked modified when these change.
+    """
+    from telltrail.models import Service
+    from telltrail.scopes import scope_index
+    digest = hashlib.md5()
+    digest.update(json.dumps(sorted(scope_index().parents.items())))
+    digest.update(json.dumps(sorted(Service.objects.values_list('pk','name','case_insensitive_profiles'))))
+    return digest.digest()
+
+def to_millis(dt):
+    return int((dt - datetime(1970,1,1,tzinfo=timezone.utc)).total_seconds() * 1000)
+
+def from_millis(millis):
+    return datetime.utcfromtimestamp(millis / 1000.0).replace(tzinfo=timezone.utc)
+
+# =============
+# = Compiling =
+# =============
+
+def compile_snapshot(path,chunk_size=None):
+    """
+    Compiles a snapshot of every policy and lookup into the file at path, replacing it
+    atomically.  Returns the number of policies written.
+    """
+    from telltrail.models import CanonicalIdentity, IdentityClaim
+    chunk_size = chunk_size or setting('SNAPSHOT_CHUNK_SIZE',2000)
+    compiled_at = timezone.now() # anything modified from here on is overlaid from the database
+    digest = reference_digest()
+    directory = os.path.dirname(os.path.abspath(path))
+    
+    with tempfile.TemporaryFile(dir=directory) as data:
+        policy_records = []
+        pks = list(CanonicalIdentity.objects.order_by('pk').values_list('pk',flat=True))
+        for chunk in chunked(pks,chunk_size):
+            policies = CanonicalIdentity.objects.render_versioned_policies(chunk)
+            for pk in chunk:
+                if pk in policies:
+                    version, policy = policies[pk]
+                    encoded = json.dumps(policy,separators=(',',':'))
+                    policy_records.append((pk,data.tell(),len(encoded),version))
+                    data.write(encoded)
+        
+        profiles = {}
+        identities = {}
+        claims = IdentityClaim.objects.order_by('pk').values_list('identity__profile_key','identity__service','identity__identity_key','canonical_identity')
+        for profile_key, service_id, identity_key, canonical_identity_id in claims.iterator():
+            if profile_key:
+                profiles.setdefault(profile_lookup_key(profile_key),[]).append(canonical_identity_id)
+            identities.setdefault(identity_lookup_key(service_id,identity_key),[]).append(canonical_identity_id)
+        profile_records = write_lookups(data,profiles)
+        identity_records = write_lookups(data,identities)
+        
+        fd, temp_path = tempfile.mkstemp(dir=directory,prefix='.snapshot')
+        with os.fdopen(fd,'wb') as f:
+            policy_offset = HEADER.size
+            profile_offset = policy_offset + POLICY_RECORD.size * len(policy_records)
+            identity_offset = profile_offset + LOOKUP_RECORD.size * len(profile_records)
+            data_offset = identity_offset + LOOKUP_RECORD.size * len(identity_records)
+            f.write(HEADER.pack(MAGIC,FORMAT,to_millis(compiled_at),digest,
+                                len(policy_records),policy_offset,
+                                len(profile_records),profile_offset,
+                                len(identity_records),identity_offset,
+                                data_offset))
+            for record in policy_records:
+                f.write(POLICY_RECORD.pack(*record))
+            for record in sorted(profile_records):
+                f.write(LOOKUP_RECORD.pack(*record))
+            for record in sorted(identity_records):
+                f.write(LOOKUP_RECORD.pack(*record))
+            data.seek(0)
+            while True:
+                block = data.read(1 << 20)
+                if not block:
+                    break
+                f.write(block)
+        os.chmod(temp_path,0644)
+        os.rename(temp_path,path)
+    return len(policy_records)
+
+def write_lookups(data,lookups):
+    """
+    Writes the lookup entries to the data file, returning their index records.
+    """
+    records = []
+    for key, canonical_identity_ids in lookups.items():
+        records.append((key_hash(key),data.tell()))
+        data.write(KEY_LENGTH.pack(len(key)) + key + COUNT.pack(len(canonical_identity_ids)))
+        data.write(struct.pack('<%dI' % len(canonical_identity_ids),*canonical_identity_ids))
+    return records
+
+# ===========
+# = Reading =
+# ===========
+
+class Snapshot(object):
+    """
+    A compiled snapshot, mapped read-only into memory.
+    """
+    def __init__(self,path):
+        with open(path,'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.map = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        (magic, format, compiled_at, self.digest,
+         self.policy_count, self.policy_offset,
+         self.profile_count, self.profile_offset,
+         self.identity_count, self.identity_offset,
+         self.data_offset) = HEADER.unpack_from(self.map,0)
+        if magic != MAGIC or format != FORMAT:
+            raise ValueError('%s is not a policy snapshot in format %d.' % (path,FORMAT))
+        self.compiled_at = from_millis(compiled_at)
+    
+    def search(self,record,offset,count,value):
+        """
+        Binary search of a sorted index for the first record starting with value.  Returns its
+        position, which is count if every record is smaller.
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if record.unpack_from(self.map,offset + middle * record.size)[0] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    
+    def policy(self,canonical_identity_id):
+        """
+        The (policy version, rendered policy) of the canonical identity, or None if it isn't in
+        the snapshot.
+        """
+        position = self.search(POLICY_RECORD,self.policy_offset,self.policy_count,canonical_identity_id)
+        if position < self.policy_count:
+            pk, offset, length, version = POLICY_RECORD.unpack_from(self.map,self.policy_offset + position * POLICY_RECORD.size)
+            if pk == canonical_identity_id:
+                start = self.data_offset + offset
+                return version, json.loads(self.map[start:start + length])
+        return None
+    
+    def lookup(self,offset,count,key):
+        """
+        The canonical identity pks for the key in a lookup index, or [] if nothing claims it.
+        """
+        value = key_hash(key)
+        position = self.search(LOOKUP_RECORD,offset,count,value)
+        while position < count:
+            record_hash, entry = LOOKUP_RECORD.unpack_from(self.map,offset + position * LOOKUP_RECORD.size)
+            if record_hash != value:
+                break
+            start = self.data_offset + entry
+            length = KEY_LENGTH.unpack_from(self.map,start)[0]
+            if self.map[start + KEY_LENGTH.size:start + KEY_LENGTH.size + length] == key:
+                start += KEY_LENGTH.size + length
+                found = COUNT.unpack_from(self.map,start)[0]
+                return list(struct.unpack_from('<%dI' % found,self.map,start + COUNT.size))
+            position += 1
+        return []
+    
+    def profile(self,profile_key):
+        return self.lookup(self.profile_offset,self.profile_count,profile_lookup_key(profile_key))
+    
+    def identity(self,service_id,identity_key):
+        return self.lookup(self.identity_offset,self.identity_count,identity_lookup_key(service_id,identity_key))
+
+class SnapshotState(object):
+    """
+    The snapshot a worker is using, with what has changed since it was compiled.
+    """
+    def __init__(self,snapshot):
+        self.snapshot = snapshot
+        self.usable = False
+        self.canonical_identity_ids = set()
+        self.identity_keys = set()
+        self.profile_keys = set()
+        self.refreshed = None
+        self.checked = 0
+    
+    def refresh(self):
+        """
+        Loads what has changed since the last refresh, or since the snapshot was compiled.
+        Changes are read from the CHANGE_FEED_DELAY setting before the last refresh, as a
+        transaction committing late may have marked them modified earlier.
+        """
+        from telltrail.models import CanonicalIdentity, Identity
+        self.usable = reference_digest() == self.snapshot.digest
+        if self.usable:
+            now = timezone.now()
+            since = self.snapshot.compiled_at
+            if self.refreshed is not None:
+                since = max(since,self.refreshed - timedelta(seconds=setting('CHANGE_FEED_DELAY',5)))
+            self.canonical_identity_ids.update(CanonicalIdentity.objects.filter(policy_modified__gte=since).values_list('pk',flat=True))
+            for service_id, identity_key, profile_key in Identity.objects.filter(claims_modified__gte=since).values_list('service','identity_key','profile_key'):
+                self.identity_keys.add((identity_key,service_id))
+                self.profile_keys.add(profile_key)
+            self.refreshed = now
+            if len(self.canonical_identity_ids) + len(self.identity_keys) > setting('SNAPSHOT_MAX_CHANGES',100000):
+                self.usable = False # too much has changed, until a newer snapshot is compiled
+        self.checked = time.time()
+    
+    def unchanged(self,canonical_identity_ids):
+        """
+        The canonical identity pks of a lookup entry, or None if any of them has changed.
+        """
+        return None if self.canonical_identity_ids.intersection(canonical_identity_ids) else canonical_identity_ids
+
+_state = None
+_lock = Lock()
+
+def snapshot_state():
+    """
+    Gets the worker's snapshot state, or None if there is no usable snapshot at the
+    SNAPSHOT_PATH setting.  The snapshot file and what has changed since it was compiled are
+    checked at most every SNAPSHOT_CHECK_INTERVAL seconds.
+    """
+    global _state
+    path = setting('SNAPSHOT_PATH',None)
+    if not path:
+        return None
+    state = _state
+    if state is None or time.time() - state.checked > setting('SNAPSHOT_CHECK_INTERVAL',2):
+        with _lock:
+            if _state is state:
+                state = load_state(path,state)
+                _state = state
+            state = _state
+    return state if state and state.usable else None
+
+def load_state(path,state):
+    """
+    Swaps in a newer snapshot file if one has appeared, and refreshes what has changed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if state is None or (stat.st_ino,stat.st_mtime) != (state.snapshot.stat.st_ino,state.snapshot.stat.st_mtime):
+        state = SnapshotState(Snapshot(path))
+    state.refresh()
+    return state
+
+def mark_modified(canonical_identity_ids=(),identities=()):
+    """
+    Notes canonical identities and (service pk, identity key, profile key) identities changed by
+    this worker, so its snapshot overlay covers them before the next check.
+    """
+    state = _state
+    if state is not None:
+        state.canonical_identity_ids.update(canonical_identity_ids)
+        for service_id, identity_key, profile_key in identities:
+            state.identity_keys.add((identity_key,service_id))
+            state.profile_keys.add(profile_key)
+
+def touch_policies(canonical_identity_ids):
+    """
+    Marks the policies of the canonical identities modified, moving their policy versions on,
+    and logs the change for the change feed.
+    """
+    from telltrail.models import CanonicalIdentity
+    from telltrail.changes import log_changes
+    pks = list(set(canonical_identity_ids))
+    if pks:
+        now = timezone.now()
+        CanonicalIdentity.objects.filter(pk__in=pks).update(policy_modified=now,policy_version=F('policy_version') + 1)
+        log_changes(pks,now)
+        mark_modified(canonical_identity_ids=pks)
+
+def touch_identities(identity_ids):
+    """
+    Marks the identities, and so their claims, modified.
+    """
+    from telltrail.models import Identity
+    pks = list(set(identity_ids))
+    if pks:
+        identities = Identity.objects.filter(pk__in=pks)
+        identities.update(claims_modified=timezone.now())
+        mark_modified(identities=identities.values_list('service','identity_key','profile_key'))
+
+def snapshot_policies(canonical_identity_ids,versions=None):
+    """
+    The (policy version, rendered policy) pairs of the canonical identities that are unchanged
+    in the snapshot, as a dictionary keyed by pk.  Given the current policy versions, keyed by
+    pk, only policies of those versions are used.
+    """
+    state = snapshot_state()
+    if state is None:
+        return {}
+    policies = {}
+    for pk in canonical_identity_ids:
+        if versions is not None or pk not in state.canonical_identity_ids:
+            policy = state.snapshot.policy(pk)
+            if policy is not None and (versions is None or policy[0] == versions.get(pk)):
+                policies[pk] = policy
+    return policies
+
+def snapshot_profiles(profiles):
+    """
+    Maps the profiles unchanged in the snapshot to the canonical identity pks claiming them,
+    under any of their keys.  Profiles claimed by a changed canonical identity are left out.
+    """
+    from telltrail.models import profile_lookup_keys
+    state = snapshot_state()
+    if state is None:
+        return {}
+    found = {}
+    for profile in profiles:
+        keys = profile_lookup_keys(profile)
+        if not state.profile_keys.intersection(keys):
+            pks = state.unchanged([pk for key in keys for pk in state.snapshot.profile(key)])
+            if pks is not None:
+                found[profile] = pks
+    return found
+
+def snapshot_identities(keys):
+    """
+    Maps (identity key, service pk) pairs unchanged in the snapshot to the canonical identity
+    pks claiming them.  Pairs claimed by a changed canonical identity are left out.
+    """
+    state = snapshot_state()
+    if state is None:
+        return {}
+    found = {}
+    for key in keys:
+        if key not in state.identity_keys:
+            pks = state.unchanged(state.snapshot.identity(key[1],key[0]))
+            if pks is not None:
+                found[key] = pks
+    return found
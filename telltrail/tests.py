@@ -0,0 +1,646 @@
+"""
+Tests for TellTrail.
+"""
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.test import TestCase, RequestFactory
+from django.test.client import Client
+from django.test.utils import override_settings
+from telltrail.models import *
+from telltrail.cache import get_policies, policy_cache
+from telltrail.decisions import decide_many
+from telltrail.audiences import AudienceIndex, audience_index, reset_audience_index
+from telltrail.snapshot import touch_policies, compile_snapshot, snapshot_state, snapshot_policies
+from telltrail.lookups import resolve_profiles, resolve_identities
+from telltrail import snapshot
+from telltrail.api.emitters import FastJSONEmitter
+from piston.emitters import JSONEmitter
+from telltrail.imports import import_identities, ProgressFile
+from telltrail.fragments import fragment_version
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+import tempfile
+import time
+
+@override_settings(CHANGE_FEED_DELAY=0.001,ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class ChangeFeedTest(TestCase):
+    """
+    The policy change feed at /api/<key>/changes/.
+    """
+    def setUp(self):
+        self.source = DataSource.objects.create(account_name='test',instance_name='test',api_key='abc123')
+        self.ci = CanonicalIdentity.objects.create(user=User.objects.create(username='someone'))
+        self.consumer = DataConsumer.objects.create(name='Shop',domain='http://shop.com')
+        self.policy_exception = PolicyException.objects.create(canonical_identity=self.ci,consumer=self.consumer,grant=False)
+        self.client = Client()
+    
+    def read_feed(self,since=0):
+        time.sleep(0.01) # past the feed delay
+        return json.loads(self.client.get('/api/abc123/changes/?since=%d' % since).content)
+    
+    def test_change_not_hidden_by_stale_cache(self):
+        """
+        A change is fed with the new policy even where another worker still caches the old one.
+        """
+        cursor = self.read_feed()['cursor']
+        version = CanonicalIdentity.objects.get(pk=self.ci.pk).policy_version
+        stale = get_policies([self.ci.pk])[self.ci.pk]
+        self.assertFalse(stale['exceptions'][0]['grant'])
+        
+        self.policy_exception.grant = True
+        self.policy_exception.save()
+        policy_cache().set_many({self.ci.pk:(version,stale)}) # as another worker would still hold it
+        
+        feed = self.read_feed(cursor)
+        self.assertEqual([change['id'] for change in feed['changes']],[self.ci.pk])
+        self.assertTrue(feed['changes'][0]['policy']['exceptions'][0]['grant'])
+    
+    def test_login_not_fed(self):
+        """
+        Logging in changes no policy, but changing personal info in one does.
+        """
+        cursor = self.read_feed()['cursor']
+        user = self.ci.user
+        user_logged_in.send(sender=User,request=None,user=user) # which saves last_login alone
+        self.assertEqual(self.read_feed(cursor)['changes'],[])
+        
+        user.first_name = 'Some'
+        user.save()
+        self.assertEqual([change['id'] for change in self.read_feed(cursor)['changes']],[self.ci.pk])
+    
+    def test_deleted_identity(self):
+        """
+        A deleted canonical identity is fed as deleted.
+        """
+        cursor = self.read_feed()['cursor']
+        pk = self.ci.pk
+        self.ci.delete()
+        feed = self.read_feed(cursor)
+        self.assertEqual(feed['changes'],[{'id':pk,'deleted':True}])
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class PolicyCacheTest(TestCase):
+    """
+    Caching rendered policies in get_policies.
+    """
+    def setUp(self):
+        self.ci = CanonicalIdentity.objects.create(user=User.objects.create(username='someone'))
+        policy_cache().clear()
+    
+    def test_stale_version_counts_as_miss(self):
+        """
+        A cached policy of an old policy version is rendered again, and counted as a miss.
+        """
+        get_policies([self.ci.pk])
+        cache = policy_cache()
+        hits, misses = cache.hits, cache.misses
+        get_policies([self.ci.pk])
+        self.assertEqual((cache.hits - hits,cache.misses - misses),(1,0))
+        
+        touch_policies([self.ci.pk])
+        cache.set_many({self.ci.pk:(0,{'stale':True})})
+        policy = get_policies([self.ci.pk])[self.ci.pk]
+        self.assertNotIn('stale',policy)
+        self.assertEqual((cache.hits - hits,cache.misses - misses),(1,1))
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class DecisionTest(TestCase):
+    """
+    Access decisions, in decide_many and at /api/<key>/decisions/.
+    """
+    def setUp(self):
+        self.source = DataSource.objects.create(account_name='test',instance_name='test',api_key='abc123')
+        self.ci = CanonicalIdentity.objects.create(user=User.objects.create(username='someone'))
+        self.consumer = DataConsumer.objects.create(name='Shop',domain='http://shop.com')
+        self.other = DataConsumer.objects.create(name='Store',domain='http://store.com')
+        self.identity = Identity.objects.create(service=Service.objects.get(name='Twitter'),identity='someone',profile='http://twitter.com/someone')
+        IdentityClaim.objects.create(canonical_identity=self.ci,identity=self.identity,claim_confidence=75)
+        PolicyElement.objects.create(canonical_identity=self.ci,scope_id='Entertainment',default_grant=False)
+        PolicyElement.objects.create(canonical_identity=self.ci,scope_id='Books',default_grant=True)
+        self.client = Client()
+    
+    def decide(self,scope,consumer=None,pks=None):
+        return decide_many([(pks or [self.ci.pk],consumer or self.consumer,scope)])[0]
+    
+    def test_nearest_element(self):
+        """
+        The element on the scope or its nearest ancestor applies, then the default policy.
+        """
+        self.assertTrue(self.decide('Books'))
+        self.assertFalse(self.decide('Music'))
+        self.assertFalse(self.decide('Entertainment'))
+        self.assertTrue(self.decide('News'))
+        self.assertTrue(self.decide(None))
+        self.assertEqual(self.decide('Nonsense'),None)
+    
+    def test_minimum_grade(self):
+        """
+        An element with a minimum grade grants only consumers at least as good.
+        """
+        PolicyElement.objects.create(canonical_identity=self.ci,scope_id='News',minimum_grade='B')
+        self.assertFalse(self.decide('Headlines'))
+        self.consumer.letter_grade = 'A'
+        self.assertTrue(self.decide('Headlines'))
+    
+    def test_exceptions(self):
+        """
+        The consumer's exception on the scope or its nearest ancestor overrides the elements.
+        """
+        PolicyException.objects.create(canonical_identity=self.ci,consumer=self.consumer,scope_id='Entertainment',grant=True)
+        PolicyException.objects.create(canonical_identity=self.ci,consumer=self.consumer,scope_id='Books',grant=False)
+        self.assertTrue(self.decide('Music'))
+        self.assertFalse(self.decide('Books'))
+        self.assertTrue(self.decide(None))
+        self.assertTrue(self.decide('Books',consumer=self.other))
+        self.assertFalse(self.decide('Music',consumer=self.other))
+        
+        PolicyException.objects.create(canonical_identity=self.ci,consumer=self.other,grant=False)
+        self.assertFalse(self.decide('Books',consumer=self.other))
+        self.assertFalse(self.decide('News',consumer=self.other))
+    
+    def test_contested_identity(self):
+        """
+        A query about several canonical identities is permitted only if all of them permit it.
+        """
+        other = CanonicalIdentity.objects.create(user=User.objects.create(username='someone_else'))
+        PolicyElement.objects.create(canonical_identity=other,scope_id='Books',default_grant=False)
+        self.assertTrue(self.decide('Books',pks=[self.ci.pk]))
+        self.assertFalse(self.decide('Books',pks=[self.ci.pk,other.pk]))
+        self.assertEqual(decide_many([([],self.consumer,'Books'),([self.ci.pk],None,'Books')]),[None,None])
+    
+    def test_handler(self):
+        """
+        Queries are answered by POST in bulk, or one by GET, and malformed queries are refused.
+        """
+        queries = [
+            {'profile':'http://twitter.com/someone','consumer':'Shop','domain':'http://shop.com','scope':'Books'},
+            {'identity':'someone@@Twitter','consumer':'Shop','domain':'http://shop.com','scope':'Entertainment : Music'},
+            {'identity':'someone@@Twitter','consumer':'Shop','domain':'http://shop.com'},
+            {'identity':'nobody@@Twitter','consumer':'Shop','domain':'http://shop.com'},
+            {'profile':'http://twitter.com/someone','consumer':'Nobody','domain':'http://nobody.com'},
+        ]
+        response = self.client.post('/api/abc123/decisions/',json.dumps({'queries':queries}),content_type='application/json')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(json.loads(response.content)['decisions'],[True,False,True,None,None])
+        
+        response = self.client.get('/api/abc123/decisions/',queries[1])
+        self.assertEqual(json.loads(response.content)['decisions'],[False])
+        
+        for body in ({'queries':[['profile']]},{'queries':{'profile':'x'}},{'queries':[{'profile':1}]},{}):
+            response = self.client.post('/api/abc123/decisions/',json.dumps(body),content_type='application/json')
+            self.assertEqual(response.status_code,400)
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None,BULK_LOOKUP_CHUNK_SIZE=2)
+class BulkLookupTest(TestCase):
+    """
+    Bulk policy lookups, POSTed as JSON to /api/<key>/policy/.
+    """
+    def setUp(self):
+        self.source = DataSource.objects.create(account_name='test',instance_name='test',api_key='abc123')
+        self.twitter = Service.objects.get(name='Twitter')
+        self.cis = []
+        for i in range(3):
+            ci = CanonicalIdentity.objects.create(user=User.objects.create(username='user%d' % i))
+            identity = Identity.objects.create(service=self.twitter,identity='User%d' % i,profile='http://twitter.com/user%d' % i)
+            IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=75)
+            self.cis.append(ci)
+        self.client = Client()
+    
+    def lookup(self,lookups):
+        return self.client.post('/api/abc123/policy/',json.dumps(lookups),content_type='application/json')
+    
+    def owners(self,policies):
+        return [policy['username'] for policy in policies]
+    
+    def test_results_keyed_by_input(self):
+        """
+        Profiles are answered by profile, and identity entries in order, across chunks.
+        """
+        profiles = ['http://twitter.com/user%d' % i for i in range(3)] + ['http://twitter.com/nobody']
+        identities = [{'service':'twitter','identity':'user2'},{'service':'Twitter','identity':'User0'},{'service':'Twitter','identity':'nobody'}]
+        response = self.lookup({'profiles':profiles,'identities':identities})
+        self.assertEqual(response.status_code,200)
+        results = json.loads(response.content)
+        self.assertEqual(sorted(results['profiles'].keys()),sorted(profiles))
+        for i in range(3):
+            self.assertEqual(self.owners(results['profiles']['http://twitter.com/user%d' % i]),['user%d' % i])
+        self.assertEqual(results['profiles']['http://twitter.com/nobody'],[])
+        self.assertEqual([(entry['service'],entry['identity']) for entry in results['identities']],[('twitter','user2'),('Twitter','User0'),('Twitter','nobody')])
+        self.assertEqual([self.owners(entry['policies']) for entry in results['identities']],[['user2'],['user0'],[]])
+    
+    def test_malformed_entries(self):
+        """
+        Malformed identity entries are answered with errors in place, and malformed lookups refused.
+        """
+        identities = [{'service':'Twitter'},'User0@@Twitter',{'service':'Twitter','identity':'User1'}]
+        results = json.loads(self.lookup({'identities':identities}).content)
+        self.assertEqual(results.keys(),['identities'])
+        self.assertEqual([entry.get('lookup') for entry in results['identities']],[identities[0],identities[1],None])
+        self.assertTrue(results['identities'][0]['error'])
+        self.assertEqual(self.owners(results['identities'][2]['policies']),['user1'])
+        
+        for lookups in ({'profiles':[1]},{'profiles':'http://twitter.com/user0'},{'identities':{}},[]):
+            self.assertEqual(self.lookup(lookups).status_code,400)
+        with self.settings(BULK_LOOKUP_LIMIT=2):
+            self.assertEqual(self.lookup({'profiles':['a','b','c']}).status_code,400)
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None,STREAM_CHUNK_SIZE=1)
+class PolicyLookupTest(TestCase):
+    """
+    Policy lookups by the four lookup variables at /api/<key>/policy/.
+    """
+    def setUp(self):
+        self.source = DataSource.objects.create(account_name='test',instance_name='test',api_key='abc123')
+        twitter = Service.objects.get(name='Twitter')
+        facebook = Service.objects.get(name='Facebook')
+        self.ci = CanonicalIdentity.objects.create(user=User.objects.create(username='someone'))
+        self.other = CanonicalIdentity.objects.create(user=User.objects.create(username='someone_else'))
+        for ci, service, name in ((self.ci,twitter,'someone'),(self.ci,facebook,'someone'),(self.other,twitter,'else')):
+            identity = Identity.objects.create(service=service,identity=name,profile='%s/%s' % (service.url,name))
+            IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=75)
+        self.query = 'profile=http://twitter.com/someone&profile_list=http://twitter.com/someone,http://facebook.com/someone,http://twitter.com/else&identity_list=someone@@Twitter,nonsense'
+        self.client = Client()
+    
+    def check_policies(self,policies):
+        self.assertEqual([policy.get('username') for policy in policies],['someone','someone_else',None])
+        self.assertEqual(policies[0]['matched_by'],{'profiles':['http://twitter.com/someone','http://facebook.com/someone'],'identities':['someone@@Twitter']})
+        self.assertEqual(policies[1]['matched_by'],{'profiles':['http://twitter.com/else'],'identities':[]})
+        self.assertEqual(policies[2]['identity'],'nonsense')
+        self.assertTrue(policies[2]['error'])
+    
+    def test_each_policy_once(self):
+        """
+        A person matched by several inputs gets one policy, recording the inputs that matched it.
+        """
+        response = self.client.get('/api/abc123/policy/?' + self.query)
+        self.assertEqual(response.status_code,200)
+        self.check_policies(json.loads(response.content))
+    
+    def test_ndjson(self):
+        """
+        Streamed lookups are deduplicated just the same, however they are chunked.
+        """
+        response = self.client.get('/api/abc123/policy/?format=ndjson&' + self.query)
+        self.assertEqual(response['Content-Type'],'application/x-ndjson')
+        lines = ''.join(response.streaming_content).splitlines()
+        self.check_policies([json.loads(line) for line in lines])
+
+@override_settings(CHANGE_FEED_DELAY=0.001,ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class AudienceIndexTest(TestCase):
+    """
+    The audience index, and keeping it up to date without rebuilding it.
+    """
+    def setUp(self):
+        reset_audience_index()
+        self.consumer = DataConsumer.objects.create(name='Shop',domain='http://shop.com')
+        self.cis = [CanonicalIdentity.objects.create(user=User.objects.create(username='user%d' % i)) for i in range(3)]
+    
+    def tearDown(self):
+        reset_audience_index()
+    
+    def test_catch_up(self):
+        """
+        Changes logged by other processes are applied by catching up with the change log.
+        """
+        index = AudienceIndex.build() # not this process's index, so its signals don't update it
+        self.assertEqual(index.count(self.consumer,'Books'),3)
+        PolicyElement.objects.create(canonical_identity=self.cis[0],scope_id='Entertainment',default_grant=False)
+        PolicyException.objects.create(canonical_identity=self.cis[1],consumer=self.consumer,grant=False)
+        self.assertEqual(index.count(self.consumer,'Books'),3)
+        
+        time.sleep(0.01) # past the feed delay
+        self.assertTrue(index.catch_up())
+        self.assertEqual(index.count(self.consumer,'Books'),1)
+        self.assertEqual(index.count(self.consumer,'News'),2)
+        self.assertEqual([index.permits(self.consumer,'Books',ci.pk) for ci in self.cis],[False,False,True])
+    
+    def test_rebuilt_only_when_stale(self):
+        """
+        The process's index is kept while it can catch up, and rebuilt once it can't.
+        """
+        with self.settings(AUDIENCE_CHECK_INTERVAL=0.001):
+            index = audience_index()
+            time.sleep(0.01)
+            self.assertIs(audience_index(),index)
+            index.caught_up -= timedelta(days=31)
+            time.sleep(0.01)
+            self.assertIsNot(audience_index(),index)
+
+class Interrupted(Exception):
+    """
+    Stands in for an import killed part way through.
+    """
+    pass
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class ImportTest(TestCase):
+    """
+    Bulk identity imports, and resuming them.
+    """
+    def setUp(self):
+        self.rows = [{'user':'user%d' % i,'service':'Twitter','identity':'User%d' % i,'profile':'http://twitter.com/user%d' % i} for i in range(5)]
+        self.path = os.path.join(tempfile.mkdtemp(),'import.progress')
+    
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+    
+    def claims(self):
+        return sorted(IdentityClaim.objects.values_list('canonical_identity__user__username','identity__identity'))
+    
+    def test_resume(self):
+        """
+        An interrupted import resumes after the last committed chunk, claiming nothing twice.
+        """
+        progress = ProgressFile(self.path)
+        def interrupt(done):
+            progress(done)
+            raise Interrupted()
+        self.assertRaises(Interrupted,import_identities,self.rows,chunk_size=2,progress=interrupt)
+        self.assertEqual(progress.read(),2)
+        self.assertEqual(self.claims(),[('user0','User0'),('user1','User1')])
+        
+        totals = import_identities(self.rows,chunk_size=2,start=progress.read(),progress=progress)
+        self.assertEqual((totals['rows'],totals['claims']),(3,3))
+        self.assertEqual(progress.read(),5)
+        self.assertEqual(self.claims(),[('user%d' % i,'User%d' % i) for i in range(5)])
+        self.assertEqual(list(Identity.objects.values_list('claim_count',flat=True)),[1] * 5)
+        progress.finish()
+        self.assertEqual(progress.read(),0)
+    
+    @override_settings(CACHES={'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache'},
+                               'fragments':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache','LOCATION':'fragments'}})
+    def test_fragments_expire(self):
+        """
+        Cached control panel fragments of the identities that gained claims go stale.
+        """
+        ci = CanonicalIdentity.objects.create(user=User.objects.create(username='user0'))
+        version = fragment_version(ci.pk)
+        import_identities(self.rows[:1])
+        self.assertNotEqual(fragment_version(ci.pk),version)
+    
+    def test_import_again(self):
+        """
+        Importing rows again, in any case, claims nothing new, and malformed rows are reported.
+        """
+        import_identities(self.rows)
+        rows = [dict(row,identity=row['identity'].lower()) for row in self.rows] + [{'user':'user0','service':'Nowhere','identity':'x'}]
+        totals = import_identities(rows,chunk_size=2)
+        self.assertEqual((totals['rows'],totals['claims']),(6,0))
+        self.assertEqual([(row_number,error) for row_number, row, error in totals['failed']],[(6,'Unknown service "Nowhere".')])
+        self.assertEqual(Identity.objects.count(),5)
+        self.assertEqual(len(self.claims()),5)
+
+@override_settings(CHANGE_FEED_DELAY=0.001,ADMISSION_CONTROL=False,SNAPSHOT_CHECK_INTERVAL=60)
+class SnapshotTest(TestCase):
+    """
+    Answering lookups and policies from a compiled snapshot, overlaid with later changes.
+    """
+    def setUp(self):
+        self.ci = CanonicalIdentity.objects.create(user=User.objects.create(username='someone'))
+        self.other = CanonicalIdentity.objects.create(user=User.objects.create(username='someone_else'))
+        self.consumer = DataConsumer.objects.create(name='Shop',domain='http://shop.com')
+        self.identity = Identity.objects.create(service=Service.objects.get(name='Twitter'),identity='someone',profile='http://twitter.com/someone')
+        IdentityClaim.objects.create(canonical_identity=self.ci,identity=self.identity,claim_confidence=75)
+        self.path = os.path.join(tempfile.mkdtemp(),'policies.snapshot')
+        time.sleep(0.01) # so the setup isn't taken for changes since the snapshot
+        compile_snapshot(self.path)
+        policy_cache().clear()
+        snapshot._state = None
+        self.override = self.settings(SNAPSHOT_PATH=self.path)
+        self.override.enable()
+    
+    def tearDown(self):
+        self.override.disable()
+        snapshot._state = None
+        shutil.rmtree(os.path.dirname(self.path))
+    
+    def test_unchanged_from_snapshot(self):
+        """
+        Lookups and policies unchanged since the snapshot was compiled are answered from it.
+        """
+        IdentityClaim.objects.update(canonical_identity=self.other) # unseen, as it sends no signals
+        self.assertEqual(resolve_profiles(['http://twitter.com/someone']),{'http://twitter.com/someone':[self.ci.pk]})
+        self.assertEqual(resolve_identities(['someone@@Twitter']),{'someone@@Twitter':[self.ci.pk]})
+        self.assertEqual(snapshot_policies([self.ci.pk]).keys(),[self.ci.pk])
+    
+    def test_changes_overlaid(self):
+        """
+        Changed policies, and lookups listing changed canonical identities, come from the database.
+        """
+        PolicyException.objects.create(canonical_identity=self.ci,consumer=self.consumer,grant=False)
+        self.assertEqual(snapshot_policies([self.ci.pk]),{})
+        self.assertEqual(len(get_policies([self.ci.pk])[self.ci.pk]['exceptions']),1)
+        
+        self.identity.profile = 'http://twitter.com/someone_new'
+        self.identity.save()
+        resolved = resolve_profiles(['http://twitter.com/someone','http://twitter.com/someone_new'])
+        self.assertEqual(resolved,{'http://twitter.com/someone':[],'http://twitter.com/someone_new':[self.ci.pk]})
+    
+    def test_changes_seen_from_other_workers(self):
+        """
+        Changes made by other workers are read from the database, and too many of them retire the
+        snapshot until a newer one is compiled.
+        """
+        state = snapshot_state()
+        snapshot._state = None # so this worker doesn't mark the change itself
+        PolicyException.objects.create(canonical_identity=self.ci,consumer=self.consumer,grant=False)
+        snapshot._state = state
+        self.assertEqual(snapshot_policies([self.ci.pk]).keys(),[self.ci.pk])
+        time.sleep(0.01) # past the feed delay
+        state.checked = 0 # as once the check interval has passed
+        self.assertEqual(snapshot_policies([self.ci.pk]),{})
+        
+        with self.settings(SNAPSHOT_MAX_CHANGES=1):
+            self.identity.identity = 'Someone'
+            self.identity.save()
+            state.checked = 0
+            self.assertEqual(snapshot_state(),None)
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class ClaimCounterTest(TestCase):
+    """
+    The claim counters kept on Identity.
+    """
+    def setUp(self):
+        self.identity = Identity.objects.create(service=Service.objects.get(name='Twitter'),identity='someone',profile='http://twitter.com/someone')
+        self.cis = [CanonicalIdentity.objects.create(user=User.objects.create(username='user%d' % i)) for i in range(3)]
+    
+    def counters(self):
+        identity = Identity.objects.get(pk=self.identity.pk)
+        return identity.claim_count, identity.claim_confidence_total, identity.confidence_distribution
+    
+    def claim(self,ci):
+        identity = Identity.objects.get(pk=self.identity.pk)
+        return IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=identity.next_claim_confidence)
+    
+    def test_counted(self):
+        """
+        Claims are counted by confidence grade as they are made, changed and deleted.
+        """
+        claims = [self.claim(ci) for ci in self.cis]
+        self.assertEqual(self.counters(),(3,75 + 75 + 50,{'high':2,'medium':1,'low':0}))
+        claims[2].claim_confidence = 30
+        claims[2].save()
+        self.assertEqual(self.counters(),(3,75 + 75 + 30,{'high':2,'medium':0,'low':1}))
+        claims[0].delete()
+        self.assertEqual(self.counters(),(2,75 + 30,{'high':1,'medium':0,'low':1}))
+    
+    def test_reconcile(self):
+        """
+        Counters that drifted, as bulk writes make them, are repaired.
+        """
+        for ci in self.cis:
+            self.claim(ci)
+        IdentityClaim.objects.filter(canonical_identity=self.cis[1]).update(claim_confidence=10)
+        Identity.objects.filter(pk=self.identity.pk).update(claim_count=0)
+        self.assertEqual(Identity.objects.reconcile_claim_counts(),1)
+        self.assertEqual(self.counters(),(3,75 + 10 + 50,{'high':1,'medium':1,'low':1}))
+        self.assertEqual(Identity.objects.reconcile_claim_counts([self.identity.pk]),0)
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class ConditionalPolicyTest(TestCase):
+    """
+    ETags and 304 Not Modified for policy lookups.
+    """
+    def setUp(self):
+        self.source = DataSource.objects.create(account_name='test',instance_name='test',api_key='abc123')
+        self.ci = CanonicalIdentity.objects.create(user=User.objects.create(username='someone'))
+        self.consumer = DataConsumer.objects.create(name='Shop',domain='http://shop.com')
+        identity = Identity.objects.create(service=Service.objects.get(name='Twitter'),identity='someone',profile='http://twitter.com/someone')
+        IdentityClaim.objects.create(canonical_identity=self.ci,identity=identity,claim_confidence=75)
+        self.url = '/api/abc123/policy/?profile=http://twitter.com/someone'
+        self.client = Client()
+    
+    def test_not_modified(self):
+        """
+        A lookup whose policies haven't changed is answered 304 for its ETag, until they change.
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code,200)
+        etag = response['ETag']
+        
+        response = self.client.get(self.url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code,304)
+        self.assertEqual(response['ETag'],etag)
+        self.assertEqual(response.content,'')
+        self.assertEqual(self.client.get(self.url,HTTP_IF_NONE_MATCH='"other", %s' % etag).status_code,304)
+        
+        PolicyException.objects.create(canonical_identity=self.ci,consumer=self.consumer,grant=False)
+        response = self.client.get(self.url,HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code,200)
+        self.assertNotEqual(response['ETag'],etag)
+        self.assertEqual(len(json.loads(response.content)[0]['exceptions']),1)
+    
+    def test_etag_per_query(self):
+        """
+        Lookups of the same policies in another form get another ETag, and failures get none.
+        """
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url.replace('profile=','profile_list='),HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code,200)
+        self.assertNotEqual(response['ETag'],etag)
+        self.assertFalse(self.client.get('/api/abc1234/policy/?profile=x').has_header('ETag'))
+
+@override_settings(ADMISSION_CONTROL=False,SNAPSHOT_PATH=None)
+class EmitterTest(TestCase):
+    """
+    FastJSONEmitter, which must write exactly what piston's JSONEmitter does.
+    """
+    def assertSameJSON(self,data,path='/'):
+        request = RequestFactory().get(path)
+        self.assertEqual(FastJSONEmitter(data,{},None).render(request),JSONEmitter(data,{},None).render(request))
+    
+    def test_policies(self):
+        """
+        Rendered policies, as lookups and bulk lookups return them.
+        """
+        ci = CanonicalIdentity.objects.create(user=User.objects.create(username='someone',first_name=u'J\xf6rg'))
+        consumer = DataConsumer.objects.create(name=u'Caf\xe9 \u2615',domain='http://cafe.com')
+        identity = Identity.objects.create(service=Service.objects.get(name='Twitter'),identity='someone',profile='http://twitter.com/someone')
+        IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=75)
+        PolicyException.objects.create(canonical_identity=ci,consumer=consumer,scope_id='Books',grant=False)
+        PolicyElement.objects.create(canonical_identity=ci,scope_id='Music',minimum_grade='B')
+        policy = dict(get_policies([ci.pk])[ci.pk])
+        policy['matched_by'] = {'profiles':['http://twitter.com/someone'],'identities':[]}
+        self.assertSameJSON([policy,{'identity':'x','error':'Malformed identity.'}])
+        self.assertSameJSON({'profiles':{'http://twitter.com/someone':[policy],'http://twitter.com/nobody':[]}})
+        self.assertSameJSON([policy],'/?callback=handle')
+    
+    def test_values(self):
+        """
+        Every kind of plain value, and values left to piston.
+        """
+        self.assertSameJSON({'a':[1,2L ** 70,-0.5,1e100,float('nan'),True,False,None],'b':{},'c':[],
+                             'd':'caf\xc3\xa9','e':u'"\\\n\t\u2028','f':{'g':{'h':[[{}]]}}})
+        self.assertSameJSON({'when':datetime(2014,1,1),'pair':(1,2)})
+        self.assertSameJSON({1:'non-string key'})
+
+@override_settings(ADMISSION_CONTROL=True,SNAPSHOT_PATH=None,STREAM_CHUNK_SIZE=1)
+class AdmissionTest(TestCase):
+    """
+    Admission control of API requests, by data source.
+    """
+    def setUp(self):
+        self.source = DataSource.objects.create(account_name='test',instance_name='test',api_key='abc123')
+        twitter = Service.objects.get(name='Twitter')
+        for i in range(3):
+            ci = CanonicalIdentity.objects.create(user=User.objects.create(username='user%d' % i))
+            identity = Identity.objects.create(service=twitter,identity='user%d' % i,profile='http://twitter.com/user%d' % i)
+            IdentityClaim.objects.create(canonical_identity=ci,identity=identity,claim_confidence=75)
+        self.directory = tempfile.mkdtemp()
+        self.override = self.settings(ADMISSION_PATH=os.path.join(self.directory,'admission'))
+        self.override.enable()
+        self.client = Client()
+    
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.directory)
+    
+    def limit(self,**limits):
+        DataSource.objects.filter(pk=self.source.pk).update(**limits)
+    
+    def lookup(self,count=1,**params):
+        params['profile_list'] = ','.join('http://twitter.com/user%d' % i for i in range(count))
+        return self.client.get('/api/abc123/policy/',params)
+    
+    def assertRefused(self,response,retry_after):
+        self.assertEqual(response.status_code,429)
+        self.assertEqual(response['Retry-After'],retry_after)
+    
+    def test_rate(self):
+        """
+        Lookups are charged per identity against the source's bucket, which refills at its rate.
+        """
+        self.limit(rate_limit=1,burst_limit=3)
+        self.assertEqual(self.lookup(2).status_code,200)
+        self.assertRefused(self.lookup(3),'2')
+        self.assertEqual(self.lookup(1).status_code,200)
+        self.assertRefused(self.client.post('/api/abc123/policy/',json.dumps({'profiles':['a','b']}),content_type='application/json'),'2')
+    
+    def test_zero_limits(self):
+        """
+        Limits of zero are the source's own, not the defaults.
+        """
+        self.limit(rate_limit=0,burst_limit=2)
+        self.assertEqual(self.lookup(2).status_code,200)
+        self.assertRefused(self.lookup(1),'60')
+        self.limit(rate_limit=None,burst_limit=None,concurrency_limit=0)
+        self.assertRefused(self.lookup(1),'1')
+    
+    def test_concurrency(self):
+        """
+        A streaming lookup holds its lease, renewing it, until the last chunk is sent.
+        """
+        self.limit(concurrency_limit=1)
+        with self.settings(ADMISSION_LEASE=0.3):
+            stream = self.lookup(3,format='ndjson').streaming_content
+            for i in range(3):
+                self.assertRefused(self.lookup(1),'1')
+                time.sleep(0.15) # past the lease, in all
+                next(stream)
+            self.assertRefused(self.lookup(1),'1')
+            self.assertEqual(list(stream),[])
+        self.assertEqual(self.lookup(1).status_code,200)
+        self.assertEqual(self.lookup(1).status_code,200)
@@ -22,10 +22,14 @@ urlpatterns = patterns('telltrail.views',
     url(r'^control/specific/(?P<policy_id>\d+)/delete/$','delete_specific_policy'),
 )
 
-# urlpatterns += patterns('',
-#     (r'^api/',include('telltrail.api.urls')),
-# )
-#
+urlpatterns += patterns('',
+    (r'^api/',include('telltrail.api.urls')),
+)
+
+urlpatterns += patterns('telltrail.metrics',
+    url(r'^metrics$','metrics_view'),
+)
+
 # from django.conf import settings
 #
 # if settings.DEBUG:
@@ -51,6 +51,13 @@ def backend(setting,default):
     else:
         return get_module(default)
 
+def chunked(items,chunk_size):
+    """
+    Splits the list of items into lists of at most chunk_size items.
+    """
+    for start in xrange(0,len(items),chunk_size):
+        yield items[start:start + chunk_size]
+
 def get_function(module_name,function_name):
     """
     Imports and returns the named function in the specified module.
@@ -88,6 +95,7 @@ def random_hex():
 from django.template import RequestContext
 from django.shortcuts import render_to_response
 from django.http import HttpResponse
+from functools import wraps
 
 def template(template_name):
     """
@@ -95,8 +103,8 @@ def template(template_name):
     The decorator will place the dictionary in a RequestContext wrapper, and return using
     the template specified in the parameter.
     """
-    from telltrail.models import CanonicalIdentity
     def function_builder(func):
+        @wraps(func)
         def view(request,*args,**kwargs):
             response = func(request,*args,**kwargs)
             if isinstance(response,HttpResponse):
@@ -105,8 +113,8 @@ def template(template_name):
                 return HttpResponse('OK')
             else:
                 ctx = RequestContext(request)
-                if not request.user.is_anonymous() and CanonicalIdentity.objects.filter(user=request.user).exists():
-                    ctx['ci'] = CanonicalIdentity.objects.get(user=request.user)
+                if request.canonical_identity:
+                    ctx['ci'] = request.canonical_identity
                 return render_to_response(template_name,response,context_instance=ctx)
         return view
     return function_builder
@@ -139,5 +147,5 @@ def catch(func):
         except:
             log.exception('Exception while executing function %s' % str(func))
             traceback.print_exc()
-
+    
     return wrapper
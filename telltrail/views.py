@@ -5,7 +5,6 @@ from django.http import HttpResponse, HttpResponseRedirect
 from telltrail.utils import template, catch
 from telltrail.forms import *
 from django.contrib import auth
-from telltrail.models import CanonicalIdentity
 
 @template('telltrail/landing.html')
 def landing(request):
@@ -78,11 +77,11 @@ def edit_personal_info(request):
     if request.POST:
         form = PersonalInfoForm(request.POST)
         if form.is_valid():
-            form.update_user(request.user)
+            form.update_user(request.canonical_identity)
             return 'OK'
     else:
         form = PersonalInfoForm()
-        form.init(request.user)
+        form.init(request.canonical_identity)
     
     return {'form':form}
 
@@ -99,7 +98,7 @@ def edit_policy(request):
     Edits the main data policy.
     """
     form = None
-    ci = CanonicalIdentity.objects.get(user=request.user)
+    ci = request.canonical_identity
     if request.POST:
         form = PolicyForm(request.POST)
         if form.is_valid():
@@ -126,7 +125,7 @@ def add_identity(request):
     if request.POST:
         form = IdentityForm(request.POST)
         if form.is_valid():
-            form.add_identity(request.user)
+            form.add_identity(request.canonical_identity)
             return 'OK'
     else:
         form = IdentityForm()
@@ -145,8 +144,7 @@ def delete_identity(request,claim_id):
     Deletes the user's claim on an identity.
     """
     try:
-        ci = CanonicalIdentity.objects.get(user=request.user)
-        claim = ci.identity_claims.get(pk=claim_id)
+        claim = request.canonical_identity.identity_claims.get(pk=claim_id)
         claim.delete()
     except IdentityClaim.DoesNotExist:
         pass
@@ -161,7 +159,7 @@ def add_exception(request):
     if request.POST:
         form = ExceptionForm(request.POST)
         if form.is_valid():
-            form.add_exception(request.user)
+            form.add_exception(request.canonical_identity)
             return 'OK'
     else:
         form = ExceptionForm()
@@ -180,8 +178,7 @@ def delete_exception(request,exception_id):
     Deletes the policy exception.
     """
     try:
-        ci = CanonicalIdentity.objects.get(user=request.user)
-        policy_exception = ci.policy_exceptions.get(pk=exception_id)
+        policy_exception = request.canonical_identity.policy_exceptions.get(pk=exception_id)
         policy_exception.delete()
     except PolicyException.DoesNotExist:
         pass
@@ -196,7 +193,7 @@ def add_specific_policy(request):
     if request.POST:
         form = SpecificPolicyForm(request.POST)
         if form.is_valid():
-            form.add_specific(request.user)
+            form.add_specific(request.canonical_identity)
             return 'OK'
     else:
         form = SpecificPolicyForm()
@@ -215,8 +212,7 @@ def delete_specific_policy(request,policy_id):
     Deletes the specific policy.
     """
     try:
-        ci = CanonicalIdentity.objects.get(user=user)
-        policy = ci.specific_policies.get(pk=policy_id)
+        policy = request.canonical_identity.specific_policies.get(pk=policy_id)
         policy.delete()
     except PolicyElement.DoesNotExist:
         pass
@@ -12,3 +12,9 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "telltrail.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# Load reference data and the audience index now, so under gunicorn --preload the workers inherit them
+from telltrail.reference import preload_reference_data
+from telltrail.audiences import preload_audience_index
+preload_reference_data()
+preload_audience_index()